@@ -8,9 +8,15 @@ import json
 import sys
 import traceback
 import time
+import threading
+import queue
 import logging
 from logging import Formatter
 import os
+from codec import CODECS, get_codec, decode
+from trainer.sparsify import Sparsifier, same_shapes
+from trainer.quantize import Quantizer, as_layers
+from trainer.delta import apply_delta
 try:
     import torch
 except:
@@ -56,6 +62,26 @@ if trainer_class is None:
     trainer_class = "TrainerMNIST"
 
 selected = False
+# wire format for weights, negotiated with the server on serverArgs
+codec_name = "json"
+# round of the last selection message, echoed back so the server can discard late responses
+current_round = None
+# asynchronous mode: the client keeps training on the latest global model it received
+async_mode = False
+latest_agg = None
+latest_agg_lock = threading.Lock()
+new_agg = threading.Event()
+# (function, args) of the work requested by the mqtt callbacks (training, applying the aggregated model)
+jobs = queue.Queue()
+# sparse uploads (server argument "sparsify"): the update is sent as a sparse delta against
+# base_weights, the (round, weights) of the last global model applied, which is also the base
+# of the deltas sent by the server (server argument "downlink")
+sparsifier = None
+base_weights = None
+# quantized uploads: client argument "quantize", or the server argument with the same name
+quantizer = None
+if CLIENT_INSTANTIATION_ARGS.get("quantize"):
+    quantizer = Quantizer(**CLIENT_INSTANTIATION_ARGS["quantize"])
 
 FORMAT = "%(asctime)s - %(infotype)-6s - %(levelname)s - %(message)s"
 # logging.basicConfig(level=logging.INFO, filename=log_file,
@@ -114,18 +140,28 @@ class color:
 
 # subscribe to queues on connection
 def on_connect(client, userdata, flags, rc):
-    subscribe_queues = ['minifed/selectionQueue',
-                        'minifed/posAggQueue', 'minifed/stopQueue', 'minifed/serverArgs']
+    subscribe_queues = ['minifed/selectionQueue', 'minifed/posAggQueue',
+                        f'minifed/posAgg/{CLIENT_NAME}', 'minifed/stopQueue', 'minifed/serverArgs']
     for s in subscribe_queues:
         client.subscribe(s)
 
 
 # callback for serverArgs: update the args with new information send by the server, between the round 0 and the round 1.
 def on_server_args(client, userdata, message):
+    global codec_name
+    global async_mode
+    global sparsifier
+    global quantizer
     msg = json.loads(message.payload.decode("utf-8"))
     if msg['id'] == CLIENT_NAME:
         if msg['args'] is not None:
             trainer.set_args(msg['args'])
+        codec_name = msg.get('codec', "json")
+        async_mode = msg.get('mode') == "async"
+        if msg.get('sparsify'):
+            sparsifier = Sparsifier(**msg['sparsify'])
+        if msg.get('quantize') and not CLIENT_INSTANTIATION_ARGS.get("quantize"):
+            quantizer = Quantizer(**msg['quantize'])
 
         client.publish('minifed/ready',
                        json.dumps({"id": CLIENT_NAME}, default=default))
@@ -139,8 +175,10 @@ the client trains and send the training results back.
 def on_message_selection(client, userdata, message):
     global selected
     global n_round
+    global current_round
     msg = json.loads(message.payload.decode("utf-8"))
     if msg['id'] == CLIENT_NAME:
+        current_round = msg.get('round')
         client_id = msg['id']
         if client_id not in n_round:
             n_round[client_id] = 0
@@ -152,26 +190,7 @@ def on_message_selection(client, userdata, message):
             print(color.BOLD_START + '[{}] new round starting'.format(n_round[client_id]) + color.BOLD_END)
             print(
                 f'trainer was selected for training this round and will start training!')
-
-            resp_dict = {'id': CLIENT_NAME, 'success': True }
-            t0 = time.time()
-            try:
-                trainer.train_model()
-                resp_dict['weights'] = trainer.get_weights()
-                resp_dict['num_samples'] = trainer.get_num_samples()
-                if has_method(trainer, 'get_training_args'):
-                    resp_dict['training_args'] = trainer.get_training_args()
-            except Exception:
-                print(traceback.format_exc())
-                resp_dict['success'] = False
-            t_train = time.time() - t0
-
-            spnfl_logger.info(f"T_TRAIN {resp_dict['success']} {t_train}")
-            response = json.dumps(resp_dict, default=default)
-
-            client.publish('minifed/preAggQueue', response)
-            spnfl_logger.info(f'T_RETURN_0')
-            print(f'finished training and sent weights!')
+            jobs.put((train_and_send, (client,)))
         else:
             spnfl_logger.info(f'T_SELECT False')
             selected = False
@@ -179,27 +198,98 @@ def on_message_selection(client, userdata, message):
             print(f'trainer was not selected for training this round')
 
 
-# callback for posAggQueue: gets aggregated weights and publish validation results on the metricsQueue
+# trains the model and sends the training results to the server on the preAggQueue
+def train_and_send(client):
+    resp_dict = {'id': CLIENT_NAME, 'success': True, 'round': current_round}
+    t0 = time.time()
+    try:
+        trainer.train_model()
+        weights = trainer.get_weights()
+        if sparsifier is not None and base_weights is not None and same_shapes(weights, base_weights[1]):
+            resp_dict['weights'] = sparsifier.compress(weights, base_weights[1])
+            resp_dict['base_round'] = base_weights[0]
+            if quantizer is not None:
+                resp_dict['weights']['values'] = quantizer.quantize_layer(resp_dict['weights']['values'])
+        elif quantizer is not None and as_layers(weights) is not None:
+            resp_dict['weights'] = quantizer.quantize(as_layers(weights))
+        else:
+            resp_dict['weights'] = weights
+        resp_dict['num_samples'] = trainer.get_num_samples()
+        if has_method(trainer, 'get_training_args'):
+            resp_dict['training_args'] = trainer.get_training_args()
+    except Exception:
+        print(traceback.format_exc())
+        resp_dict['success'] = False
+    t_train = time.time() - t0
+
+    try:
+        response = get_codec(codec_name, default=default).encode(resp_dict)
+    except Exception:
+        # the server still has to know that this trainer will not send weights this round
+        logger.exception(f'could not encode the training response of round {current_round}')
+        resp_dict = {'id': CLIENT_NAME, 'success': False, 'round': current_round}
+        response = get_codec(codec_name, default=default).encode(resp_dict)
+    spnfl_logger.info(f"T_TRAIN {resp_dict['success']} {t_train}")
+
+    client.publish('minifed/preAggQueue', response)
+    spnfl_logger.info(f'T_RETURN_0')
+    print(f'finished training and sent weights!')
+
+
+# callback for posAggQueue and posAgg/<name>: gets aggregated weights and publish validation results on the metricsQueue
+# the shared global model arrives on posAggQueue, a model specific to this trainer on posAgg/<name>
 def on_message_agg(client, userdata, message):
-    global selected
+    global latest_agg
     spnfl_logger.info(f'T_SEND')
     print(f'received aggregated weights!')
-    msg = json.loads(message.payload.decode("utf-8"))
-    agg_weights = [np.asarray(w, dtype=np.float32)
-                   for w in msg["agg_response"][CLIENT_NAME]["weights"]]
+    msg = decode(message.payload)
+    if async_mode:
+        # only the latest global model matters, older ones still waiting are discarded
+        with latest_agg_lock:
+            latest_agg = msg
+        new_agg.set()
+        jobs.put((async_step, (client,)))
+        return
+    jobs.put((apply_agg_response, (client, msg)))
+
+
+# updates the model with the aggregated weights and sends the metrics to the server
+def apply_agg_response(client, msg):
+    global base_weights
+    agg_response = msg["agg_response"]
+    # a delta can only be applied on the model of its base_round
+    base_round = agg_response.get("base_round")
+    applicable = base_round is None or (base_weights is not None and base_weights[0] == base_round)
     results = trainer.all_metrics()
     results['selected'] = selected
+    # version: the global model the trainer will hold (None asks the server for the full model)
     response = json.dumps(
-        {'id': CLIENT_NAME, "metrics": results}, default=default)
-    trainer.update_weights(agg_weights)
-
-    if has_method(trainer, "agg_response_extra_info"):
-        trainer.agg_response_extra_info(
-            msg["agg_response"][CLIENT_NAME] | msg["agg_response"]['all'])
-
+        {'id': CLIENT_NAME, "metrics": results, "round": msg.get('round'),
+         "version": msg.get('round') if applicable else None}, default=default)
+    # the metrics are from the model of this round, so they are sent before the
+    # aggregated weights are decoded and loaded
     print(f'sending eval metrics!\n')
     client.publish('minifed/metricsQueue', response)
     spnfl_logger.info(f'T_RETURN_1')
+
+    agg_weights = agg_response["weights"]
+    if not applicable:
+        print(color.RED + f'received a delta against the global model of round {base_round}, '
+              f'which this trainer does not hold: waiting for the full model' + color.RESET)
+        base_weights = None
+        spnfl_logger.info(f'END_ROUND {n_round[CLIENT_NAME]-1}')
+        return
+    if base_round is not None:
+        agg_weights = apply_delta(agg_weights, base_weights[1])
+        base_weights = (msg.get('round'), agg_weights)
+    elif not isinstance(agg_weights, dict):
+        # dict: sparse top-k delta (SketchAggTopK), handled by the trainer
+        agg_weights = [np.asarray(w, dtype=np.float32) for w in agg_weights]
+        base_weights = (msg.get('round'), agg_weights)
+    trainer.update_weights(agg_weights)
+
+    if has_method(trainer, "agg_response_extra_info"):
+        trainer.agg_response_extra_info(agg_response)
     spnfl_logger.info(f'END_ROUND {n_round[CLIENT_NAME]-1}')
 
 
@@ -216,6 +306,7 @@ client.connect(BROKER_ADDR, keepalive=0)
 client.on_connect = on_connect
 client.message_callback_add('minifed/selectionQueue', on_message_selection)
 client.message_callback_add('minifed/posAggQueue', on_message_agg)
+client.message_callback_add(f'minifed/posAgg/{CLIENT_NAME}', on_message_agg)
 client.message_callback_add('minifed/stopQueue', on_message_stop)
 client.message_callback_add('minifed/serverArgs', on_server_args)
 
@@ -225,14 +316,49 @@ client.loop_start()
 spnfl_logger.info("INIT_EXPERIMENT")
 
 response = json.dumps({'id': CLIENT_NAME, 'accuracy': trainer.eval_model(
-), "metrics": trainer.all_metrics()}, default=default)
+), "metrics": trainer.all_metrics(), "codecs": list(CODECS)}, default=default)
 client.publish('minifed/registerQueue',  response)
 spnfl_logger.info(f'T_ARRIVAL')
 print(color.BOLD_START +
       f'trainer {CLIENT_NAME} connected!\n' + color.BOLD_END)
 
 
+# asynchronous mode: apply the newest global model, send its metrics and train again on top of it
+def async_step(client):
+    global latest_agg
+    global current_round
+    # a job is queued for every global model received, the newest one handles them all
+    if not new_agg.is_set():
+        return
+    with latest_agg_lock:
+        msg = latest_agg
+        latest_agg = None
+        new_agg.clear()
+    # trainers that joined after the start only begin with the first global model they receive
+    n_round.setdefault(CLIENT_NAME, 0)
+    apply_agg_response(client, msg)
+
+    current_round = msg.get('round')
+    n_round[CLIENT_NAME] += 1
+    spnfl_logger.info(f'START_ROUND {n_round[CLIENT_NAME]-1}')
+    spnfl_logger.info(f'T_SELECT True')
+    print(color.BOLD_START + '[{}] training on global model version {}'.format(
+        n_round[CLIENT_NAME], current_round) + color.BOLD_END)
+    train_and_send(client)
+
+
+# the work of the trainer runs here, in arrival order, instead of in the mqtt callbacks,
+# so the network loop keeps answering the broker and receiving while the trainer works
 while not trainer.get_stop_flag():
-    time.sleep(1)
+    try:
+        function, args = jobs.get(timeout=1)
+    except queue.Empty:
+        continue
+    # a failing job must not stop the trainer: the next messages of the server are still handled
+    try:
+        function(*args)
+    except Exception:
+        logger.exception(f'job {function.__name__} failed')
+        print(traceback.format_exc())
 
 client.loop_stop()
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# trainer/__init__.py imports every trainer (and TensorFlow), so the tests import the standalone
+# modules of trainer/ (partitioner.py, dataset_cache.py) as top-level modules, as their scripts do
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "trainer"))
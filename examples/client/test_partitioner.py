@@ -0,0 +1,97 @@
+import numpy as np
+import pytest
+
+from partitioner import load_partition, main, partition, partition_name, per_user, save_partitions
+
+
+def labels(n, n_classes=10, seed=0):
+    return np.random.default_rng(seed).integers(0, n_classes, size=n).astype(np.uint8)
+
+
+TRAIN = labels(3000)
+TEST = labels(600, seed=1)
+
+
+@pytest.mark.parametrize("scheme", ["iid", "dirichlet", "quantity"])
+def test_same_seed_same_partition(scheme):
+    a = partition(TRAIN, TEST, scheme, 8, alpha=0.5, seed=3)
+    b = partition(TRAIN, TEST, scheme, 8, alpha=0.5, seed=3)
+    for (train_a, test_a), (train_b, test_b) in zip(a, b):
+        np.testing.assert_array_equal(train_a, train_b)
+        np.testing.assert_array_equal(test_a, test_b)
+
+
+def test_other_seed_other_partition():
+    a = partition(TRAIN, TEST, "dirichlet", 8, seed=0)
+    b = partition(TRAIN, TEST, "dirichlet", 8, seed=1)
+    assert any(len(x[0]) != len(y[0]) or (x[0] != y[0]).any() for x, y in zip(a, b))
+
+
+@pytest.mark.parametrize("scheme", ["iid", "dirichlet", "quantity"])
+def test_every_sample_goes_to_one_client(scheme):
+    partitions = partition(TRAIN, TEST, scheme, 7, alpha=0.3, seed=0)
+    assert len(partitions) == 7
+    for split, all_labels in ((0, TRAIN), (1, TEST)):
+        indices = np.concatenate([p[split] for p in partitions])
+        assert indices.dtype == np.int32
+        np.testing.assert_array_equal(np.sort(indices), np.arange(len(all_labels)))
+        for p in partitions:
+            assert np.all(np.diff(p[split]) > 0)
+
+
+def test_iid_is_balanced():
+    for train, _ in partition(TRAIN, TEST, "iid", 5, seed=0):
+        counts = np.bincount(TRAIN[train], minlength=10)
+        expected = np.bincount(TRAIN, minlength=10) / 5
+        assert np.abs(counts - expected).max() <= 1
+
+
+def test_test_set_follows_the_train_shares():
+    # label skew: each client is evaluated on its own label distribution
+    for train, test in partition(TRAIN, TEST, "dirichlet", 4, alpha=0.2, seed=0):
+        train_dist = np.bincount(TRAIN[train], minlength=10) / max(len(train), 1)
+        test_dist = np.bincount(TEST[test], minlength=10) / max(len(test), 1)
+        assert np.abs(train_dist - test_dist).max() < 0.15
+
+
+def test_invalid_scheme():
+    with pytest.raises(ValueError):
+        partition(TRAIN, TEST, "pathological", 4)
+
+
+def test_per_user():
+    users = np.repeat(np.arange(10), 30)
+    partitions = per_user(users, 3, test_ratio=0.2, seed=0)
+    np.testing.assert_array_equal(partitions[0][0], per_user(users, 3, test_ratio=0.2, seed=0)[0][0])
+    seen = set()
+    for train, test in partitions:
+        client_users = set(users[np.concatenate([train, test])])
+        assert not client_users & seen
+        seen |= client_users
+        assert len(test) == int((len(train) + len(test)) * 0.2)
+    assert seen == set(range(10))
+
+
+def test_save_and_load(tmp_path):
+    partitions = partition(TRAIN, TEST, "dirichlet", 3, seed=0)
+    name = partition_name("mnist", "dirichlet", 3, 0.5, 0)
+    assert name == "mnist_dirichlet0.5_3_0"
+    save_partitions(str(tmp_path / name), partitions, {"seed": 0})
+    train, test = load_partition(name, 2, partitions_path=str(tmp_path))
+    np.testing.assert_array_equal(train, partitions[2][0])
+    np.testing.assert_array_equal(test, partitions[2][1])
+    with pytest.raises(FileNotFoundError):
+        load_partition(name, 3, partitions_path=str(tmp_path))
+
+
+def test_per_user_command(tmp_path):
+    users = np.repeat(np.array(["s1", "s2", "s3", "s4", "s5"]), 20)
+    users_file = tmp_path / "har_users.txt"
+    users_file.write_text("\n".join(users))
+    name = main(["partitioner.py", str(users_file), "per_user", "2", "0.25", "1"], data_dir=str(tmp_path))
+    assert name == "har_users_per_user0.25_2_1"
+    expected = per_user(users, 2, test_ratio=0.25, seed=1)
+    for client in range(2):
+        train, test = load_partition(name, client, partitions_path=str(tmp_path / "partitions"))
+        np.testing.assert_array_equal(train, expected[client][0])
+        np.testing.assert_array_equal(test, expected[client][1])
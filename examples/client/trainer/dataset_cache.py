@@ -0,0 +1,112 @@
+"""
+Preprocessed dataset cache shared by all trainers of a host.
+
+The raw datasets under data/ are converted once into normalized .npy files
+(images float32 in [0, 1], labels uint8). Trainers open them with
+np.load(mmap_mode='r'), so every container on the host shares the same page
+cache and only copies its own partition into memory.
+
+Usage (from the MininetFed folder, before the experiment):
+    python examples/client/trainer/dataset_cache.py [data_dir] [mnist|cifar ...]
+"""
+import os
+import pickle
+import sys
+import tempfile
+
+import numpy as np
+
+# inside the containers the MininetFed folder is mounted on /flw
+CACHE_PATH = 'flw/data/cache'
+MNIST_PATH = 'flw/data/MNIST'
+CIFAR_PATH = 'flw/data/cifar-10-batches-py'
+
+SPLITS = ('train_images', 'train_labels', 'test_images', 'test_labels')
+
+
+def _read_idx(file_path):
+    # idx files of MNIST: magic number, dimensions (uint32 big-endian), uint8 data
+    with open(file_path, 'rb') as f:
+        magic = int.from_bytes(f.read(4), 'big')
+        n_dims = magic & 0xFF
+        shape = [int.from_bytes(f.read(4), 'big') for _ in range(n_dims)]
+        return np.frombuffer(f.read(), dtype=np.uint8).reshape(shape)
+
+
+def read_mnist(data_path=MNIST_PATH):
+    train_images = _read_idx(os.path.join(data_path, 'train-images.idx3-ubyte'))
+    train_labels = _read_idx(os.path.join(data_path, 'train-labels.idx1-ubyte'))
+    test_images = _read_idx(os.path.join(data_path, 't10k-images.idx3-ubyte'))
+    test_labels = _read_idx(os.path.join(data_path, 't10k-labels.idx1-ubyte'))
+    return train_images, train_labels, test_images, test_labels
+
+
+def read_cifar(data_path=CIFAR_PATH):
+    def load_batch(file):
+        with open(file, 'rb') as f:
+            batch = pickle.load(f, encoding='bytes')
+        data = batch[b'data'].reshape(-1, 3, 32, 32).transpose(0, 2, 3, 1)
+        return data, np.array(batch[b'labels'], dtype=np.uint8)
+
+    batches = [load_batch(os.path.join(data_path, f"data_batch_{i}")) for i in range(1, 6)]
+    train_images = np.concatenate([b[0] for b in batches])
+    train_labels = np.concatenate([b[1] for b in batches])
+    test_images, test_labels = load_batch(os.path.join(data_path, "test_batch"))
+    return train_images, train_labels, test_images, test_labels
+
+
+READERS = {
+    'mnist': (read_mnist, MNIST_PATH),
+    'cifar': (read_cifar, CIFAR_PATH),
+}
+
+
+def cache_files(name, cache_path=CACHE_PATH):
+    return {split: os.path.join(cache_path, f"{name}_{split}.npy") for split in SPLITS}
+
+
+def build_cache(name, data_path=None, cache_path=CACHE_PATH):
+    reader, default_path = READERS[name]
+    arrays = dict(zip(SPLITS, reader(data_path or default_path)))
+    os.makedirs(cache_path, exist_ok=True)
+    for split, path in cache_files(name, cache_path).items():
+        array = arrays[split]
+        if split.endswith('images'):
+            array = array.astype(np.float32) / np.float32(255.0)
+        # written to a temporary file first: other trainers may be reading the cache. The
+        # trainers of other containers share the folder (and may have the same pid)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_path, prefix=f"{name}_{split}.", suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, array)
+            os.chmod(tmp_path, 0o644)  # mkstemp creates it readable only by its owner
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+
+def load_dataset(name, data_path=None, cache_path=CACHE_PATH):
+    """
+    Returns (train_images, train_labels), (test_images, test_labels) as read-only
+    memory-mapped arrays, building the cache from the raw files if needed.
+    """
+    files = cache_files(name, cache_path)
+    if not all(os.path.exists(path) for path in files.values()):
+        build_cache(name, data_path, cache_path)
+    arrays = {split: np.load(path, mmap_mode='r') for split, path in files.items()}
+    return ((arrays['train_images'], arrays['train_labels']),
+            (arrays['test_images'], arrays['test_labels']))
+
+
+if __name__ == '__main__':
+    data_dir = sys.argv[1] if len(sys.argv) > 1 else 'data'
+    names = sys.argv[2:] or list(READERS)
+    paths = {'mnist': os.path.join(data_dir, 'MNIST'),
+             'cifar': os.path.join(data_dir, 'cifar-10-batches-py')}
+    for name in names:
+        if not os.path.exists(paths[name]):
+            print(f"{paths[name]} not found, skipping {name}")
+            continue
+        build_cache(name, paths[name], os.path.join(data_dir, 'cache'))
+        print(f"{name} cached in {os.path.join(data_dir, 'cache')}")
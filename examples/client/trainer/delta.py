@@ -0,0 +1,78 @@
+import numpy as np
+
+from .sparsify import Sparsifier, densify, flatten, index_dtype, is_sparse, layer_shapes, same_shapes
+from .quantize import Quantizer, dequantize, dequantize_layer, is_quantized_layer
+
+
+# Delta-based downlink: instead of the full global model, a trainer that already holds the
+# model of round r receives {"weights": delta, "base_round": r, ...}, with delta as
+#   a sparse message (sparsify.py), optionally with quantized values,
+#   quantized layers (quantize.py), or
+#   the coordinates that changed, as a sparse message with "delta": False.
+# apply_delta() rebuilds the model. The server runs the same function, so it knows the
+# exact weights every trainer holds, and the error of a lossy delta is sent again in the
+# next one. The copies of this file in client/trainer/ and server/aggregator/ must be kept in sync.
+
+
+def apply_delta(delta, base):
+    # float32 layers of base updated by a downlink delta (base is not modified)
+    if is_sparse(delta):
+        if is_quantized_layer(delta["values"]):
+            delta = delta | {"values": dequantize_layer(delta["values"])}
+        return densify(delta, base)
+    layers = dequantize(delta)
+    if len(layers) != len(base):
+        raise ValueError("Error: the delta does not match the shape of the base model")
+    return [np.add(np.asarray(b, dtype=np.float32), d, dtype=np.float32) for b, d in zip(base, layers)]
+
+
+def exact_delta(weights, base):
+    # lossless delta: the coordinates of weights that differ from base, None without base or
+    # when sending an (index, value) pair for each of them is not smaller than the full model
+    if base is None or not same_shapes(weights, base):
+        return None
+    vector = flatten(weights)
+    indices = np.flatnonzero(vector != flatten(base))
+    if 2 * len(indices) >= len(vector):
+        return None
+    return {"sparse": "exact", "indices": indices.astype(index_dtype(len(vector))),
+            "values": vector[indices], "shapes": layer_shapes(weights), "delta": False}
+
+
+class DeltaEncoder:
+    """
+    Downlink deltas of the server, configured by the server argument "downlink", e.g.
+    {"versions": 4, "sparsify": {"scheme": "topk", "ratio": 0.1}, "quantize": {"scheme": "int8"}}.
+    Without "sparsify" and "quantize" the deltas are lossless.
+    """
+
+    def __init__(self, versions=4, sparsify=None, quantize=None, seed=None):
+        if versions < 1:
+            raise ValueError("Error: the downlink needs at least one model version")
+        self.versions = versions
+        # the error of the lossy deltas is kept by the server (see above), not by the sparsifier
+        self.sparsifier = None
+        if sparsify:
+            self.sparsifier = Sparsifier(**(sparsify | {"error_feedback": False, "seed": seed}))
+        self.quantizer = Quantizer(**(quantize | {"seed": seed})) if quantize else None
+
+    def encode(self, weights, base):
+        """
+        (delta, weights rebuilt by the trainers) from base to weights. The delta is None
+        when the full model must be sent: the shapes changed or the delta is not smaller.
+        """
+        weights = [np.asarray(w, dtype=np.float32) for w in weights]
+        if not same_shapes(weights, base):
+            return None, weights
+        if self.sparsifier is not None:
+            delta = self.sparsifier.compress(weights, base)
+            if self.quantizer is not None:
+                delta["values"] = self.quantizer.quantize_layer(delta["values"])
+        elif self.quantizer is not None:
+            delta = self.quantizer.quantize([np.subtract(w, b, dtype=np.float32)
+                                             for w, b in zip(weights, base)])
+        else:
+            delta = exact_delta(weights, base)
+            if delta is None:
+                return None, weights
+        return delta, apply_delta(delta, base)
@@ -0,0 +1,160 @@
+"""
+Deterministic federated data partitioner.
+
+Splits a dataset of the cache (see dataset_cache.py) among the clients ahead of
+the experiment and saves one index file per client (client_<id>.npz with the
+int32 arrays "train" and "test"). Trainers only load their own file, so startup
+does not depend on the size of the dataset and the partition is the same in
+every run with the same seed.
+
+Schemes:
+    iid        every client gets the same share of every class
+    dirichlet  label skew: the share of each class is drawn from Dirichlet(alpha)
+    quantity   quantity skew: the size of each client is drawn from Dirichlet(alpha),
+               with the classes distributed as in the whole dataset
+    per_user   each client gets all the samples of some users (see per_user)
+
+The test set is split with the same class shares as the training set, so each
+client is evaluated on its own label distribution.
+
+Usage (from the MininetFed folder):
+    python examples/client/trainer/partitioner.py <dataset> <scheme> <n_clients> [alpha] [seed]
+    e.g. python examples/client/trainer/partitioner.py mnist dirichlet 8 0.5 0
+For per_user, <dataset> is a file with the user of each sample (.npy, or text with
+one user per line) and alpha is replaced by the test ratio:
+    python examples/client/trainer/partitioner.py data/har_users.npy per_user 8 0.2 0
+"""
+import json
+import os
+import sys
+
+import numpy as np
+
+try:
+    from .dataset_cache import load_dataset
+except ImportError:
+    from dataset_cache import load_dataset
+
+PARTITIONS_PATH = 'flw/data/partitions'
+
+
+def class_shares(scheme, n_classes, n_clients, alpha, rng):
+    # (n_classes x n_clients) matrix: share of each class that goes to each client
+    if scheme == 'iid':
+        return np.full((n_classes, n_clients), 1.0 / n_clients)
+    if scheme == 'dirichlet':
+        return rng.dirichlet(np.full(n_clients, alpha), size=n_classes)
+    if scheme == 'quantity':
+        return np.tile(rng.dirichlet(np.full(n_clients, alpha)), (n_classes, 1))
+    raise ValueError(f"Error: partition scheme {scheme} not available")
+
+
+def split_by_shares(labels, shares, rng):
+    # splits the indices of each class among the clients with the given shares
+    n_classes, n_clients = shares.shape
+    parts = [[] for _ in range(n_clients)]
+    for c in range(n_classes):
+        indices = rng.permutation(np.flatnonzero(labels == c))
+        bounds = np.round(np.cumsum(shares[c]) * len(indices)).astype(np.int64)[:-1]
+        for client, part in enumerate(np.split(indices, bounds)):
+            parts[client].append(part)
+    return [np.sort(np.concatenate(p)).astype(np.int32) for p in parts]
+
+
+def per_user(users, n_clients, test_ratio=0.2, seed=0):
+    """
+    users: user (subject) of each sample. The users are dealt to the clients in
+    sorted order (client i gets users i, i + n_clients, ...) and the samples of
+    each client are split into train/test with test_ratio.
+    """
+    rng = np.random.default_rng(seed)
+    users = np.asarray(users)
+    unique_users = np.unique(users)
+    partitions = []
+    for client in range(n_clients):
+        indices = rng.permutation(np.flatnonzero(np.isin(users, unique_users[client::n_clients])))
+        n_test = int(len(indices) * test_ratio)
+        partitions.append((np.sort(indices[n_test:]).astype(np.int32),
+                           np.sort(indices[:n_test]).astype(np.int32)))
+    return partitions
+
+
+def partition(train_labels, test_labels, scheme, n_clients, alpha=0.5, seed=0):
+    # returns [(train_indices, test_indices)] for each client
+    rng = np.random.default_rng(seed)
+    n_classes = int(max(train_labels.max(), test_labels.max())) + 1
+    shares = class_shares(scheme, n_classes, n_clients, alpha, rng)
+    train = split_by_shares(np.asarray(train_labels), shares, rng)
+    test = split_by_shares(np.asarray(test_labels), shares, rng)
+    return list(zip(train, test))
+
+
+def partition_name(dataset, scheme, n_clients, alpha, seed):
+    # alpha is the test ratio of per_user
+    if scheme in ('dirichlet', 'quantity', 'per_user'):
+        return f"{dataset}_{scheme}{alpha}_{n_clients}_{seed}"
+    return f"{dataset}_{scheme}_{n_clients}_{seed}"
+
+
+def save_partitions(path, partitions, info=None):
+    os.makedirs(path, exist_ok=True)
+    for client, (train, test) in enumerate(partitions):
+        np.savez(os.path.join(path, f"client_{client}.npz"), train=train, test=test)
+    with open(os.path.join(path, "partition.json"), "w") as f:
+        json.dump(info or {}, f)
+
+
+def load_partition(name, client, partitions_path=PARTITIONS_PATH):
+    # (train_indices, test_indices) of one client
+    path = os.path.join(partitions_path, name, f"client_{client}.npz")
+    if not os.path.exists(path):
+        raise FileNotFoundError(
+            f"Partition {path} not found, create it with partitioner.py before the experiment.")
+    with np.load(path) as data:
+        return data["train"], data["test"]
+
+
+def load_users(users_path):
+    # user of each sample: .npy file or text file with one user per line
+    if users_path.endswith('.npy'):
+        return np.load(users_path)
+    return np.loadtxt(users_path, dtype=str, ndmin=1)
+
+
+def main(argv, data_dir='data'):
+    if len(argv) < 4:
+        print("correct use: python partitioner.py <dataset> <iid|dirichlet|quantity> <n_clients> [alpha] [seed]\n"
+              "             python partitioner.py <users_file> per_user <n_clients> [test_ratio] [seed]")
+        sys.exit(1)
+    dataset, scheme, n_clients = argv[1], argv[2], int(argv[3])
+    seed = int(argv[5]) if len(argv) > 5 else 0
+
+    if scheme == 'per_user':
+        alpha = float(argv[4]) if len(argv) > 4 else 0.2
+        users = load_users(dataset)
+        partitions = per_user(users, n_clients, test_ratio=alpha, seed=seed)
+        dataset = os.path.splitext(os.path.basename(dataset))[0]
+    else:
+        alpha = float(argv[4]) if len(argv) > 4 else 0.5
+        raw_paths = {'mnist': 'MNIST', 'cifar': 'cifar-10-batches-py'}
+        (_, train_labels), (_, test_labels) = load_dataset(
+            dataset, os.path.join(data_dir, raw_paths[dataset]), os.path.join(data_dir, 'cache'))
+        partitions = partition(train_labels, test_labels, scheme, n_clients, alpha, seed)
+
+    name = partition_name(dataset, scheme, n_clients, alpha, seed)
+    path = os.path.join(data_dir, 'partitions', name)
+    save_partitions(path, partitions, {"dataset": dataset, "scheme": scheme, "n_clients": n_clients,
+                                       "alpha": alpha, "seed": seed})
+    for client, (train, test) in enumerate(partitions):
+        if scheme == 'per_user':
+            print(f"client {client}: {len(train)} train, {len(test)} test, "
+                  f"users {np.unique(users[np.concatenate([train, test])]).tolist()}")
+        else:
+            print(f"client {client}: {len(train)} train, {len(test)} test, "
+                  f"classes {np.bincount(train_labels[train], minlength=10).tolist()}")
+    print(f"partition saved in {path} (client argument \"partition\": \"{name}\")")
+    return name
+
+
+if __name__ == '__main__':
+    main(sys.argv)
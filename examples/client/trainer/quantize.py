@@ -0,0 +1,163 @@
+import numpy as np
+
+
+# Update quantization: every layer of the weights is sent as
+#   fp16        {"quant": "fp16", "data": float16}
+#   int8        {"quant": "int8", "data": int8, "scale": s, "zero_point": z}, value = s * (q - z),
+#               over the range of the layer extended to include 0
+#   stochastic  {"quant": "stochastic", "bits": b, "data": packed codes, "shape": [...],
+#                "scale": s, "min": m}, value = m + s * code, codes rounded up with
+#                probability equal to the fraction, so the dequantized layer is unbiased
+# and the whole model as {"quantized": scheme, "layers": [...]}. The server dequantizes the
+# layers while accumulating them (add_dequantized), without a float32 copy of the model.
+# The copies of this file in client/trainer/ and server/aggregator/ must be kept in sync.
+SCHEMES = ("fp16", "int8", "stochastic")
+# stochastic codes are packed 8 // bits per byte (bits <= 8) or sent as uint16
+STOCHASTIC_BITS = (1, 2, 4, 8, 16)
+
+
+def _as_array(layer):
+    if hasattr(layer, "detach") and hasattr(layer, "numpy"):
+        # torch.Tensor
+        layer = layer.detach().cpu().numpy()
+    return np.asarray(layer, dtype=np.float32)
+
+
+def as_layers(weights):
+    # list of layers of the weights returned by a trainer, None if they are not quantizable
+    # (e.g. the sparse dicts of the sketch aggregators); 2-D arrays are lists of rows
+    if isinstance(weights, (list, tuple)):
+        return list(weights)
+    if isinstance(weights, np.ndarray) and weights.ndim > 1:
+        return list(weights)
+    return None
+
+
+def pack(codes, bits):
+    if bits == 16:
+        return codes.astype(np.uint16)
+    codes = codes.astype(np.uint8)
+    per_byte = 8 // bits
+    if per_byte == 1:
+        return codes
+    padded = np.zeros(-(-len(codes) // per_byte) * per_byte, dtype=np.uint8)
+    padded[:len(codes)] = codes
+    shifts = np.arange(0, 8, bits, dtype=np.uint8)
+    return np.bitwise_or.reduce(padded.reshape(-1, per_byte) << shifts, axis=1).astype(np.uint8)
+
+
+def unpack(data, bits, size):
+    if bits == 16:
+        return np.asarray(data, dtype=np.uint16)[:size]
+    data = np.asarray(data, dtype=np.uint8)
+    if bits == 8:
+        return data[:size]
+    shifts = np.arange(0, 8, bits, dtype=np.uint8)
+    mask = np.uint8((1 << bits) - 1)
+    return ((data[:, None] >> shifts) & mask).reshape(-1)[:size]
+
+
+def quantize_layer(layer, scheme="int8", bits=8, rng=None):
+    x = _as_array(layer)
+    if scheme == "fp16":
+        return {"quant": "fp16", "data": x.astype(np.float16)}
+    low = float(x.min()) if x.size else 0.0
+    high = float(x.max()) if x.size else 0.0
+    if scheme == "int8":
+        # the range always includes 0, so the zero point is an int8 and 0 is exact
+        # (e.g. a bias in [0.9, 1.1] is quantized over [0, 1.1])
+        low, high = min(low, 0.0), max(high, 0.0)
+        scale = (high - low) / 255 or 1.0
+        zero_point = int(np.round(-128 - low / scale))
+        q = np.clip(np.round(x / scale) + zero_point, -128, 127).astype(np.int8)
+        return {"quant": "int8", "data": q, "scale": scale, "zero_point": zero_point}
+    if scheme == "stochastic":
+        if bits not in STOCHASTIC_BITS:
+            raise ValueError(f"Error: stochastic quantization to {bits} bits not available ({list(STOCHASTIC_BITS)})")
+        rng = rng if rng is not None else np.random.default_rng()
+        levels = (1 << bits) - 1
+        scale = (high - low) / levels or 1.0
+        scaled = (x.ravel() - low) / scale
+        codes = np.floor(scaled + rng.random(scaled.shape, dtype=np.float32))
+        codes = np.clip(codes, 0, levels)
+        return {"quant": "stochastic", "bits": bits, "data": pack(codes, bits),
+                "shape": list(x.shape), "scale": scale, "min": low}
+    raise ValueError(f"Error: quantization scheme {scheme} not available ({list(SCHEMES)})")
+
+
+def is_quantized(weights):
+    return isinstance(weights, dict) and "quantized" in weights
+
+
+def is_quantized_layer(layer):
+    return isinstance(layer, dict) and "quant" in layer
+
+
+def layer_shape(layer):
+    if not is_quantized_layer(layer):
+        return np.shape(layer)
+    if "shape" in layer:
+        return tuple(layer["shape"])
+    return np.shape(layer["data"])
+
+
+def _affine(layer):
+    # (codes, scale, offset) of a layer: value = scale * code + offset
+    if not is_quantized_layer(layer):
+        return np.asarray(layer), 1.0, 0.0
+    kind = layer["quant"]
+    if kind == "fp16":
+        return np.asarray(layer["data"], dtype=np.float16), 1.0, 0.0
+    if kind == "int8":
+        scale = layer["scale"]
+        return np.asarray(layer["data"], dtype=np.int8), scale, -scale * layer["zero_point"]
+    if kind == "stochastic":
+        shape = tuple(layer["shape"])
+        codes = unpack(layer["data"], layer["bits"], int(np.prod(shape))).reshape(shape)
+        return codes, layer["scale"], layer["min"]
+    raise ValueError(f"Error: quantization scheme {kind} not available ({list(SCHEMES)})")
+
+
+def dequantize_layer(layer):
+    codes, scale, offset = _affine(layer)
+    values = np.multiply(codes, scale, dtype=np.float32)
+    if offset:
+        values += np.float32(offset)
+    return values
+
+
+def dequantize(weights):
+    # float32 layers of a quantized model (or of plain layers)
+    layers = weights["layers"] if is_quantized(weights) else weights
+    return [dequantize_layer(layer) for layer in layers]
+
+
+def add_dequantized(acc, layer, weight, out=None):
+    # acc += weight * layer, dequantized on the fly in float64 (out: optional scratch buffer)
+    codes, scale, offset = _affine(layer)
+    acc += np.multiply(codes, weight * scale, out=out, dtype=np.float64)
+    if offset:
+        acc += weight * offset
+    return acc
+
+
+class Quantizer:
+    """
+    Quantizes the weights uploaded by a client, configured by the server argument or the
+    client argument "quantize", e.g. {"scheme": "int8"} or {"scheme": "stochastic", "bits": 4}.
+    """
+
+    def __init__(self, scheme="int8", bits=8, seed=None):
+        if scheme not in SCHEMES:
+            raise ValueError(f"Error: quantization scheme {scheme} not available ({list(SCHEMES)})")
+        if scheme == "stochastic" and bits not in STOCHASTIC_BITS:
+            raise ValueError(f"Error: stochastic quantization to {bits} bits not available ({list(STOCHASTIC_BITS)})")
+        self.scheme = scheme
+        self.bits = bits
+        self.rng = np.random.default_rng(seed)
+
+    def quantize_layer(self, layer):
+        return quantize_layer(layer, self.scheme, self.bits, self.rng)
+
+    def quantize(self, layers):
+        return {"quantized": self.scheme, "layers": [self.quantize_layer(layer) for layer in layers]}
@@ -0,0 +1,48 @@
+import logging
+import time
+
+import numpy as np
+
+from .sketch_utils import DP_MECHANISMS, add_dp_noise, dp_noise_scale, estimate_epsilon, flat_weights
+
+spnfl_logger = logging.getLogger("spnfl")
+
+
+class SketchDP:
+    """
+    Differential privacy of the sketches sent by a sketch trainer, configured by the
+    client argument "dp", e.g. {"epsilon": 1, "mechanism": "laplace", "percentile": 90}.
+
+    Every round the epsilon given by the sketch alone is estimated from the delta
+    (bounded by its percentile of |delta|); when it is above the target, noise
+    calibrated to the target epsilon is added to every cell of the sketch. The epsilon
+    of the round and the total over the rounds (sequential composition) are logged as
+    T_DP_EPSILON <round epsilon> <total epsilon> <seconds> in the spn log.
+    """
+
+    def __init__(self, epsilon=1, mechanism="laplace", percentile=90, delta=1e-5, seed=None,
+                 client_id=0):
+        if mechanism not in DP_MECHANISMS:
+            raise ValueError(f"Error: DP mechanism {mechanism} not available ({list(DP_MECHANISMS)})")
+        self.epsilon = epsilon
+        self.mechanism = mechanism
+        self.percentile = percentile
+        self.delta = delta
+        # seeded runs are reproducible, but every client draws different noise
+        self.rng = np.random.default_rng(None if seed is None else [seed, client_id])
+        self.spent_epsilon = 0.0
+
+    def apply(self, delta, sketch):
+        # adds the noise to sketch (in place) and returns the epsilon of the round
+        t0 = time.time()
+        vector = flat_weights(delta)
+        alpha = float(np.percentile(np.abs(vector), self.percentile))
+        t, k = sketch.shape
+        epsilon = estimate_epsilon(vector, t, k, alpha)
+        if epsilon > self.epsilon:
+            scale = dp_noise_scale(alpha, t, self.epsilon, self.mechanism, self.delta)
+            add_dp_noise(sketch, scale, self.mechanism, self.rng)
+            epsilon = self.epsilon
+        self.spent_epsilon += epsilon
+        spnfl_logger.info(f'T_DP_EPSILON {epsilon} {self.spent_epsilon} {time.time() - t0}')
+        return epsilon
@@ -1,15 +1,13 @@
 import os
+import tempfile
 import numpy as np
 import pandas as pd
 import torch
 import mmh3
 import random
 import statistics
-import itertools
 import hashlib
 
-from scipy.stats import norm,scoreatpercentile
-
 
 def set_params(model, data, learning_rate):
   for name, param in model.named_parameters():
@@ -33,6 +31,49 @@ def delta_weights(new_weights,old_weights):
   delta = { k: v - old_weights[k] for k, v in new_weights.items() if k in old_weights }
   return delta
 
+class FlatParams:
+  """
+  Trainable parameters of a model (same order as get_params) seen as one contiguous
+  float32 vector. The snapshot and the delta live in buffers allocated once, so a round
+  does not clone the parameters into dicts, and numpy() views of the buffers are handed
+  to the sketch functions without copies or per-element Python objects.
+  """
+  def __init__(self, model):
+    self.model = model
+    sizes = [p.numel() for p in self.params()]
+    self.offsets = np.concatenate(([0], np.cumsum(sizes))).astype(np.int64)
+    self.vector_length = int(self.offsets[-1])
+    self.snapshot_buffer = torch.empty(self.vector_length, dtype=torch.float32)
+    self.delta_buffer = torch.empty(self.vector_length, dtype=torch.float32)
+
+  def params(self):
+    # looked up at every call: set_params_fedsketch may replace the tensors of the model
+    return [p for _, p in self.model.named_parameters() if p.requires_grad]
+
+  def copy_to(self, out):
+    with torch.no_grad():
+      for p, a, b in zip(self.params(), self.offsets[:-1], self.offsets[1:]):
+        out[a:b].copy_(p.detach().reshape(-1))
+    return out
+
+  def snapshot(self):
+    # parameters before training, base of the delta and of the updates
+    return self.copy_to(self.snapshot_buffer)
+
+  def delta(self):
+    # current - snapshot computed in place; the numpy view is overwritten by the next call
+    self.copy_to(self.delta_buffer)
+    self.delta_buffer.sub_(self.snapshot_buffer)
+    return self.delta_buffer.numpy()
+
+  def apply_delta(self, delta, learning_rate=1):
+    # parameters = snapshot + learning_rate * delta (flat vector), written in place
+    delta = torch.as_tensor(delta, dtype=torch.float32)
+    with torch.no_grad():
+      for p, a, b in zip(self.params(), self.offsets[:-1], self.offsets[1:]):
+        p.copy_(self.snapshot_buffer[a:b].reshape(p.shape))
+        p.add_(delta[a:b].reshape(p.shape).to(p.device), alpha=learning_rate)
+
 def get_random_hashfunc(_max=1024, seed=None):
     seed = seed or os.urandom(10)
     seed_hash_func = hashlib.md5(seed)
@@ -40,31 +81,93 @@ def get_random_hashfunc(_max=1024, seed=None):
         func = seed_hash_func.copy()
         func.update(n.to_bytes(n.bit_length(), 'big'))
         return int.from_bytes(func.digest(), 'big') % _max
+    # seed/max identify the function, so its table of buckets can be cached (sketch_tables)
+    hashfunc.seed = seed
+    hashfunc.max = _max
     return hashfunc
 
+# Count Sketch tables: bucket (int32) and sign (int8) of every parameter index in every
+# row, computed once per model layout instead of hashing every element at every round.
+# They are kept in memory and saved in SKETCH_TABLES_DIR, so other clients/runs with the
+# same (vector_length, width, length, seeds) only load them.
+SKETCH_TABLES_DIR = "temp/sketch_tables"
+_sketch_tables = {}
+
+def sketch_tables(vector_length,width,length,index_hash_functions):
+    seeds = [getattr(h, "seed", None) for h in index_hash_functions[:length]]
+    if any(seed is None for seed in seeds):
+      # hash functions created elsewhere: the table is only cached in memory
+      key = (vector_length, width, length, tuple(id(h) for h in index_hash_functions[:length]))
+      path = None
+    else:
+      digest = hashlib.md5(repr((seeds, [h.max for h in index_hash_functions[:length]])).encode()).hexdigest()
+      key = (vector_length, width, length, digest)
+      path = os.path.join(SKETCH_TABLES_DIR, f"{vector_length}_{width}_{length}_{digest}.npz")
+
+    tables = _sketch_tables.get(key)
+    if tables is not None:
+      return tables
+    if path is not None and os.path.exists(path):
+      with np.load(path) as data:
+        tables = (data["buckets"], data["signs"])
+    else:
+      buckets = np.empty((length, vector_length), dtype=np.int32)
+      signs = np.empty((length, vector_length), dtype=np.int8)
+      for j in range(length):
+        buckets[j] = np.fromiter(map(index_hash_functions[j], range(vector_length)),
+                                 dtype=np.int32, count=vector_length)
+        signs[j] = np.fromiter((mmh3.hash(str(i),j) % 2 for i in range(vector_length)),
+                               dtype=np.int8, count=vector_length) * 2 - 1
+      if buckets.size and buckets.max() >= width:
+        raise Exception(f"Error: hash functions return buckets larger than the sketch width {width}")
+      tables = (buckets, signs)
+      if path is not None:
+        # written to a temporary file first: several clients may build the same table
+        os.makedirs(SKETCH_TABLES_DIR, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=SKETCH_TABLES_DIR, suffix=".npz")
+        try:
+          with os.fdopen(fd, "wb") as f:
+            np.savez(f, buckets=buckets, signs=signs)
+          os.chmod(tmp_path, 0o644)  # mkstemp creates it readable only by its owner
+          os.replace(tmp_path, path)
+        except BaseException:
+          os.unlink(tmp_path)
+          raise
+    _sketch_tables[key] = tables
+    return tables
+
 #@profile
 def CountSketchFunction_pytorch(vector,sketch,length,width,index_hash_functions,weight_index=None):
+    # bincount adds the values of each bucket in index order, the same as the
+    # element by element loop, so the sketch is identical to the previous one
+    # (sign * value is exact in float32, bincount sums in float64)
+    vector = np.asarray(vector)
+    buckets, signs = sketch_tables(len(vector), width, length, index_hash_functions)
     for j in range(length):
-      for i in range(len(vector)):
-          sign_hash = mmh3.hash(str(i),j) % 2
-          sign_value = sign_hash * 2 - 1
-          sketch[j,index_hash_functions[j](i)] += sign_value*vector[i]
+      sketch[j] += np.bincount(buckets[j], weights=signs[j]*vector, minlength=width)
 
-def QuerySketchFunction_pytorch(start_index,end_index,sketch,length,width,index_hash_functions):
-    new_weights = []
-    for i in range(start_index,end_index):
-        m = []
-        for j in range(length):
-              sign_hash = mmh3.hash(str(i),j) % 2
-              sign_value = sign_hash * 2 - 1
-              m.append(sign_value*sketch[j][index_hash_functions[j](i)])
-        new_weights.append(statistics.median(m))
+# number of parameters decompressed at a time: bounds the (length x chunk) gather
+SKETCH_QUERY_CHUNK = 1 << 16
+
+def QuerySketchFunction_pytorch(start_index,end_index,sketch,length,width,index_hash_functions,vector_length=None):
+    # median over the rows of sign * sketch[row, bucket], gathered for a chunk of indices at a time
+    sketch = np.asarray(sketch)
+    vector_length = end_index if vector_length is None else vector_length
+    buckets, signs = sketch_tables(vector_length, width, length, index_hash_functions)
+    rows = np.arange(length)[:, None]
+    new_weights = np.empty(end_index - start_index, dtype=sketch.dtype)
+    for a in range(start_index, end_index, SKETCH_QUERY_CHUNK):
+      b = min(a + SKETCH_QUERY_CHUNK, end_index)
+      m = signs[:length, a:b] * sketch[rows, buckets[:length, a:b]]
+      new_weights[a - start_index:b - start_index] = np.median(m, axis=0)
     return new_weights
 
 def add_weigths_to_sketch_pytorch(weights,compression=0.7, length = 7,index_hash_functions = None):
-  convert = [torch.flatten(v) for k,v in weights.items()]
-  convert = list(itertools.chain.from_iterable(convert))
-  convert = [v.item() for v in convert]
+  if isinstance(weights, dict):
+    convert = torch.cat([torch.flatten(v).detach().cpu() for k,v in weights.items()]).numpy()
+  else:
+    # flat vector (e.g. FlatParams.delta()), sketched without copies
+    convert = np.asarray(weights)
   #biggest_number_elements = np.max([value.numel() for key, value in new_weights.items()])
   width = int(len(convert)*compression)
   sketch = np.zeros((length,width))
@@ -78,25 +181,49 @@ def query_weigths_sketch_pytorch(weights,length,sketch,index_hash_functions):
   n_weights = {}
   start_index = 0
   end_index = 0
+  sketch = np.asarray(sketch)
+  vector_length = sum(convert)
   for i in range(len(convert)):
     end_index+=convert[i]
-    query = QuerySketchFunction_pytorch(start_index,end_index,sketch,length,len(sketch[0]),index_hash_functions)
-    query = torch.tensor(query)
+    query = QuerySketchFunction_pytorch(start_index,end_index,sketch,length,len(sketch[0]),index_hash_functions,vector_length)
+    query = torch.from_numpy(query)
     query = query.reshape(sizes[i])
     n_weights[keys[i]] = query
     start_index += convert[i]
   return n_weights
 
-def epsilon_estimation_pytorch(weights,sketch,percentile):
-  convert = [torch.flatten(v) for k,v in weights.items()]
-  convert = list(itertools.chain.from_iterable(convert))
-  convert = [v.item() for v in convert]
-  mu, std = norm.fit(convert)
-  alpha = np.percentile(np.abs(convert), 90)
-  
-  n = len(convert)
-  t = sketch.shape[0]
-  k = sketch.shape[1]
+def sparse_to_vector(sparse):
+  # dense flat delta from a sparse top-k delta {"indices", "values", "vector_length"}
+  values = np.asarray(sparse["values"])
+  vector = np.zeros(sparse["vector_length"], dtype=values.dtype)
+  vector[np.asarray(sparse["indices"], dtype=np.int64)] = values
+  return vector
+
+def sparse_to_weights(weights,sparse):
+  # dense delta shaped like weights from a sparse top-k delta
+  vector = sparse_to_vector(sparse)
+  n_weights = {}
+  start_index = 0
+  for k,v in weights.items():
+    n_weights[k] = torch.from_numpy(vector[start_index:start_index+v.numel()]).reshape(v.size())
+    start_index += v.numel()
+  return n_weights
+
+# Differential privacy of the sketches. The statistics are computed on a flat float32
+# vector and the noise is drawn for every cell of the sketch in a single call.
+DP_MECHANISMS = ("laplace", "gaussian")
+
+def flat_weights(weights):
+  # flat float32 vector of a dict of tensors (get_params) or of a flat vector (FlatParams.delta())
+  if isinstance(weights, dict):
+    return torch.cat([torch.flatten(v).detach().cpu() for v in weights.values()]).numpy().astype(np.float32, copy=False)
+  return np.asarray(weights, dtype=np.float32)
+
+def estimate_epsilon(vector, t, k, alpha, min_beta=0.0000000001):
+  # epsilon given by a (t x k) sketch of vector whose values are bounded by alpha
+  # (std is the maximum likelihood std, as norm.fit)
+  std = vector.std(dtype=np.float64)
+  n = len(vector)
   if alpha == 0:
     alpha = 1
   if (n-k) == 0:
@@ -108,45 +235,65 @@ def epsilon_estimation_pytorch(weights,sketch,percentile):
   left_side = (numerator/denominator)*multiplyer
   beta = -1/(left_side - 0.5)
   if beta < 0:
-    beta = 0.0000000001
+    beta = min_beta
   episolon = t*np.log(1+(beta*left_side))
   return episolon
 
+def epsilon_estimation_pytorch(weights,sketch,percentile):
+  convert = flat_weights(weights)
+  alpha = np.percentile(np.abs(convert), 90)
+  return estimate_epsilon(convert, sketch.shape[0], sketch.shape[1], alpha)
+
+def dp_noise_scale(alpha, t, epsilon, mechanism="laplace", delta=1e-5):
+  # a coordinate bounded by alpha changes one cell in each of the t rows: the L1
+  # sensitivity of the sketch is t*alpha and the L2 sensitivity sqrt(t)*alpha
+  if mechanism == "laplace":
+    return t*alpha/epsilon
+  if mechanism == "gaussian":
+    return np.sqrt(t)*alpha*np.sqrt(2*np.log(1.25/delta))/epsilon
+  raise ValueError(f"Error: DP mechanism {mechanism} not available ({list(DP_MECHANISMS)})")
 
-def differential_garantee_pytorch(weights,sketch,desired_episilon,percentile):
-  episilon = epsilon_estimation_pytorch(weights,sketch,percentile)
+def add_dp_noise(sketch, scale, mechanism="laplace", rng=None):
+  # independent noise in every cell of the sketch, in place
+  rng = rng if rng is not None else np.random.default_rng()
+  if mechanism == "laplace":
+    sketch += rng.laplace(0.0, scale, size=sketch.shape)
+  elif mechanism == "gaussian":
+    sketch += rng.normal(0.0, scale, size=sketch.shape)
+  else:
+    raise ValueError(f"Error: DP mechanism {mechanism} not available ({list(DP_MECHANISMS)})")
+  return sketch
 
-  print("Episilion " + str(episilon))
-  if episilon > desired_episilon:
-    noise = np.random.laplace(0, 1.0/episilon, 1)
-    sketch += noise
+def differential_garantee_pytorch(weights,sketch,desired_epsilon,percentile,mechanism="laplace",rng=None):
+  # adds noise calibrated to desired_epsilon when the sketch alone does not reach it;
+  # returns the epsilon of the sketch that is sent
+  convert = flat_weights(weights)
+  alpha = np.percentile(np.abs(convert), 90)
+  epsilon = estimate_epsilon(convert, sketch.shape[0], sketch.shape[1], alpha)
+  if epsilon > desired_epsilon:
+    add_dp_noise(sketch, dp_noise_scale(alpha, sketch.shape[0], desired_epsilon, mechanism), mechanism, rng)
+    return desired_epsilon
+  return epsilon
 
 def compare_and_zero_pytorch(x,y):
-  comparison = []
-  for i in range(len(x)):
-    comparison.append((torch.abs(x[i])-torch.abs(y[i]),i))
-  comparison = sorted(
-    comparison,
-    key=lambda x: x[0]
-  )
-  new_x = torch.zeros(len(x))
-  for i in range(len(comparison)):
-    if i <= int(len(comparison)*0.5):
-      new_x[comparison[i][1]] = x[comparison[i][1]]
-    else:
-      new_x[comparison[i][1]] = 0
+  # keeps the int(len(x)*0.5)+1 coordinates with the smallest |x| - |y| along the last
+  # dimension (stable order, as the sorted list of (diff, i) did) and zeroes the others
+  x = x.detach()
+  keep = torch.argsort(torch.abs(x) - torch.abs(y.detach()), dim=-1, stable=True)
+  keep = keep[..., :int(x.shape[-1]*0.5)+1]
+  new_x = torch.zeros(x.shape, dtype=torch.float32)
+  new_x.scatter_(-1, keep, torch.gather(x, -1, keep).float())
   return new_x
 
 def compare_and_zero_weight_list(new_weights,old_weights):
+  # matrices row by row (all rows at once), vectors as a whole
   for key, value in new_weights.items():
       shape = value.size()
-      if len(shape) > 1 and shape[0] > 1:
-            for i in range(len(value)):
-              new_weights[key][i] = torch.Tensor(compare_and_zero_pytorch(new_weights[key][i],old_weights[key][i]))
-      elif len(shape) > 1 and shape[0] == 1:
-        new_weights[key][0] = torch.Tensor(compare_and_zero_pytorch(new_weights[key][0],old_weights[key][0]))
+      if len(shape) > 1:
+        rows = compare_and_zero_pytorch(value.reshape(shape[0], -1), old_weights[key].reshape(shape[0], -1))
+        new_weights[key] = rows.reshape(shape)
       elif len(shape) == 1:
-        new_weights[key] = torch.Tensor(compare_and_zero_pytorch(new_weights[key],old_weights[key]))
+        new_weights[key] = compare_and_zero_pytorch(new_weights[key],old_weights[key])
       else:
         new_weights[key] = torch.Tensor(new_weights[key])
 
@@ -160,37 +307,24 @@ def decompress(n_weights,sketch, length, min, max,index_hash_functions):
   n_weights = query_weigths_sketch_pytorch(n_weights,length,sketch,index_hash_functions)
   return n_weights
 
+def decompress_vector(sketch, length, vector_length, index_hash_functions):
+  # flat delta decoded from the sketch (see FlatParams.apply_delta)
+  sketch = np.asarray(sketch)
+  return QuerySketchFunction_pytorch(0,vector_length,sketch,length,len(sketch[0]),index_hash_functions)
+
 def epsilon_estimation(weights, sketch,percentile):
-  convert = [torch.flatten(v) for k,v in weights.items()]
-  convert = list(itertools.chain.from_iterable(convert))
-  convert = [v.item() for v in convert]
-  mu, std = norm.fit(convert)
+  convert = flat_weights(weights)
   alpha = np.percentile(convert, percentile)
-  n = len(convert)
-  t = sketch.shape[0]
-  k = sketch.shape[1]
-  if alpha == 0:
-    alpha = 1
-  if (n-k) == 0:
-    n = 1
-    k = 0.1
-  numerator = (alpha**2)*k*(k-1)
-  denominator = (std**2)*(n-2)
-  multiplyer = 1+np.log(n-k)
-  left_side = (numerator/denominator)*multiplyer
-  beta = -1/(left_side - 0.5)
-  if beta < 0:
-    beta = 0.0000001
-  episolon = t*np.log(1+(beta*left_side))
-  return episolon
-
-def differential_garantee(weights,sketch,desired_episilon,percentile):
-  episilon = epsilon_estimation(weights,sketch,percentile)
+  return estimate_epsilon(convert, sketch.shape[0], sketch.shape[1], alpha, 0.0000001)
 
-  print("Episilion " + str(episilon))
-  if episilon > desired_episilon:
-    noise = np.random.laplace(0, 1.0/episilon, 1)
-    sketch += noise
+def differential_garantee(weights,sketch,desired_epsilon,percentile,mechanism="laplace",rng=None):
+  convert = flat_weights(weights)
+  alpha = np.abs(np.percentile(convert, percentile))
+  epsilon = estimate_epsilon(convert, sketch.shape[0], sketch.shape[1], alpha, 0.0000001)
+  if epsilon > desired_epsilon:
+    add_dp_noise(sketch, dp_noise_scale(alpha, sketch.shape[0], desired_epsilon, mechanism), mechanism, rng)
+    return desired_epsilon
+  return epsilon
 
 def CountSketchFunction(vector,sketch,length,width,weight_index=None):
     random.seed(0)
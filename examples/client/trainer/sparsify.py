@@ -0,0 +1,144 @@
+import numpy as np
+
+
+# Update sparsification: only k coordinates of the flattened model are sent, as
+#   {"sparse": scheme, "indices": int32, "values": float32, "shapes": [...], "delta": bool}
+# "delta": True means the values are added to the base model of the receiver, False that
+# they replace its coordinates. The same message is used by the clients (uploads) and
+# by the server; the copies of this file in client/trainer/ and server/aggregator/ must be kept in sync.
+#
+# Schemes (coordinates selected with np.argpartition, without sorting the whole model):
+#   topk         largest |value|
+#   topk_change  largest |value - reference| (e.g. the weights of the previous round)
+#   randk        k coordinates drawn at random
+#   threshold    every coordinate with |value| >= threshold
+SCHEMES = ("topk", "topk_change", "randk", "threshold")
+
+
+def _as_array(layer):
+    if hasattr(layer, "detach") and hasattr(layer, "numpy"):
+        # torch.Tensor
+        layer = layer.detach().cpu().numpy()
+    return np.asarray(layer, dtype=np.float32)
+
+
+def flatten(layers):
+    # one float32 vector with every layer, in order
+    return np.concatenate([np.ravel(_as_array(layer)) for layer in layers])
+
+
+def layer_shapes(layers):
+    return [list(np.shape(layer)) for layer in layers]
+
+
+def same_shapes(layers, base):
+    return (isinstance(layers, (list, tuple)) and isinstance(base, (list, tuple))
+            and layer_shapes(layers) == layer_shapes(base))
+
+
+def num_kept(n, ratio):
+    return min(n, max(1, int(ratio * n)))
+
+
+def top_k(scores, k):
+    # indices of the k largest scores, sorted by index
+    if k >= len(scores):
+        return np.arange(len(scores))
+    return np.sort(np.argpartition(scores, -k)[-k:])
+
+
+def select(vector, scheme="topk", ratio=0.01, threshold=None, reference=None, rng=None):
+    """
+    Indices (sorted) of the coordinates of vector kept by the scheme.
+    """
+    n = len(vector)
+    if scheme == "topk":
+        return top_k(np.abs(vector), num_kept(n, ratio))
+    if scheme == "topk_change":
+        if reference is None:
+            raise ValueError("Error: topk_change needs the reference vector")
+        return top_k(np.abs(vector - reference), num_kept(n, ratio))
+    if scheme == "randk":
+        rng = rng if rng is not None else np.random.default_rng()
+        return np.sort(rng.choice(n, num_kept(n, ratio), replace=False))
+    if scheme == "threshold":
+        if threshold is None:
+            raise ValueError("Error: the threshold scheme needs a threshold")
+        return np.flatnonzero(np.abs(vector) >= threshold)
+    raise ValueError(f"Error: sparsification scheme {scheme} not available ({list(SCHEMES)})")
+
+
+def index_dtype(n):
+    return np.int32 if n < 2 ** 31 else np.int64
+
+
+def sparsify(layers, scheme="topk", ratio=0.01, threshold=None, reference=None, rng=None,
+             delta=False):
+    # sparse message with the selected coordinates of layers
+    vector = flatten(layers)
+    if reference is not None:
+        reference = flatten(reference)
+    indices = select(vector, scheme, ratio, threshold, reference, rng)
+    return {"sparse": scheme, "indices": indices.astype(index_dtype(len(vector))),
+            "values": vector[indices], "shapes": layer_shapes(layers), "delta": delta}
+
+
+def is_sparse(weights):
+    return isinstance(weights, dict) and "sparse" in weights
+
+
+def densify(message, base=None):
+    """
+    Dense float32 layers of a sparse message. The coordinates that were not sent are
+    taken from base (zeros without base); delta messages are added to base.
+    """
+    shapes = [tuple(s) for s in message["shapes"]]
+    sizes = [int(np.prod(s)) for s in shapes]
+    if base is None:
+        vector = np.zeros(sum(sizes), dtype=np.float32)
+    else:
+        vector = flatten(base)  # new array, base is not modified
+        if len(vector) != sum(sizes):
+            raise ValueError("Error: the sparse message does not match the shape of the base model")
+    indices = np.asarray(message["indices"], dtype=np.int64)
+    values = np.asarray(message["values"], dtype=np.float32)
+    if message.get("delta"):
+        vector[indices] += values
+    else:
+        vector[indices] = values
+    offsets = np.cumsum([0] + sizes)
+    return [vector[a:b].reshape(shape) for shape, a, b in zip(shapes, offsets[:-1], offsets[1:])]
+
+
+class Sparsifier:
+    """
+    Sparsifies the updates of a client: the delta between the trained weights and the
+    base model (the last global model received) is sparsified and sent with delta=True.
+    With error_feedback the coordinates that were not sent are kept and added to the
+    delta of the next round, so small updates are delayed instead of lost.
+    """
+
+    def __init__(self, scheme="topk", ratio=0.01, threshold=None, error_feedback=True, seed=None):
+        if scheme not in SCHEMES:
+            raise ValueError(f"Error: sparsification scheme {scheme} not available ({list(SCHEMES)})")
+        self.scheme = scheme
+        self.ratio = ratio
+        self.threshold = threshold
+        self.error_feedback = error_feedback
+        self.rng = np.random.default_rng(seed)
+        self.residual = None
+
+    def compress(self, layers, base):
+        vector = flatten(layers)
+        vector -= flatten(base)
+        if self.residual is not None and len(self.residual) == len(vector):
+            vector += self.residual
+        # on a delta, the largest change and the largest value are the same coordinates
+        scheme = "topk" if self.scheme == "topk_change" else self.scheme
+        indices = select(vector, scheme, self.ratio, self.threshold, rng=self.rng)
+        message = {"sparse": self.scheme, "indices": indices.astype(index_dtype(len(vector))),
+                   "values": vector[indices], "shapes": layer_shapes(layers), "delta": True}
+        if self.error_feedback:
+            vector[indices] = 0
+            self.residual = vector
+        return message
@@ -0,0 +1,87 @@
+"""
+tf.data input pipelines and thread budget of the Keras trainers.
+
+The pipelines are built once when the trainer is created and reused in every
+round: the arrays are converted to float32 (labels to int32 when they are class
+indices) only once, the training set is reshuffled at each epoch and the next
+batches are prefetched while the model trains on the current one.
+
+The number of threads used by TensorFlow follows the CPU share of the container
+(cpu_quota / cpu_period of the station, see federated/node.py) instead of the
+number of CPUs of the host, so trainers that share a host do not oversubscribe it.
+"""
+import math
+import os
+
+import numpy as np
+import tensorflow as tf
+
+BATCH_SIZE = 64
+
+_num_threads = None
+
+
+def cpu_budget():
+    # CPUs available to the container: cgroup v2 (cpu.max) or v1 (cfs quota/period)
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            quota, period = f.read().split()[:2]
+        if quota != 'max':
+            return max(1, math.ceil(int(quota) / int(period)))
+    except (OSError, ValueError):
+        pass
+    try:
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as f:
+            quota = int(f.read())
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as f:
+            period = int(f.read())
+        if quota > 0 and period > 0:
+            return max(1, math.ceil(quota / period))
+    except (OSError, ValueError):
+        pass
+    return os.cpu_count() or 1
+
+
+def configure_threads(num_threads=None):
+    """
+    Sets the thread pools of TensorFlow to num_threads (default: cpu_budget()).
+    Must be called before the first TensorFlow operation of the process (e.g. before
+    the model is defined); afterwards TensorFlow keeps its pools and the call only
+    returns the budget used by the input pipelines.
+    """
+    global _num_threads
+    if _num_threads is not None:
+        return _num_threads
+    _num_threads = int(num_threads) if num_threads else cpu_budget()
+    try:
+        tf.config.threading.set_intra_op_parallelism_threads(_num_threads)
+        tf.config.threading.set_inter_op_parallelism_threads(min(2, _num_threads))
+    except RuntimeError:
+        print(f"TensorFlow already initialized, thread budget of {_num_threads} only used by tf.data")
+    return _num_threads
+
+
+def _as_labels(y):
+    # class indices as int32 (sparse labels), one-hot labels as float32
+    y = np.asarray(y)
+    if np.issubdtype(y.dtype, np.integer):
+        return y.astype(np.int32, copy=False)
+    return y.astype(np.float32, copy=False)
+
+
+def make_dataset(x, y, batch_size=BATCH_SIZE, shuffle=False, seed=None):
+    """
+    Batched and prefetched dataset of (x, y). from_tensor_slices keeps a float32 copy
+    of the arrays in memory, so the dataset needs no cache() and the memory-mapped
+    cache of the host (dataset_cache.py) is read only once.
+    """
+    x = np.asarray(x, dtype=np.float32)
+    dataset = tf.data.Dataset.from_tensor_slices((x, _as_labels(y)))
+    if shuffle:
+        # same as fit(shuffle=True) on arrays: a new order at every epoch
+        dataset = dataset.shuffle(len(x), seed=seed, reshuffle_each_iteration=True)
+    dataset = dataset.batch(batch_size).prefetch(tf.data.AUTOTUNE)
+
+    options = tf.data.Options()
+    options.threading.private_threadpool_size = configure_threads()
+    return dataset.with_options(options)
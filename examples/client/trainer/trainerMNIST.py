@@ -5,6 +5,8 @@ import tensorflow as tf
 from tensorflow.keras.layers import Conv2D, MaxPool2D, Flatten, Dense
 from tensorflow.keras.optimizers import SGD
 from tensorflow.keras.models import Sequential
+from .trainer_utils import EvaluationCache
+from .tf_pipeline import configure_threads, make_dataset
 
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 
@@ -14,9 +16,14 @@ class TrainerMINIST:
         # id and model
         self.num_id = num_id
         self.mode = mode
+        configure_threads()  # before the first TensorFlow operation
         self.model = self.define_model()
         self.num_samples = int(np.random.choice(np.arange(10000, 20000, 1000)))
         self.x_train, self.y_train, self.x_test, self.y_test = self.split_data()
+        # input pipelines built once and reused in every round
+        self.train_dataset = make_dataset(self.x_train, self.y_train, shuffle=True)
+        self.test_dataset = make_dataset(self.x_test, self.y_test)
+        self.evaluation = EvaluationCache()  # evaluate() of the current model version
         self.stop_flag = False
         self.args = None
 
@@ -37,7 +44,7 @@ class TrainerMINIST:
         model.add(Dense(n_classes, activation='softmax'))
         opt = SGD(learning_rate=0.01, momentum=0.9)
         model.compile(
-            optimizer=opt, loss='categorical_crossentropy', metrics=['accuracy'])
+            optimizer=opt, loss='sparse_categorical_crossentropy', metrics=['accuracy'])
 
         return model
 
@@ -50,26 +57,31 @@ class TrainerMINIST:
         idx_train = np.random.choice(
             np.arange(len(x_train)), self.num_samples, replace=False)
         x_train = x_train[idx_train]
-        y_train = tf.one_hot(y_train[idx_train].astype(np.int32), depth=10)
+        y_train = y_train[idx_train].astype(np.int32)
 
         idx_test = np.random.choice(
             np.arange(len(x_test)), 3000, replace=False)
         x_test = x_test[idx_test]
-        y_test = tf.one_hot(y_test[idx_test].astype(np.int32), depth=10)
+        y_test = y_test[idx_test].astype(np.int32)
 
         return x_train, y_train, x_test, y_test
 
     def train_model(self):
-        self.model.fit(x=self.x_train, y=self.y_train,
-                       batch_size=64, epochs=10, verbose=3)
+        self.model.fit(self.train_dataset, epochs=10, verbose=3)
+        self.evaluation.invalidate()
+
+    def evaluate(self):
+        # loss and metrics of the current model, computed once per model version
+        return self.evaluation.get(lambda: self.model.evaluate(
+            self.test_dataset, verbose=False))
 
     def eval_model(self):
-        acc = self.model.evaluate(x=self.x_test, y=self.y_test, verbose=False)[1]
+        acc = self.evaluate()[1]
         return acc
     
     def all_metrics(self):
         metrics_names = self.model.metrics_names
-        values = self.model.evaluate(x=self.x_test, y=self.y_test, verbose=False)
+        values = self.evaluate()
         return dict(zip(metrics_names, values))
 
     def get_weights(self):
@@ -77,6 +89,7 @@ class TrainerMINIST:
 
     def update_weights(self, weights):
         self.model.set_weights(weights)
+        self.evaluation.invalidate()
 
     def set_stop_true(self):
         self.stop_flag = True
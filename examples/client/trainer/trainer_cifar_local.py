@@ -2,11 +2,12 @@ import os
 import numpy as np
 import pandas as pd
 import tensorflow as tf
-import pickle
 
 from tensorflow.keras.optimizers import SGD
 from tensorflow.keras import layers, models
-from .trainer_utils import read_energy
+from .trainer_utils import read_energy, EvaluationCache
+from .tf_pipeline import configure_threads, make_dataset
+from .dataset_cache import load_dataset
 
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 DATASET_PATH = 'flw/data/cifar-10-batches-py'
@@ -16,9 +17,14 @@ class TrainerCifar:
     def __init__(self, id, mode) -> None:
         self.id = id
         self.mode = mode  # 'class' 'random' 'all'
+        configure_threads()  # before the first TensorFlow operation
         self.model = self.define_model()
         self.num_samples = int(np.random.choice(np.arange(10000, 20000, 1000)))
         self.x_train, self.y_train, self.x_test, self.y_test = self.split_data()
+        # input pipelines built once and reused in every round
+        self.train_dataset = make_dataset(self.x_train, self.y_train, shuffle=True)
+        self.test_dataset = make_dataset(self.x_test, self.y_test)
+        self.evaluation = EvaluationCache()  # evaluate() of the current model version
         self.stop_flag = False
         self.args = None
 
@@ -50,7 +56,7 @@ class TrainerCifar:
 
         # Compilar o modelo com o otimizador ajustado
         model.compile(optimizer=optimizer,
-                      loss='categorical_crossentropy',
+                      loss='sparse_categorical_crossentropy',
                       metrics=['accuracy'])
 
         return model
@@ -63,52 +69,17 @@ class TrainerCifar:
             raise FileNotFoundError(
                 f"O diretório {cifar10_dir} não foi encontrado.")
 
-        def load_batch(file):
-            with open(file, 'rb') as f:
-                batch = pickle.load(f, encoding='bytes')
-                data = batch[b'data']
-                labels = batch[b'labels']
-                data = data.reshape(len(data), 3, 32, 32).transpose(0, 2, 3, 1)
-                return data, labels
-
-        # Carrega os dados de treinamento
-        train_data = []
-        train_labels = []
-        for i in range(1, 6):
-            file = os.path.join(cifar10_dir, f"data_batch_{i}")
-            data, labels = load_batch(file)
-            train_data.append(data)
-            train_labels.extend(labels)
-
-        train_data = np.concatenate(train_data)
-        train_labels = np.array(train_labels)
-
-        # Carrega os dados de teste
-        test_file = os.path.join(cifar10_dir, "test_batch")
-        test_data, test_labels = load_batch(test_file)
-
-        test_labels = np.array(test_labels)
-
-        return (train_data, train_labels), (test_data, test_labels)
+        # read-only memory-mapped arrays shared by all trainers of the host, already
+        # converted to float32 in [0, 1] (see dataset_cache.py)
+        return load_dataset('cifar', cifar10_dir)
 
     def split_data(self):
         (train_images, train_labels), (test_images,
                                        test_labels) = self.load_data()
 
-        # Converting the pixels data to float type
-        train_images = train_images.astype('float32')
-        test_images = test_images.astype('float32')
-
-        # Standardizing (255 is the total number of pixels an image can have)
-        train_images = train_images / 255.0
-        test_images = test_images / 255.0
-
-        # One hot encoding the target class (labels)
+        # Sparse labels (class indices): only the samples of this trainer are copied
+        # out of the shared cache and the labels are never one-hot encoded
         num_classes = 10
-        train_labels = tf.one_hot(np.squeeze(
-            train_labels), depth=num_classes).numpy()
-        test_labels = tf.one_hot(np.squeeze(
-            test_labels), depth=num_classes).numpy()
 
         if self.mode == 'random':
             # Calculate the proportion of test samples
@@ -128,10 +99,8 @@ class TrainerCifar:
             test_labels = test_labels[test_indices]
         elif self.mode == 'class':
             selected_label = self.id % num_classes
-            train_indices = np.where(
-                np.argmax(train_labels, axis=1) == selected_label)[0]
-            test_indices = np.where(
-                np.argmax(test_labels, axis=1) == selected_label)[0]
+            train_indices = np.where(train_labels == selected_label)[0]
+            test_indices = np.where(test_labels == selected_label)[0]
 
             train_images, train_labels = train_images[train_indices], train_labels[train_indices]
             test_images, test_labels = test_images[test_indices], test_labels[test_indices]
@@ -141,18 +110,21 @@ class TrainerCifar:
         return train_images, train_labels, test_images, test_labels
 
     def train_model(self):
-        self.model.fit(x=self.x_train, y=self.y_train,
-                       batch_size=64, epochs=10, verbose=3)
+        self.model.fit(self.train_dataset, epochs=10, verbose=3)
+        self.evaluation.invalidate()
+
+    def evaluate(self):
+        # loss and metrics of the current model, computed once per model version
+        return self.evaluation.get(lambda: self.model.evaluate(
+            self.test_dataset, verbose=False))
 
     def eval_model(self):
-        acc = self.model.evaluate(
-            x=self.x_test, y=self.y_test, verbose=False)[1]
+        acc = self.evaluate()[1]
         return acc
 
     def all_metrics(self):
         metrics_names = self.model.metrics_names
-        values = self.model.evaluate(
-            x=self.x_test, y=self.y_test, verbose=False)
+        values = self.evaluate()
 
         dic = dict(zip(metrics_names, values))
         dic['energy_consumption'] = read_energy()
@@ -163,6 +135,7 @@ class TrainerCifar:
 
     def update_weights(self, weights):
         self.model.set_weights(weights)
+        self.evaluation.invalidate()
 
     def set_stop_true(self):
         self.stop_flag = True
@@ -11,71 +11,44 @@ from Pyfhel import Pyfhel, PyCtxt
 from sklearn.model_selection import KFold
 from torch.utils.data import ConcatDataset
 from torchvision.datasets import MNIST
-from .sketch_utils import compress, decompress, get_params, set_params_fedsketch, delta_weights, get_random_hashfunc
+from .sketch_utils import compress, decompress_vector, FlatParams, get_random_hashfunc
+from .sketch_dp import SketchDP
+from .trainer_utils import EvaluationCache
 
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 
 
-def recuperar_matriz_binaria(nome_arquivo, HE):
+def ler_matriz_binaria(bytes_matriz, HE):
     """
-    Recupera a matriz binária de um arquivo especificado, incluindo as chaves de linha, coluna e valor e considerando tamanhos variáveis de valores.
+    Recupera a matriz binária serializada por matriz_para_bytes (servidor).
+    Os bytes são percorridos com um memoryview, sem cópias intermediárias; apenas
+    os bytes de cada PyCtxt são copiados ao criá-lo.
 
-    Argumento:
-      nome_arquivo: O nome do arquivo binário contendo a matriz.
+    Argumentos:
+      bytes_matriz: Os bytes da matriz (ou a string cp437 enviada pelo codec json).
+      HE: O contexto Pyfhel.
 
     Retorna:
       A matriz binária recuperada (dicionário de dicionários).
     """
+    if isinstance(bytes_matriz, str):
+        bytes_matriz = bytes_matriz.encode('cp437')
+    view = memoryview(bytes_matriz).cast('B')
     matriz = {}
-
-    with open(nome_arquivo, 'rb') as f:
-        i = 0
-
-        # Ler os bytes da matriz
-        bytes_matriz = f.read()
-
-        # Descodificar os bytes em elementos da matriz
-        offset = 0
-        while offset < len(bytes_matriz):
-            i += 1
-
-            # Ler o tamanho da chave linha1
-            tamanho_chave_linha1 = int.from_bytes(
-                bytes_matriz[offset:offset + 4], 'big')
-            offset += 4
-            # Ler os bytes da chave linha1
-            bytes_chave_linha1 = bytes_matriz[offset:offset +
-                                              tamanho_chave_linha1]
-            offset += tamanho_chave_linha1
-            # Decodificar a chave linha1 em string
-            linha1 = bytes_chave_linha1.decode('utf-8')
-
-            # Ler o tamanho da chave coluna1
-            tamanho_chave_coluna1 = int.from_bytes(
-                bytes_matriz[offset:offset + 4], 'big')
-            offset += 4
-            # Ler os bytes da chave coluna1
-            bytes_chave_coluna1 = bytes_matriz[offset:offset +
-                                               tamanho_chave_coluna1]
-            offset += tamanho_chave_coluna1
-            # Decodificar a chave coluna1 em string
-            coluna1 = bytes_chave_coluna1.decode('utf-8')
-
-            # Ler o tamanho do valor
-            tamanho_valor = int.from_bytes(
-                bytes_matriz[offset:offset + 4], 'big')
-            offset += 4
-
-            # Ler os bytes do valor
-            bytes_valor = bytes_matriz[offset:offset + tamanho_valor]
-            offset += tamanho_valor
-
-            # Converter os bytes em PyCtxt e adicionar à matriz
-            pyctxt_elemento = PyCtxt(pyfhel=HE, bytestring=bytes_valor)
-
-            # Inserir o elemento na matriz usando as duas chaves
-            matriz.setdefault(linha1, {})[coluna1] = pyctxt_elemento
-    f.close()
+    offset = 0
+
+    def ler_campo(offset):
+        tamanho = int.from_bytes(view[offset:offset + 4], 'big')
+        offset += 4
+        return view[offset:offset + tamanho], offset + tamanho
+
+    while offset < len(view):
+        linha1, offset = ler_campo(offset)
+        coluna1, offset = ler_campo(offset)
+        bytes_valor, offset = ler_campo(offset)
+        # Converter os bytes em PyCtxt e adicionar à matriz usando as duas chaves
+        matriz.setdefault(str(linha1, 'utf-8'), {})[str(coluna1, 'utf-8')] = PyCtxt(
+            pyfhel=HE, bytestring=bytes(bytes_valor))
     return matriz
 
 
@@ -162,18 +135,20 @@ class TrainerCkksfed():
         self.fedsketch = True  # Lembra de trocar no outro -------------------------
         if self.fedsketch:
 
-            self.old_weights = get_params(self.model)
-            self.weights = get_params(self.model)
+            # flat snapshot of the parameters before training and delta buffer
+            self.params = FlatParams(self.model)
+            self.params.snapshot()
             self.compression = 0.00066666666  # 75x
             self.length = 20
             self.desired_episilon = 1
             self.percentile = 90
-            self.vector_length = sum(
-                p.numel() for p in self.model.parameters() if p.requires_grad)
+            self.configure_dp()
+            self.vector_length = self.params.vector_length
             self.index_hash_function = [get_random_hashfunc(
                 _max=int(self.compression*self.vector_length), seed=repr(j).encode())
                 for j in range(self.length)]
 
+        self.evaluation = EvaluationCache()  # (accuracy, activations) of the current model version
         self.stop_flag = False
 
         self.HE_f = Pyfhel()  # Empty creation
@@ -185,7 +160,9 @@ class TrainerCkksfed():
         # self.HE_f.load_rotate_key(dir_path + "/rotate.key")
 
     def encrypt_array(self, array):
-        return [self.HE_f.encrypt(array[j:j+self.HE_f.get_nSlots()]) for j in range(0, self.l, self.HE_f.get_nSlots())]
+        # each ciphertext packs get_nSlots() consecutive values, up to self.l values
+        n_slots = self.HE_f.get_nSlots()
+        return [self.HE_f.encrypt(array[j:j+n_slots]) for j in range(0, min(self.l, len(array)), n_slots)]
 
     def encrypt_value(self, value):
         return self.HE_f.encrypt(value)
@@ -203,6 +180,16 @@ class TrainerCkksfed():
 
     def set_args(self, args):
         self.args.update(args)
+        if self.fedsketch:
+            self.configure_dp()
+
+    def configure_dp(self):
+        # client argument "dp" (see sketch_dp.py), e.g. {"epsilon": 1, "mechanism": "gaussian"}
+        dp = self.args.get('dp')
+        self.dp = None
+        if dp:
+            self.dp = SketchDP(**({"epsilon": self.desired_episilon, "percentile": self.percentile} | dp),
+                               client_id=self.id)
 
     def set_nc(self, clients):
         self.nc = clients
@@ -314,7 +301,7 @@ class TrainerCkksfed():
         optimizer = optim.SGD(model.parameters(), lr=self.learning_rate)
         total_step = len(train_loader)
         if self.fedsketch:
-            self.old_weights = get_params(self.model)
+            self.params.snapshot()
         # print(total_step)
         for epoch in range(num_epochs):
             for i, (images, labels) in enumerate(train_loader):
@@ -335,17 +322,24 @@ class TrainerCkksfed():
                     print('Epoch [{}/{}], Step [{}/{}], Loss: {:.4f}'
                           .format(epoch+1, num_epochs, i+1, total_step, loss.item()))
         if self.fedsketch:
-            self.weights = get_params(self.model)
-            delta = delta_weights(self.weights, self.old_weights)
+            # trained - snapshot, computed in place in the flat buffer of self.params
+            delta = self.params.delta()
             self.sketch = compress(delta, self.compression, self.length,
                                    self.desired_episilon, self.percentile, self.index_hash_function)
 
-            # differential_garantee_pytorch(delta,self.sketch,self.desired_episilon,self.percentile)
+            if self.dp is not None:
+                self.dp.apply(delta, self.sketch)
             self.sketch_list = [i.tolist() if type(
                 i) != list else i for i in self.sketch]
+        self.evaluation.invalidate()
         # return model, loss.item()
 
-    def eval_model(self):
+    def forward_test(self):
+        # accuracy and last layer activations on the test set: a single forward pass per
+        # model version serves eval_model, all_metrics and get_training_args
+        return self.evaluation.get(self._forward_test)
+
+    def _forward_test(self):
         model = self.model
         test_loader = self.dataloader_test
         actv_last = []
@@ -364,41 +358,30 @@ class TrainerCkksfed():
 
             print('Accuracy of the network on the 10000 test images: {} %'.format(
                 100 * correct / total))
-            return correct / total
+            return correct / total, np.array(torch.cat(actv_last, axis=0))
+
+    def eval_model(self):
+        return self.forward_test()[0]
 
     def get_training_args(self):
-        model = self.model
-        test_loader = self.dataloader_test
-        actv_last = []
-        with torch.no_grad():
-            correct = 0
-            total = 0
-            for images, labels in test_loader:
-                images = images.to(self.device)
-                labels = labels.to(self.device)
-                outputs = model(images)
-                actv_last.append(outputs.detach().clone().flatten())
-                _, predicted = torch.max(outputs.data, 1)
-                total += labels.size(0)
-                correct += (predicted == labels).sum().item()
+        # the cached activations are not modified
+        concat_actv = self.forward_test()[1]
+        concat_actv = concat_actv - np.mean(concat_actv)
 
-            concat_actv = np.array(torch.cat(actv_last, axis=0))
-            concat_actv -= np.mean(concat_actv)
-
-            if self.args['encrypted']:
-                XTX = self.encrypt_value(
-                    1/np.sqrt((concat_actv.T.dot(concat_actv)**2).sum()))
-                concat_actv_T = self.encrypt_array(concat_actv.T)
-                concat_actv = self.encrypt_array(concat_actv)
-                actv = [concat_actv, concat_actv_T,
-                        XTX, self.cluster, self.args['encrypted']]
-                return actv
-            else:
-                XTX = 1/np.sqrt((concat_actv.T.dot(concat_actv)**2).sum())
-                concat_actv_T = concat_actv.T
-                actv = [concat_actv, concat_actv_T,
-                        XTX, self.cluster, self.args['encrypted']]
-                return actv
+        # concat_actv is 1-D, so its transpose is the same vector: it is encrypted and
+        # sent only once (None in the position of the transpose, see Ckksfed)
+        if self.args['encrypted']:
+            XTX = self.encrypt_value(
+                1/np.sqrt((concat_actv.T.dot(concat_actv)**2).sum()))
+            concat_actv = self.encrypt_array(concat_actv)
+            actv = [concat_actv, None,
+                    XTX, self.cluster, self.args['encrypted']]
+            return actv
+        else:
+            XTX = 1/np.sqrt((concat_actv.T.dot(concat_actv)**2).sum())
+            actv = [concat_actv, None,
+                    XTX, self.cluster, self.args['encrypted']]
+            return actv
 
     def all_metrics(self):
         acc = self.eval_model()
@@ -416,24 +399,21 @@ class TrainerCkksfed():
     def update_weights(self, weights):
         if self.fedsketch:
             sketch_global = [np.asarray(i) for i in weights]
-            self.n_weights = decompress(self.weights, sketch_global, len(
-                sketch_global), -100000, 100000, self.index_hash_function)
-            for k, v in self.n_weights.items():
-
-                self.n_weights[k] = v + self.old_weights[k]
-
-            set_params_fedsketch(self.model, self.n_weights)
-            self.model = self.model.float()
+            delta = decompress_vector(sketch_global, len(sketch_global),
+                                      self.vector_length, self.index_hash_function)
+            # parameters = snapshot + delta, copied in place (float32)
+            self.params.apply_delta(delta)
         else:
             w = [torch.from_numpy(x) for x in weights]
             set_params_fedsketch(self.model, dict(zip(self.model_keys, w)))
+        self.evaluation.invalidate()
         # print("Pesos Atualizados",file=sys.stderr)
         # print(list(get_params(self.model).values()),file=sys.stderr)
 
     def agg_response_extra_info(self, agg_response):
         if self.args['encrypted']:
-            agg_response["distances"] = recuperar_matriz_binaria(
-                'data_temp/data.bin', self.HE_f)
+            agg_response["distances"] = ler_matriz_binaria(
+                agg_response["distances_bin"], self.HE_f)
         data_matrix = []
 
         name_dict = {}
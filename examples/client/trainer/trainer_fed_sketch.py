@@ -5,8 +5,10 @@ import sklearn
 import torch
 import torchvision
 
-from .sketch_utils import (compress, decompress, get_params, set_params_fedsketch,
-                           delta_weights, get_random_hashfunc)
+from .sketch_utils import (compress, decompress_vector, FlatParams, get_random_hashfunc,
+                           sparse_to_vector)
+from .sketch_dp import SketchDP
+from .trainer_utils import EvaluationCache
 from sklearn.metrics import accuracy_score
 from tsai.inference import load_learner
 from tsai.all import *
@@ -34,25 +36,29 @@ class TrainerFedSketch:
         self.num_epocs = 1
         self.global_seed = 0
         self.model = self.define_model()
-        self.old_weights = get_params(self.model)
-        self.weights = get_params(self.model)
+        # flat snapshot of the parameters before training and delta buffer
+        self.params = FlatParams(self.model.model)
+        self.params.snapshot()
         self.compression = 0.00066666666  # 75x
         self.length = 20
         self.learning_rate = 1e-3
         self.global_learning_rate = 1
 
-        self.vector_length = sum(
-            p.numel() for p in self.model.model.parameters() if p.requires_grad)
+        self.vector_length = self.params.vector_length
         self.metrics_names = ["accuracy"]
         self.index_hash_function = [get_random_hashfunc(_max=int(
             self.compression*self.vector_length), seed=repr(j).encode()) for j in range(self.length)]
         self.args = None
+        self.dp = None  # SketchDP, client argument "dp"
+        self.evaluation = EvaluationCache()  # accuracy of the current model version
         self.stop_flag = False
 
     def set_args(self, args):
         self.args = args
         self.global_learning_rate = self.args['global_learning_rate']
         self.global_seed = self.args['global_seed']
+        if self.args.get('dp'):
+            self.dp = SketchDP(**self.args['dp'], client_id=self.id)
 
     def get_num_samples(self):
         return self.num_samples
@@ -73,18 +79,19 @@ class TrainerFedSketch:
         return dls, X_test, y_test
 
     def train_model(self):
-        self.old_weights = get_params(self.model)
-        for k, v in self.old_weights.items():
-            self.old_weights[k] = v.cpu()
+        self.params.snapshot()
         self.model.fit_one_cycle(self.num_epocs, self.learning_rate)
-        self.weights = get_params(self.model)
+        self.evaluation.invalidate()
 
     def eval_model(self):
+        self.acc = self.evaluation.get(self._eval_model)
+        return self.acc
+
+    def _eval_model(self):
         test_probas, test_targets, test_preds = self.model.get_X_preds(
             self.X_test)
         pred = np.argmax(test_probas, axis=1)
-        self.acc = accuracy_score(self.y_test, pred)
-        return self.acc
+        return accuracy_score(self.y_test, pred)
 
     def all_metrics(self):
         metrics_names = self.metrics_names
@@ -92,20 +99,29 @@ class TrainerFedSketch:
         return dict(zip(metrics_names, values))
 
     def get_weights(self):
-        delta = delta_weights(self.weights, self.old_weights)
+        # trained - snapshot, computed in place in the flat buffer of self.params
+        delta = self.params.delta()
         self.sketch = compress(delta, self.compression,
                                self.length, 1, 90, self.index_hash_function)
-        return self.sketch
+        if self.dp is not None:
+            self.dp.apply(delta, self.sketch)
+        # the server aggregates the sketches in float32
+        return self.sketch.astype(np.float32)
 
-    def update_weights(self, global_sketch):
-        n_weights = decompress(self.weights, global_sketch, len(
-            global_sketch), -10000, 10000, self.index_hash_function)
-        for k, v in n_weights.items():
-
-            n_weights[k] = v*self.global_learning_rate + self.old_weights[k]
+    def get_training_args(self):
+        # used by SketchAggTopK to decode the global sketch on the server
+        return {"vector_length": self.vector_length}
 
-        set_params_fedsketch(self.model, n_weights)
-        self.model.model = self.model.model.float()
+    def update_weights(self, global_sketch):
+        if isinstance(global_sketch, dict):
+            # sparse top-k delta decoded by the server (SketchAggTopK)
+            delta = sparse_to_vector(global_sketch)
+        else:
+            delta = decompress_vector(global_sketch, len(global_sketch),
+                                      self.vector_length, self.index_hash_function)
+        # parameters = snapshot + global_learning_rate * delta, copied in place (float32)
+        self.params.apply_delta(delta, self.global_learning_rate)
+        self.evaluation.invalidate()
 
     def set_stop_true(self):
         self.stop_flag = True
@@ -8,80 +8,16 @@ import sys
 
 from datetime import datetime
 
-from .trainer_utils import read_energy, copiar_arquivo
+from .trainer_utils import read_energy, copiar_arquivo, EvaluationCache
+from .tf_pipeline import configure_threads, make_dataset
+from .dataset_cache import load_dataset
+from .partitioner import load_partition
 
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 
 DATASET_PATH = 'flw/data/MNIST'
 
 
-class MNISTLoader:
-    def __init__(self, data_path):
-        self.data_path = data_path
-
-    def load_data(self):
-        """
-        Load MNIST dataset from local files.
-
-        Returns:
-            (tuple): (train_images, train_labels), (test_images, test_labels) 
-        """
-        train_images_path = os.path.join(
-            self.data_path, 'train-images.idx3-ubyte')
-        train_labels_path = os.path.join(
-            self.data_path, 'train-labels.idx1-ubyte')
-        test_images_path = os.path.join(
-            self.data_path, 't10k-images.idx3-ubyte')
-        test_labels_path = os.path.join(
-            self.data_path, 't10k-labels.idx1-ubyte')
-
-        train_images = self._load_images(train_images_path)
-        train_labels = self._load_labels(train_labels_path)
-        test_images = self._load_images(test_images_path)
-        test_labels = self._load_labels(test_labels_path)
-
-        return (train_images, train_labels), (test_images, test_labels)
-
-    def _load_images(self, file_path):
-        """
-        Load image data from file.
-
-        Args:
-            file_path (str): Path to the image file.
-
-        Returns:
-            numpy.ndarray: Array of images.
-        """
-        with open(file_path, 'rb') as f:
-            _ = int.from_bytes(f.read(4), 'big')  # Magic number
-            num_images = int.from_bytes(f.read(4), 'big')
-            rows = int.from_bytes(f.read(4), 'big')
-            cols = int.from_bytes(f.read(4), 'big')
-
-            image_data = np.frombuffer(f.read(), dtype=np.uint8)
-            images = image_data.reshape(num_images, rows, cols)
-
-        return images / 255.0  # Normalize pixel values to [0, 1]
-
-    def _load_labels(self, file_path):
-        """
-        Load label data from file.
-
-        Args:
-            file_path (str): Path to the label file.
-
-        Returns:
-            numpy.ndarray: Array of labels.
-        """
-        with open(file_path, 'rb') as f:
-            _ = int.from_bytes(f.read(4), 'big')  # Magic number
-            num_labels = int.from_bytes(f.read(4), 'big')
-
-            label_data = np.frombuffer(f.read(), dtype=np.uint8)
-
-        return label_data
-
-
 class TrainerMNIST:
     def __init__(self, id, name, args) -> None:
 
@@ -90,6 +26,8 @@ class TrainerMNIST:
         self.name = name
         # self.mode = mode  # 'class' 'random' 'all'
         self.__dict__.update(args)
+        # thread budget (client argument "num_threads", default: CPU share of the container)
+        configure_threads(getattr(self, 'num_threads', None))
         mode = self.mode
         # define model
         self.model = self.define_model()
@@ -112,6 +50,10 @@ class TrainerMNIST:
         if self.num_samples == -1:
             self.num_samples == len(self.y_train)
 
+        # input pipelines built once and reused in every round
+        self.train_dataset = make_dataset(self.x_train, self.y_train, shuffle=True)
+        self.test_dataset = make_dataset(self.x_test, self.y_test)
+        self.evaluation = EvaluationCache()  # evaluate() of the current model version
         self.stop_flag = False
         self.args = None
 
@@ -143,14 +85,14 @@ class TrainerMNIST:
 
         # Compilar o modelo com o otimizador ajustado
         model.compile(optimizer=optimizer,
-                      loss='categorical_crossentropy',
+                      loss='sparse_categorical_crossentropy',
                       metrics=['accuracy'])
 
         return model
 
     def load_data(self):
-        loader = MNISTLoader(DATASET_PATH)
-        return loader.load_data()
+        # read-only memory-mapped arrays shared by all trainers of the host (see dataset_cache.py)
+        return load_dataset('mnist', DATASET_PATH)
 
     def split_data(self):
         (train_images, train_labels), (test_images,
@@ -164,12 +106,16 @@ class TrainerMNIST:
         # train_images = train_images / 255.0
         # test_images = test_images / 255.0
 
-        # One hot encoding the target class (labels)
+        # Sparse labels (class indices): only the samples of this trainer are copied
+        # out of the shared cache and the labels are never one-hot encoded
         num_classes = 10
-        train_labels = tf.one_hot(np.squeeze(
-            train_labels), depth=num_classes).numpy()
-        test_labels = tf.one_hot(np.squeeze(
-            test_labels), depth=num_classes).numpy()
+
+        if 'partition' in self.mode:
+            # index files created by partitioner.py before the experiment (client argument "partition")
+            train_indices, test_indices = load_partition(self.partition, self.id)
+            self.num_samples = len(train_indices)
+            return (train_images[train_indices], train_labels[train_indices],
+                    test_images[test_indices], test_labels[test_indices])
 
         if 'n_classes' in self.mode:
             # Criar um gerador de números aleatórios usando self.id como seed
@@ -181,9 +127,9 @@ class TrainerMNIST:
 
             # Filtrar índices para as classes selecionadas
             train_indices = np.where(
-                np.isin(np.argmax(train_labels, axis=1), selected_classes))[0]
+                np.isin(train_labels, selected_classes))[0]
             test_indices = np.where(
-                np.isin(np.argmax(test_labels, axis=1), selected_classes))[0]
+                np.isin(test_labels, selected_classes))[0]
 
             # Selecionar os dados correspondentes
             train_images, train_labels = train_images[train_indices], train_labels[train_indices]
@@ -215,18 +161,21 @@ class TrainerMNIST:
         return train_images, train_labels, test_images, test_labels
 
     def train_model(self):
-        self.model.fit(x=self.x_train, y=self.y_train,
-                       batch_size=64, epochs=10, verbose=3)
+        self.model.fit(self.train_dataset, epochs=10, verbose=3)
+        self.evaluation.invalidate()
+
+    def evaluate(self):
+        # loss and metrics of the current model, computed once per model version
+        return self.evaluation.get(lambda: self.model.evaluate(
+            self.test_dataset, verbose=False))
 
     def eval_model(self):
-        acc = self.model.evaluate(
-            x=self.x_test, y=self.y_test, verbose=False)[1]
+        acc = self.evaluate()[1]
         return acc
 
     def all_metrics(self):
         metrics_names = self.model.metrics_names
-        values = self.model.evaluate(
-            x=self.x_test, y=self.y_test, verbose=False)
+        values = self.evaluate()
 
         dic = dict(zip(metrics_names, values))
         dic['energy_consumption'] = read_energy()
@@ -237,6 +186,7 @@ class TrainerMNIST:
 
     def update_weights(self, weights):
         self.model.set_weights(weights)
+        self.evaluation.invalidate()
 
     def set_stop_true(self):
         self.now = datetime.now()
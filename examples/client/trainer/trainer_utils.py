@@ -60,3 +60,26 @@ def copiar_arquivo(origem, destino):
     except Exception as e:
         print(f"Erro ao copiar o arquivo: {e}")
         return False
+
+
+class EvaluationCache:
+    """
+    Guarda o resultado da avaliação do modelo até que ele mude.
+
+    O trainer chama invalidate() sempre que os pesos mudam (train_model/update_weights),
+    então eval_model, all_metrics e get_training_args usam uma única avaliação por versão do modelo.
+    """
+
+    def __init__(self):
+        self.version = 0
+        self._evaluated_version = None
+        self._value = None
+
+    def invalidate(self):
+        self.version += 1
+
+    def get(self, evaluate):
+        if self._evaluated_version != self.version:
+            self._value = evaluate()
+            self._evaluated_version = self.version
+        return self._value
@@ -7,6 +7,8 @@ from tensorflow.keras.models import Sequential
 from tensorflow.keras.layers import Dense, Dropout, Flatten
 from tensorflow.keras.layers import Conv2D, MaxPooling2D
 import tensorflow.keras.optimizers as optimizers
+from .trainer_utils import EvaluationCache
+from .tf_pipeline import configure_threads, make_dataset
 
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 
@@ -16,10 +18,15 @@ class TrainerCifar:
         # id and model
         self.id = id
         self.mode = mode # 'class' 'random' 'all'
+        configure_threads()  # before the first TensorFlow operation
         self.model = self.define_model()
         # split data
         self.num_samples = int(np.random.choice(np.arange(10000, 20000, 1000))) # select a random number ranging from 10000 < num_samples < 20000
         self.x_train, self.y_train, self.x_test, self.y_test = self.split_data()
+        # input pipelines built once and reused in every round
+        self.train_dataset = make_dataset(self.x_train, self.y_train, shuffle=True)
+        self.test_dataset = make_dataset(self.x_test, self.y_test)
+        self.evaluation = EvaluationCache()  # evaluate() of the current model version
         self.stop_flag = False
         self.args = None
     
@@ -53,7 +60,7 @@ class TrainerCifar:
         )
 
         opt = optimizers.RMSprop(learning_rate=lr_schedule)
-        model.compile(loss='categorical_crossentropy', optimizer=opt, metrics=['accuracy'])
+        model.compile(loss='sparse_categorical_crossentropy', optimizer=opt, metrics=['accuracy'])
 
 
         return model
@@ -69,10 +76,10 @@ class TrainerCifar:
         train_images = train_images / 255
         test_images = test_images / 255 
 
-        # One hot encoding the target class (labels)
+        # Sparse labels (class indices)
         num_classes = 10
-        train_labels = tf.one_hot(np.squeeze(train_labels), depth=num_classes).numpy()
-        test_labels = tf.one_hot(np.squeeze(test_labels), depth=num_classes).numpy()
+        train_labels = np.squeeze(train_labels).astype(np.int32)
+        test_labels = np.squeeze(test_labels).astype(np.int32)
         
         if self.mode == 'random':
             # Calculate the proportion of test samples
@@ -89,8 +96,8 @@ class TrainerCifar:
             test_labels = test_labels[test_indices]
         elif self.mode == 'class':
             selected_label = self.id % num_classes
-            train_indices = np.where(np.argmax(train_labels, axis=1) == selected_label)[0]
-            test_indices = np.where(np.argmax(test_labels, axis=1) == selected_label)[0]
+            train_indices = np.where(train_labels == selected_label)[0]
+            test_indices = np.where(test_labels == selected_label)[0]
 
             train_images, train_labels = train_images[train_indices], train_labels[train_indices]
             test_images, test_labels = test_images[test_indices], test_labels[test_indices]
@@ -101,15 +108,21 @@ class TrainerCifar:
     
 
     def train_model(self):
-        self.model.fit(x=self.x_train, y=self.y_train, batch_size=64, epochs=10, verbose=3)
+        self.model.fit(self.train_dataset, epochs=10, verbose=3)
+        self.evaluation.invalidate()
+
+    def evaluate(self):
+        # loss and metrics of the current model, computed once per model version
+        return self.evaluation.get(lambda: self.model.evaluate(
+            self.test_dataset, verbose=False))
 
     def eval_model(self):
-        acc = self.model.evaluate(x=self.x_test, y=self.y_test, verbose=False)[1]
+        acc = self.evaluate()[1]
         return acc
     
     def all_metrics(self):
         metrics_names = self.model.metrics_names
-        values = self.model.evaluate(x=self.x_test, y=self.y_test, verbose=False)
+        values = self.evaluate()
         return dict(zip(metrics_names, values))
     
     def get_weights(self):
@@ -117,6 +130,7 @@ class TrainerCifar:
     
     def update_weights(self, weights):
         self.model.set_weights(weights)
+        self.evaluation.invalidate()
     
     def set_stop_true(self):
         self.stop_flag = True
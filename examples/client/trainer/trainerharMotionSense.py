@@ -6,6 +6,8 @@ import pandas as pd
 from tensorflow.keras.models import Sequential
 from tensorflow.keras.layers import Dense, Flatten
 from tensorflow.keras.optimizers import SGD
+from .trainer_utils import EvaluationCache
+from .tf_pipeline import configure_threads, make_dataset
 
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 
@@ -13,14 +15,19 @@ os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 class TrainerHarMotionSense:
         
     def __init__(self,num_id, mode) -> None:
+        configure_threads()  # before the first TensorFlow operation
         self.folder = "client/data"
         self.id = num_id
         self.mode = mode # client, all
         self.x_train, self.y_train, self.x_test, self.y_test = self.split_data()
         input_shape = self.x_train.shape[1:]
         self.num_samples = self.x_train.shape[0]
-        n_classes = len(self.y_train[0])
+        n_classes = 4
         self.model = self.define_model(input_shape, n_classes)
+        # input pipelines built once and reused in every round
+        self.train_dataset = make_dataset(self.x_train, self.y_train, shuffle=True)
+        self.test_dataset = make_dataset(self.x_test, self.y_test)
+        self.evaluation = EvaluationCache()  # evaluate() of the current model version
         self.stop_flag = False
         self.args = None
     
@@ -39,7 +46,7 @@ class TrainerHarMotionSense:
         model.add(Dense(n_classes, activation='softmax'))
 
         opt = SGD(learning_rate=0.01)
-        model.compile(optimizer=opt, loss='categorical_crossentropy', metrics=['accuracy'])
+        model.compile(optimizer=opt, loss='sparse_categorical_crossentropy', metrics=['accuracy'])
 
         return model
 
@@ -50,15 +57,21 @@ class TrainerHarMotionSense:
         return x_train, y_train, x_test, y_test
 
     def train_model(self):
-        self.model.fit(x=self.x_train, y=self.y_train, batch_size=64, epochs=10, verbose=3)
+        self.model.fit(self.train_dataset, epochs=10, verbose=3)
+        self.evaluation.invalidate()
+
+    def evaluate(self):
+        # loss and metrics of the current model, computed once per model version
+        return self.evaluation.get(lambda: self.model.evaluate(
+            self.test_dataset, verbose=False))
 
     def eval_model(self):
-        acc = self.model.evaluate(x=self.x_test, y=self.y_test, verbose=False)[1]
+        acc = self.evaluate()[1]
         return acc
     
     def all_metrics(self):
         metrics_names = self.model.metrics_names
-        values = self.model.evaluate(x=self.x_test, y=self.y_test, verbose=False)
+        values = self.evaluate()
         return dict(zip(metrics_names, values))
 
     
@@ -67,6 +80,7 @@ class TrainerHarMotionSense:
     
     def update_weights(self, weights):
         self.model.set_weights(weights)
+        self.evaluation.invalidate()
     
     def set_stop_true(self):
         self.stop_flag = True
@@ -101,9 +115,9 @@ class TrainerHarMotionSense:
             pass
         # Converter os dataframes para numpy arrays antes de usá-los no treinamento do modelo
         x_train = x_train.values
-        y_train = tf.one_hot(y_train.values.astype(np.int32), depth=4)
+        y_train = y_train.values.astype(np.int32)
         x_test = x_test.values
-        y_test = tf.one_hot(y_test.values.astype(np.int32), depth=4)
+        y_test = y_test.values.astype(np.int32)
 
         return x_train, y_train, x_test, y_test
 
@@ -3,7 +3,8 @@ import pandas as pd
 import numpy as np
 import tensorflow as tf
 
-from .trainer_utils import read_energy
+from .trainer_utils import read_energy, EvaluationCache
+from .tf_pipeline import configure_threads, make_dataset
 from imblearn.over_sampling import RandomOverSampler
 from sklearn import preprocessing
 from sklearn.model_selection import train_test_split
@@ -17,6 +18,7 @@ os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 class TrainerHarEnergy:
     # ID = 0
     def __init__(self, ext_id, mode) -> None:
+        configure_threads()  # before the first TensorFlow operation
         self.clients = 6
         self.external_id = ext_id
         self.mode = mode  # client
@@ -30,6 +32,10 @@ class TrainerHarEnergy:
         self.num_tests = self.x_test.shape[0]
         n_classes = len(np.unique(self.y_train))
         self.model = self.define_model(input_shape, n_classes)
+        # input pipelines built once and reused in every round
+        self.train_dataset = make_dataset(self.x_train, self.y_train, shuffle=True)
+        self.test_dataset = make_dataset(self.x_test, self.y_test)
+        self.evaluation = EvaluationCache()  # evaluate() of the current model version
         self.stop_flag = False
         self.args = None
 
@@ -62,18 +68,21 @@ class TrainerHarEnergy:
         return x_train, y_train, x_test, y_test
 
     def train_model(self):
-        self.model.fit(x=self.x_train, y=self.y_train,
-                       batch_size=64, epochs=10, verbose=3)
+        self.model.fit(self.train_dataset, epochs=10, verbose=3)
+        self.evaluation.invalidate()
+
+    def evaluate(self):
+        # loss and metrics of the current model, computed once per model version
+        return self.evaluation.get(lambda: self.model.evaluate(
+            self.test_dataset, verbose=False))
 
     def eval_model(self):
-        acc = self.model.evaluate(
-            x=self.x_test, y=self.y_test, verbose=False)[1]
+        acc = self.evaluate()[1]
         return acc
 
     def all_metrics(self):
         metrics_names = self.model.metrics_names
-        values = self.model.evaluate(
-            x=self.x_test, y=self.y_test, verbose=False)
+        values = self.evaluate()
         dic = dict(zip(metrics_names, values))
         dic['energy_consumption'] = read_energy()
         return dic
@@ -84,6 +93,7 @@ class TrainerHarEnergy:
     def update_weights(self, weights):
         # print(weights)
         self.model.set_weights(weights)
+        self.evaluation.invalidate()
 
     def set_stop_true(self):
         self.stop_flag = True
@@ -1 +1,3 @@
 from .fedavg import FedAvg
+from .robust import CoordinateMedian, TrimmedMean, MultiKrum
+from .sketchagg import SketchAgg, SketchAggTopK
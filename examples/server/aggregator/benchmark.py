@@ -0,0 +1,86 @@
+"""
+Compares the stacked aggregation backend with the previous per-layer loops.
+
+Usage (from examples/server):
+    python -m aggregator.benchmark [n_clients ...]
+"""
+import sys
+import time
+from functools import reduce
+
+import numpy as np
+
+from .fedavg import FedAvg
+from .fedsketch import FedSketchAgg
+
+# LeNet-5 (TrainerMNIST) layer shapes
+LENET5_SHAPES = [(5, 5, 1, 6), (6,), (5, 5, 6, 16), (16,), (400, 120), (120,),
+                 (120, 84), (84,), (84, 10), (10,)]
+
+
+def fedavg_loops(client_training_response):
+    all_trainer_samples = []
+    all_weights = []
+    for client_id in client_training_response:
+        all_trainer_samples.append(
+            client_training_response[client_id]["num_samples"])
+        all_weights.append(list(client_training_response[client_id]["weights"]))
+
+    scaling_factor = list(np.array(all_trainer_samples) /
+                          np.array(all_trainer_samples).sum())
+
+    for scaling, weights in zip(scaling_factor, all_weights):
+        for i in range(0, len(weights)):
+            weights[i] = weights[i] * scaling
+
+    agg_weights = []
+    for layer in range(0, len(all_weights[0])):
+        var = []
+        for model in range(0, len(all_weights)):
+            var.append(all_weights[model][layer])
+        agg_weights.append(sum(var))
+    return agg_weights
+
+
+def fedsketch_loops(client_training_response):
+    all_weights = [client_training_response[c]["weights"]
+                   for c in client_training_response]
+    num_clients = len(all_weights)
+    return [reduce(np.add, layer_updates) / num_clients
+            for layer_updates in zip(*all_weights)]
+
+
+def random_responses(n_clients, shapes, rng):
+    return {f"sta{i}": {"weights": [rng.standard_normal(s, dtype=np.float32) for s in shapes],
+                        "num_samples": int(rng.integers(100, 1000))}
+            for i in range(n_clients)}
+
+
+def best_time(function, responses, repeat=3):
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = function(responses)
+        best = min(best, time.perf_counter() - t0)
+    return best, result
+
+
+def main(clients):
+    rng = np.random.default_rng(0)
+    sketch_shapes = [(40000,)] * 20  # 20 sketch rows, as sent by TrainerFedSketch
+    cases = [("FedAvg", LENET5_SHAPES, fedavg_loops, FedAvg().aggregate),
+             ("FedSketchAgg", sketch_shapes, fedsketch_loops, FedSketchAgg().aggregate)]
+
+    print(f"{'aggregator':<14}{'clients':>8}{'loops (s)':>12}{'stacked (s)':>13}{'speedup':>9}{'max diff':>11}")
+    for name, shapes, loops, stacked in cases:
+        for n in clients:
+            responses = random_responses(n, shapes, rng)
+            t_loops, expected = best_time(loops, responses)
+            t_stacked, result = best_time(stacked, responses)
+            diff = max(float(np.max(np.abs(a - b))) for a, b in zip(expected, result))
+            print(f"{name:<14}{n:>8}{t_loops:>12.4f}{t_stacked:>13.4f}{t_loops / t_stacked:>9.1f}{diff:>11.2e}")
+
+
+if __name__ == "__main__":
+    main([int(n) for n in sys.argv[1:]] or [8, 64, 512])
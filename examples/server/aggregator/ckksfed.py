@@ -1,53 +1,54 @@
+import hashlib
+import logging
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
 import torch
 
-from .fedavg import FedAvg
-from .fedsketch import FedSketchAgg
+from .stacked import StackedWeights
 
 from Pyfhel import Pyfhel, PyCtxt
 
+spnfl_logger = logging.getLogger("spnfl")
+
+HE_DIR = "temp/ckksfed_fhe/pasta"
+
+
+def matriz_para_bytes(matriz):
+    """
+    Serializa a matriz (dicionário de dicionários de PyCtxt) em um único bloco de bytes.
+    Cada elemento é gravado como: tamanho (4 bytes, big-endian) + chave da linha,
+    tamanho + chave da coluna, tamanho + bytes do PyCtxt.
+
+    Argumentos:
+      matriz: A matriz a ser serializada (dicionário de dicionários).
+
+    Retorna:
+      Os bytes da matriz.
+    """
+    partes = []
+    for linha1 in matriz:
+        bytes_linha1 = linha1.encode('utf-8')
+        for coluna1 in matriz[linha1]:
+            bytes_coluna1 = coluna1.encode('utf-8')
+            bytes_pyctxt = matriz[linha1][coluna1].to_bytes()
+            partes += [len(bytes_linha1).to_bytes(4, 'big'), bytes_linha1,
+                       len(bytes_coluna1).to_bytes(4, 'big'), bytes_coluna1,
+                       len(bytes_pyctxt).to_bytes(4, 'big'), bytes_pyctxt]
+    return b''.join(partes)
 
 def salvar_matriz_binaria(matriz, nome_arquivo):
     """
-    Salva a matriz binária em um arquivo especificado, incluindo as chaves de linha, coluna e valor e considerando tamanhos variáveis de valores.
+    Salva a matriz binária em um arquivo especificado, no formato de matriz_para_bytes.
 
     Argumentos:
       matriz: A matriz a ser salva (dicionário de dicionários).
       nome_arquivo: O nome do arquivo binário para salvar a matriz.
     """
     with open(nome_arquivo, 'wb') as f:
-
-        # Percorrer cada elemento da matriz
-        for linha1 in matriz:
-            # Converter a chave linha1 em bytes
-            bytes_linha1 = linha1.encode('utf-8')
-
-            for coluna1 in matriz[linha1]:
-
-                # Converter a chave linha1 em bytes
-                bytes_coluna1 = coluna1.encode('utf-8')
-
-                # Escrever o tamanho da chave linha1 e os bytes da chave no arquivo
-                f.write(len(bytes_linha1).to_bytes(4, 'big'))
-                f.write(bytes_linha1)
-                # Escrever o tamanho da chave linha1 e os bytes da chave no arquivo
-                f.write(len(bytes_coluna1).to_bytes(4, 'big'))
-                f.write(bytes_coluna1)
-
-                # Obter o valor (PyCtxt)
-                valor_pyctxt = matriz[linha1][coluna1]
-                # print(matriz, file=sys.stderr)
-                bytes_pyctxt = valor_pyctxt.to_bytes()
-
-                # Converter o tamanho do valor em bytes
-                tamanho_valor = len(bytes_pyctxt).to_bytes(4, 'big')
-
-                # Escrever o tamanho do valor no arquivo
-                f.write(tamanho_valor)
-
-                # escrever no arquivo
-                f.write(bytes_pyctxt)
-        f.close()
+        f.write(matriz_para_bytes(matriz))
 
 def cka_unecrypted(X, Y, XTX, YTY):
   # Implements linear CKA as in Kornblith et al. (2019)
@@ -77,14 +78,19 @@ def cka_encrypted(X, Y, XTX, YTY, HE):
     HE.relinearize(result)
     return result
 
+def to_bytestring(value):
+    # json transport sends ciphertexts as cp437 strings, binary transport as raw bytes
+    if isinstance(value, str):
+        return value.encode('cp437')
+    return bytes(value)
+
 def decode_value(HE, value):
-    return PyCtxt(pyfhel=HE, bytestring=value.encode('cp437'))
+    return PyCtxt(pyfhel=HE, bytestring=to_bytestring(value))
 
 def decode_array(HE, encrypted_array):
     out = []
     for element in encrypted_array:
-        b = element.encode('cp437')
-        c_res = PyCtxt(pyfhel=HE, bytestring=b)
+        c_res = PyCtxt(pyfhel=HE, bytestring=to_bytestring(element))
         out.append(c_res)
     return out
 
@@ -97,46 +103,181 @@ def encrypt_array(HE_f, array):
     }[CASE_SELECTOR]
     l = case_params['l']
 
-    return [HE_f.encrypt(array[j:j+HE_f.get_nSlots()]) for j in range(0, l, HE_f.get_nSlots())]
+    # each ciphertext packs get_nSlots() consecutive values, up to l values
+    n_slots = HE_f.get_nSlots()
+    return [HE_f.encrypt(array[j:j+n_slots]) for j in range(0, min(l, len(array)), n_slots)]
 
 def encrypt_value(HE_f, value):
     return HE_f.encrypt(value)
 
-def cka(X, Y, XTX, YTY, HE=None, crypt=False):
+def transposed_activations(training_args):
+    # the trainers send the 1-D activations once (None as their transpose), older
+    # trainers send both
+    if training_args[1] is None:
+        return training_args[0]
+    return training_args[1]
+
+def decode_activations(training_args, HE=None, crypt=False):
+    # (X, Y, XTX) of one client, decoded once and reused in every pair it takes part in
+    X = training_args[0]
+    Y = transposed_activations(training_args)
     if crypt:
-        X = decode_array(HE, X)
-        Y = decode_array(HE, Y)
-        XTX = decode_value(HE, XTX)
-        YTY = decode_value(HE, YTY)
-        res = cka_encrypted(X, Y, XTX, YTY, HE)
+        X_dec = decode_array(HE, X)
+        Y_dec = X_dec if Y is X else decode_array(HE, Y)
+        return X_dec, Y_dec, decode_value(HE, training_args[2])
+    return np.array(X), np.array(Y), training_args[2]
+
+def cka_decoded(client_i, client_j, HE=None, crypt=False):
+    # client_i/client_j: decoded (X, Y, XTX) of each client
+    X, _, XTX = client_i
+    _, Y, YTY = client_j
+    if crypt:
+        return cka_encrypted(X, Y, XTX, YTY, HE)
+    return cka_unecrypted(X, Y, XTX, YTY)
+
+def _update_fingerprint(h, value):
+    if isinstance(value, (list, tuple)) and value and isinstance(value[0], (list, tuple, str, bytes, bytearray, memoryview)):
+        for v in value:
+            _update_fingerprint(h, v)
+    elif isinstance(value, str):
+        h.update(value.encode('utf-8'))
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        h.update(value)
     else:
-        res = cka_unecrypted(np.array(X), np.array(Y), XTX, YTY)
-    return res
+        h.update(np.asarray(value, dtype=np.float64).tobytes())
+
+def activation_fingerprint(training_args):
+    # identifies the activations (X, Y, XTX) a client sent, to reuse its distances
+    h = hashlib.sha1()
+    for part in (training_args[0], transposed_activations(training_args), training_args[2]):
+        _update_fingerprint(h, part)
+    return h.hexdigest()
+
+def load_he_context(dir_path=HE_DIR):
+    HE_f = Pyfhel()  # Empty creation
+    HE_f.load_context(dir_path + "/context")
+    HE_f.load_public_key(dir_path + "/pub.key")
+    HE_f.load_relin_key(dir_path + "/relin.key")
+    HE_f.load_rotate_key(dir_path + "/rotate.key")
+    return HE_f
+
+# state of each worker process of the distance matrix pool: the context is loaded once per
+# worker and the decoded activations of each client are kept while its fingerprint is the same
+_worker = {}
+
+def _init_worker(dir_path):
+    _worker["HE"] = load_he_context(dir_path)
+    _worker["clients"] = {}
+
+def _cka_pairs(task):
+    # task: (pairs, {client: (fingerprint, training_args)} of the clients in the pairs)
+    pairs, clients = task
+    decoded = _worker["clients"]
+    for c, (fingerprint, args) in clients.items():
+        if c not in decoded or decoded[c][0] != fingerprint:
+            decoded[c] = (fingerprint, decode_activations(args, _worker["HE"], crypt=True))
+    return [(ci, cj, cka_decoded(decoded[ci][1], decoded[cj][1], _worker["HE"], crypt=True).to_bytes())
+            for ci, cj in pairs]
 
 
 class Ckksfed:
-
-    def __init__(self):
+    def __init__(self, num_workers=1):
+        # processes used for the encrypted distance matrix (1: computed in the server process),
+        # set with the server argument "aggregator_args", e.g. {"num_workers": 4}
+        self.num_workers = max(1, int(num_workers))
+        self.pool = None  # created on the first encrypted round and kept until close()
         self.distance_matrix = None
         self.fedsketch = True
-        dir_path = "temp/ckksfed_fhe/pasta"
-        self.HE_f = Pyfhel()  # Empty creation
-        self.HE_f.load_context(dir_path + "/context")
-        self.HE_f.load_public_key(dir_path + "/pub.key")
-        self.HE_f.load_relin_key(dir_path + "/relin.key")
-        self.HE_f.load_rotate_key(dir_path + "/rotate.key")
-
-    def get_distance_matrix(self, client_training_responses, ENCRYPT):
+        self.HE_f = load_he_context(HE_DIR)
+        # last activations of each trainer, {client: (fingerprint, training_args)}, and the
+        # distances between them: only the pairs of clients with new activations are computed
+        self.activation_cache = {}
+        self.distance_cache = {}
+
+    def update_activation_cache(self, client_training_responses, trainers_list):
+        # trainers that left are evicted, clients with new activations lose their distances
+        for client in list(self.activation_cache):
+            if client not in trainers_list:
+                del self.activation_cache[client]
+        changed = set()
+        for client, response in client_training_responses.items():
+            fingerprint = activation_fingerprint(response["training_args"])
+            cached = self.activation_cache.get(client)
+            if cached is None or cached[0] != fingerprint:
+                self.activation_cache[client] = (fingerprint, response["training_args"])
+                changed.add(client)
+        self.distance_cache = {(ci, cj): d for (ci, cj), d in self.distance_cache.items()
+                               if ci in self.activation_cache and cj in self.activation_cache
+                               and ci not in changed and cj not in changed}
+
+    def get_pool(self):
+        # one pool for the lifetime of the aggregator: the workers start and load the context once
+        if self.pool is None:
+            # spawn: the server process runs the mqtt threads, which must not be forked
+            self.pool = ProcessPoolExecutor(max_workers=self.num_workers,
+                                            mp_context=multiprocessing.get_context("spawn"),
+                                            initializer=_init_worker, initargs=(HE_DIR,))
+        return self.pool
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+    def get_distance_matrix(self, client_training_responses, ENCRYPT, trainers_list=None):
+        # the matrix has every trainer with known activations, including the ones that
+        # did not train this round (their distances come from the cache)
+        trainers_list = list(client_training_responses) if trainers_list is None else trainers_list
+        self.update_activation_cache(client_training_responses, trainers_list)
+        clients = [c for c in trainers_list if c in self.activation_cache]
+        cached_args = {c: self.activation_cache[c][1] for c in clients}
+        # cka(i, j) only differs from cka(j, i) when the trainers send X and its transpose
+        # separately; with the 1-D activations sent once only i <= j is computed
+        symmetric = all(args[1] is None for args in cached_args.values())
+        if symmetric:
+            all_pairs = [(ci, cj) for i, ci in enumerate(clients) for cj in clients[i:]]
+        else:
+            all_pairs = [(ci, cj) for ci in clients for cj in clients]
+        pairs = [(ci, cj) for ci, cj in all_pairs
+                 if (ci, cj) not in self.distance_cache
+                 and not (symmetric and (cj, ci) in self.distance_cache)]
+        print(f"Distance matrix: {len(pairs)} of {len(all_pairs)} pairs to compute")
+
+        workers = min(self.num_workers, len(pairs)) if ENCRYPT else 1
+        spnfl_logger.info(f'T_DISTANCE_START {len(clients)} {len(pairs)} {workers}')
+        start = time.time()
+
+        results = self.distance_cache
+        if workers > 1:
+            # a few chunks per worker, each with the activations of the clients in its pairs
+            num_chunks = min(len(pairs), 2 * workers)
+            tasks = []
+            for chunk in (pairs[k::num_chunks] for k in range(num_chunks)):
+                involved = {c for pair in chunk for c in pair}
+                tasks.append((chunk, {c: self.activation_cache[c] for c in involved}))
+            n = 0
+            for chunk_results in self.get_pool().map(_cka_pairs, tasks):
+                for ci, cj, res in chunk_results:
+                    results[(ci, cj)] = PyCtxt(pyfhel=self.HE_f, bytestring=res)
+                n += len(chunk_results)
+                print(f"Distance matrix: {n}/{len(pairs)} pairs ({time.time() - start:.1f}s)")
+        else:
+            involved = {c for pair in pairs for c in pair}
+            decoded = {c: decode_activations(cached_args[c], self.HE_f, crypt=ENCRYPT)
+                       for c in involved}
+            for ci, cj in pairs:
+                results[(ci, cj)] = cka_decoded(decoded[ci], decoded[cj], self.HE_f, crypt=ENCRYPT)
+
         distance_matrix = {}
-        for client_i in client_training_responses:
+        for client_i in clients:
             client_distance = {}
-            for client_j in client_training_responses:
-                client_distance[client_j] = cka(client_training_responses[client_i]["training_args"][0],
-                                                client_training_responses[client_j]["training_args"][1],
-                                                client_training_responses[client_i]["training_args"][2],
-                                                client_training_responses[client_j]["training_args"][2],
-                                                self.HE_f, crypt=ENCRYPT)
+            for client_j in clients:
+                if (client_i, client_j) in results:
+                    client_distance[client_j] = results[(client_i, client_j)]
+                else:
+                    client_distance[client_j] = results[(client_j, client_i)]
             distance_matrix[client_i] = client_distance
+        spnfl_logger.info(f'T_DISTANCE_END {len(clients)} {len(pairs)} {time.time() - start:.3f}')
         return distance_matrix
 
     def aggregate(self, client_training_responses, trainers_list):
@@ -147,20 +288,22 @@ class Ckksfed:
 
         print("Calculating the distance matrix")
         self.distance_matrix = self.get_distance_matrix(
-            client_training_responses, ENCRYPT=ENCRYPTED)
+            client_training_responses, ENCRYPT=ENCRYPTED, trainers_list=trainers_list)
 
 
+        # FedAvg weights by num_samples, FedSketchAgg is a plain mean of the sketches
         if not self.fedsketch:
             print("FedAvg selected")
-            fed_avg = FedAvg()
         else:
             print("FedSketchAgg selected")
-            fed_avg = FedSketchAgg()
+        # the weights of all clients are stacked once and each cluster averages its own rows
+        stacked = StackedWeights(client_training_responses)
+        weighted = not self.fedsketch
 
         weights_dict = {}
         if len(client_training_responses[trainers_list[0]]["training_args"][3]) == 0:
             print("No cluster provided (first round) => Aggregating all weights")
-            weights = fed_avg.aggregate(client_training_responses)
+            weights = stacked.average(weighted=weighted)
             weights_dict = {c: weights for c in trainers_list}
         else:
             print("Aggregating each cluster")
@@ -175,8 +318,7 @@ class Ckksfed:
                 print(cluster)
 
                 aggregated_clusters.add(tuple(cluster))
-                weights = fed_avg.aggregate(
-                    {c: client_training_responses[c] for c in cluster})
+                weights = stacked.average(cluster, weighted=weighted)
                 weights_dict = weights_dict | {c: weights for c in cluster}
 
         agg_response = {}
@@ -184,9 +326,10 @@ class Ckksfed:
             agg_response[client] = {"weights": weights_dict[client]}
 
         if ENCRYPTED:
-            print("Saving encrypted matrix in external file")
-            salvar_matriz_binaria(
-                self.distance_matrix, 'data_temp/data.bin')
+            # sent through the broker as a single binary blob (raw bytes with the binary codec)
+            print("Sending encrypted matrix")
+            agg_response['all'] = {
+                "distances_bin": matriz_para_bytes(self.distance_matrix), "clients": trainers_list}
         else:
             print("Saving unencrypted matrix")
             agg_response['all'] = {
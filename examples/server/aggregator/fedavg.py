@@ -1,32 +1,38 @@
 import numpy as np
 
+from .stacked import StackedWeights
+from .quantize import add_dequantized, layer_shape
+
 
 class FedAvg:
     def __init__(self):
-        pass
-
-    def aggregate(self, client_training_response):
-        all_trainer_samples = []
-        all_weights = []
-        for client_id in client_training_response:
-            all_trainer_samples.append(
-                client_training_response[client_id]["num_samples"])
-            all_weights.append(client_training_response[client_id]["weights"])
+        self.sum_weights = None  # running sum of num_samples * weights, one float64 array per layer
+        self.total_samples = 0
+        self.num_clients = 0
 
-        scaling_factor = list(np.array(all_trainer_samples) /
-                              np.array(all_trainer_samples).sum())
+    # Incremental API: the controller folds each client in as soon as its weights arrive,
+    # so only one copy of the model is kept in memory and finalize() is almost free.
+    def begin_round(self):
+        if self.sum_weights is not None:
+            for acc in self.sum_weights:
+                acc.fill(0)
+        self.total_samples = 0
+        self.num_clients = 0
 
-        # scale weights
-        for scaling, weights in zip(scaling_factor, all_weights):
-            for i in range(0, len(weights)):
-                weights[i] = weights[i] * scaling
+    def accumulate(self, client_id, weights, num_samples, training_args=None):
+        # the layers can be quantized (see quantize.py): they are dequantized while accumulated
+        if self.sum_weights is None or len(self.sum_weights) != len(weights):
+            self.sum_weights = [np.zeros(layer_shape(w), dtype=np.float64)
+                                for w in weights]
+        for acc, w in zip(self.sum_weights, weights):
+            add_dequantized(acc, w, num_samples)
+        self.total_samples += num_samples
+        self.num_clients += 1
 
-        # agg weights
-        agg_weights = []
-        for layer in range(0, len(all_weights[0])):
-            var = []
-            for model in range(0, len(all_weights)):
-                var.append(all_weights[model][layer])
-            agg_weights.append(sum(var))
+    def finalize(self):
+        return [(acc / self.total_samples).astype(np.float32)
+                for acc in self.sum_weights]
 
-        return agg_weights
+    def aggregate(self, client_training_response):
+        # all clients at once: weighted average of the stacked (clients x parameters) matrix
+        return StackedWeights(client_training_response).average(weighted=True)
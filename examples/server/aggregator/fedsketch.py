@@ -1,5 +1,6 @@
 import numpy as np
-from functools import reduce
+
+from .stacked import StackedWeights
 
 class FedSketchAgg:
       
@@ -7,18 +8,5 @@ class FedSketchAgg:
       pass
     
     def aggregate(self, client_training_response):
-        """Compute weighted average."""
-        all_trainer_samples = []
-        all_weights = []
-        for client_id in client_training_response:
-            all_trainer_samples.append(client_training_response[client_id]["num_samples"])
-            all_weights.append(client_training_response[client_id]["weights"])
-        
-        num_clients = len(all_trainer_samples)
-
-        # Compute average weights of each layer
-        weights_prime = [
-            reduce(np.add, layer_updates) / num_clients
-            for layer_updates in zip(*all_weights)
-        ]
-        return weights_prime
\ No newline at end of file
+        """Compute the average of the stacked client sketches."""
+        return StackedWeights(client_training_response).average(weighted=False)
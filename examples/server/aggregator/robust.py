@@ -0,0 +1,77 @@
+import logging
+
+import numpy as np
+
+from .stacked import StackedWeights
+
+spnfl_logger = logging.getLogger("spnfl")
+
+
+# Byzantine-robust aggregators. All of them work on the stacked (clients x parameters)
+# matrix in column blocks, so memory stays bounded for any number of clients.
+# Their parameters are set with the server argument "aggregator_args", e.g. {"trim_ratio": 0.2}.
+
+
+# CoordinateMedian: each parameter is the median of the values sent by the clients
+class CoordinateMedian:
+    def __init__(self):
+        pass
+
+    def aggregate(self, client_training_response):
+        stacked = StackedWeights(client_training_response)
+        # the block is a scratch buffer, so the partial sort can be done in place
+        return stacked.coordinate_wise(
+            lambda block: np.median(block, axis=0, overwrite_input=True))
+
+
+# TrimmedMean: each parameter is the mean of the client values after discarding the
+# trim_ratio largest and the trim_ratio smallest ones
+class TrimmedMean:
+    def __init__(self, trim_ratio=0.1):
+        self.trim_ratio = trim_ratio
+
+    def aggregate(self, client_training_response):
+        stacked = StackedWeights(client_training_response)
+        n = len(stacked.ids)
+        k = min(int(self.trim_ratio * n), (n - 1) // 2)
+
+        def trimmed_mean(block):
+            if k == 0:
+                return block.mean(axis=0)
+            # after the partition the rows k..n-k-1 hold the values that are kept
+            block.partition((k, n - k - 1), axis=0)
+            return block[k:n - k].mean(axis=0)
+
+        return stacked.coordinate_wise(trimmed_mean)
+
+
+# MultiKrum: scores each client by the sum of the squared distances to its n - f - 2
+# nearest clients (f = byzantine_ratio * n) and averages, weighted by num_samples,
+# the num_selected clients with the lowest scores (n - f when not given)
+class MultiKrum:
+    def __init__(self, byzantine_ratio=0.2, num_selected=None):
+        self.byzantine_ratio = byzantine_ratio
+        self.num_selected = num_selected
+
+    def aggregate(self, client_training_response):
+        stacked = StackedWeights(client_training_response)
+        n = len(stacked.ids)
+        f = int(self.byzantine_ratio * n)
+        # Krum needs n > 2f + 2 to tolerate f byzantine clients
+        f = max(0, min(f, (n - 3) // 2))
+        neighbours = max(1, n - f - 2)
+
+        distances = stacked.squared_distances()
+        np.fill_diagonal(distances, np.inf)
+        if n > 1:
+            nearest = np.partition(distances, min(neighbours, n - 1) - 1, axis=1)
+            scores = nearest[:, :min(neighbours, n - 1)].sum(axis=1)
+        else:
+            scores = np.zeros(1)
+
+        m = self.num_selected if self.num_selected is not None else n - f
+        m = max(1, min(m, n))
+        selected = np.argsort(scores, kind="stable")[:m]
+        selected_ids = [stacked.ids[i] for i in sorted(selected)]
+        spnfl_logger.info(f'T_MULTIKRUM_SELECTED {" ".join(map(str, selected_ids))}')
+        return stacked.average(selected_ids, weighted=True)
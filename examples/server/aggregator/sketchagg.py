@@ -0,0 +1,95 @@
+import logging
+
+import numpy as np
+
+from .quantize import add_dequantized, layer_shape
+from .sparsify import num_kept, top_k
+
+logger = logging.getLogger(__name__)
+
+
+# Aggregators that work directly on the (length x width) Count Sketches sent by
+# TrainerFedSketch. The sketches are folded into a single preallocated float64 sketch
+# as they arrive (incremental API), so the server never keeps one sketch per client
+# and never decodes the dense client deltas.
+
+
+# SketchAgg: average of the client sketches, weighted by num_samples (weighted = False
+# gives the plain mean of FedSketchAgg). The global sketch is sent to every client.
+class SketchAgg:
+    weighted = True
+
+    def __init__(self):
+        self.sum_sketch = None  # running (weighted) sum of the sketches, float64
+        self.scratch = None  # one row of the sketch, reused for the weighted products
+        self.total_weight = 0
+        self.vector_length = None  # length of the dense vector compressed by the clients
+
+    def begin_round(self):
+        if self.sum_sketch is not None:
+            self.sum_sketch.fill(0)
+        self.total_weight = 0
+
+    def accumulate(self, client_id, weights, num_samples, training_args=None):
+        # weights: the rows of the sketch (views of the received buffer, they are not copied),
+        # possibly quantized (see quantize.py)
+        shape = (len(weights), layer_shape(weights[0])[0])
+        if self.sum_sketch is None or self.sum_sketch.shape != shape:
+            self.sum_sketch = np.zeros(shape, dtype=np.float64)
+            self.scratch = np.empty(shape[1], dtype=np.float64)
+        weight = num_samples if self.weighted else 1
+        for acc, row in zip(self.sum_sketch, weights):
+            add_dequantized(acc, row, weight, out=self.scratch)
+        self.total_weight += weight
+        if isinstance(training_args, dict) and "vector_length" in training_args:
+            self.vector_length = training_args["vector_length"]
+
+    def global_sketch(self):
+        return (self.sum_sketch / self.total_weight).astype(np.float32)
+
+    def finalize(self):
+        return list(self.global_sketch())
+
+    def aggregate(self, client_training_response):
+        # all clients at once (e.g. the buffer of the asynchronous mode)
+        self.begin_round()
+        for client_id, response in client_training_response.items():
+            self.accumulate(client_id, response["weights"], response["num_samples"],
+                            response.get("training_args"))
+        return self.finalize()
+
+
+# SketchAggTopK: decodes the global sketch on the server and keeps only its top_k_ratio
+# heavy hitters (largest decoded coordinates in absolute value). Clients download the
+# sparse delta {"indices", "values", "vector_length"} instead of the whole sketch.
+# Needs the clients to send their "vector_length" in the training args.
+# top_k_ratio is set with the server argument "aggregator_args", e.g. {"top_k_ratio": 0.05}.
+class SketchAggTopK(SketchAgg):
+    def __init__(self, top_k_ratio=0.01):
+        super().__init__()
+        self.top_k_ratio = top_k_ratio
+        self.index_hash_functions = None
+
+    def hash_functions(self, length, width):
+        # same hash functions as the trainers: seed repr(j) and buckets in [0, width)
+        from .sketch_utils import get_random_hashfunc
+        if (self.index_hash_functions is None or len(self.index_hash_functions) != length
+                or self.index_hash_functions[0].max != width):
+            self.index_hash_functions = [get_random_hashfunc(_max=width, seed=repr(j).encode())
+                                         for j in range(length)]
+        return self.index_hash_functions
+
+    def finalize(self):
+        if self.vector_length is None:
+            logger.warning("SketchAggTopK: clients did not send vector_length, sending the whole sketch")
+            return super().finalize()
+        from .sketch_utils import QuerySketchFunction_pytorch
+        sketch = self.global_sketch()
+        length, width = sketch.shape
+        decoded = QuerySketchFunction_pytorch(0, self.vector_length, sketch, length, width,
+                                              self.hash_functions(length, width))
+        indices = top_k(np.abs(decoded), num_kept(self.vector_length, self.top_k_ratio))
+        sparse = {"indices": indices.astype(np.int64), "values": decoded[indices],
+                  "vector_length": self.vector_length}
+        # single model shared by every client
+        return {"all": {"weights": sparse}}
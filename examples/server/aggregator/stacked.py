@@ -0,0 +1,136 @@
+import numpy as np
+
+# maximum size of the (clients x parameters) blocks, so memory stays bounded for any number of clients
+MAX_BLOCK_BYTES = 32 << 20
+# layers are only stacked for averaging while the stack fits in cache; above that the
+# average is memory bound and accumulating client by client avoids copying the layer
+AVERAGE_STACK_BYTES = 2 << 20
+
+_layouts = {}
+_buffer = np.empty((0, 0), dtype=np.float32)
+
+
+def _block_buffer(n_rows, width):
+    # the block buffer is reused between calls and rounds, it only grows when needed
+    global _buffer
+    if _buffer.shape[0] < n_rows or _buffer.shape[1] < width:
+        _buffer = np.empty((max(n_rows, _buffer.shape[0]), max(width, _buffer.shape[1])),
+                           dtype=np.float32)
+    return _buffer
+
+
+class LayerLayout:
+    """
+    Position of each layer inside the flat parameter vector of a model.
+    Layouts are cached by the shapes of the layers, so they are computed once per model.
+    """
+
+    def __init__(self, shapes):
+        self.shapes = [tuple(s) for s in shapes]
+        self.sizes = [int(np.prod(s)) for s in self.shapes]
+        self.offsets = np.concatenate(([0], np.cumsum(self.sizes))).astype(np.int64)
+        self.total = int(self.offsets[-1])
+
+    @staticmethod
+    def of(weights):
+        shapes = tuple(tuple(np.shape(w)) for w in weights)
+        layout = _layouts.get(shapes)
+        if layout is None:
+            layout = LayerLayout(shapes)
+            _layouts[shapes] = layout
+        return layout
+
+    def unflatten(self, vector):
+        return [vector[start:end].reshape(shape)
+                for shape, start, end in zip(self.shapes, self.offsets[:-1], self.offsets[1:])]
+
+
+class StackedWeights:
+    """
+    Weights of the clients seen as a single (clients x parameters) float32 matrix.
+    The matrix is produced in column blocks of at most MAX_BLOCK_BYTES, so memory does
+    not grow with the number of clients. Averages are one matrix product per layer
+    instead of Python loops over clients and layers; layers whose stack would not fit
+    in cache are summed client by client in place, since they are memory bound.
+    """
+
+    def __init__(self, client_training_response):
+        self.ids = list(client_training_response)
+        self.row = {id: i for i, id in enumerate(self.ids)}
+        self.num_samples = np.array([client_training_response[id]["num_samples"]
+                                     for id in self.ids], dtype=np.float64)
+        self.layout = LayerLayout.of(client_training_response[self.ids[0]]["weights"])
+        # flat views of each layer of each client (no copies for contiguous arrays)
+        self.flat = [[np.ravel(w) for w in client_training_response[id]["weights"]]
+                     for id in self.ids]
+
+    def rows(self, ids=None):
+        return list(range(len(self.ids))) if ids is None else [self.row[id] for id in ids]
+
+    def block_width(self, n_rows, max_bytes=None):
+        max_bytes = MAX_BLOCK_BYTES if max_bytes is None else max_bytes
+        return max(1, max_bytes // (n_rows * np.dtype(np.float32).itemsize))
+
+    def block(self, rows, layer, a, b):
+        # (clients x (b - a)) slice of a layer, copied into the reused block buffer
+        buffer = _block_buffer(len(rows), b - a)
+        block = buffer[:len(rows), :b - a]
+        np.stack([self.flat[r][layer][a:b] for r in rows], out=block)
+        return block
+
+    def blocks(self, ids=None, max_bytes=None):
+        # yields (start, end, block): block is the (clients x (end - start)) slice of the matrix.
+        # The block is a reused buffer, it is only valid until the next iteration
+        rows = self.rows(ids)
+        width = self.block_width(len(rows), max_bytes)
+        for layer, offset in enumerate(self.layout.offsets[:-1]):
+            size = self.layout.sizes[layer]
+            for a in range(0, size, width):
+                b = min(a + width, size)
+                yield offset + a, offset + b, self.block(rows, layer, a, b)
+
+    def average(self, ids=None, weighted=True):
+        # weighted by num_samples (FedAvg) or plain mean (FedSketchAgg) over the given clients
+        rows = self.rows(ids)
+        scaling = self.num_samples[rows] if weighted else np.ones(len(rows))
+        # float32 scaling keeps the products in single precision
+        scaling = (scaling / scaling.sum()).astype(np.float32)
+        width = self.block_width(len(rows), AVERAGE_STACK_BYTES)
+        averaged = np.empty(self.layout.total, dtype=np.float32)
+        for layer, offset in enumerate(self.layout.offsets[:-1]):
+            size = self.layout.sizes[layer]
+            out = averaged[offset:offset + size]
+            if size <= width:
+                np.matmul(scaling, self.block(rows, layer, 0, size), out=out)
+            else:
+                # large layers (e.g. sketch rows): the output stays in cache while the clients are added
+                out.fill(0)
+                if weighted:
+                    scaled = np.empty(size, dtype=np.float32)
+                    for k, r in enumerate(rows):
+                        np.multiply(self.flat[r][layer], scaling[k], out=scaled)
+                        out += scaled
+                else:
+                    for r in rows:
+                        out += self.flat[r][layer]
+                    out *= scaling[0]
+        return self.layout.unflatten(averaged)
+
+    def coordinate_wise(self, function, ids=None):
+        # applies function(block) -> one value per column to every block of the matrix
+        combined = np.empty(self.layout.total, dtype=np.float32)
+        for start, end, block in self.blocks(ids):
+            combined[start:end] = function(block)
+        return self.layout.unflatten(combined)
+
+    def squared_distances(self, ids=None):
+        # (clients x clients) squared euclidean distances, accumulated block by block from
+        # the Gram matrix in float64 so only one block of the matrix is in memory at a time
+        rows = self.rows(ids)
+        gram = np.zeros((len(rows), len(rows)), dtype=np.float64)
+        for start, end, block in self.blocks(ids):
+            block64 = block.astype(np.float64)
+            gram += block64 @ block64.T
+        norms = np.diag(gram)
+        distances = norms[:, None] + norms[None, :] - 2 * gram
+        return np.maximum(distances, 0)
@@ -0,0 +1,107 @@
+import os
+
+import numpy as np
+import pytest
+
+from codec import decode, get_codec
+from .delta import DeltaEncoder, apply_delta, exact_delta
+
+CONFIGS = [
+    {},
+    {"sparsify": {"scheme": "topk", "ratio": 0.1}},
+    {"sparsify": {"scheme": "randk", "ratio": 0.2}},
+    {"quantize": {"scheme": "int8"}},
+    {"sparsify": {"scheme": "topk", "ratio": 0.1}, "quantize": {"scheme": "stochastic", "bits": 4}},
+]
+
+
+def default(obj):
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError(type(obj))
+
+
+def model(rng):
+    return [rng.normal(size=(20, 30)).astype(np.float32), rng.normal(size=30).astype(np.float32)]
+
+
+def step(weights, rng, changed=0.3):
+    # new global model: a fraction of the coordinates changes a little
+    return [w + (rng.normal(scale=0.01, size=w.shape) * (rng.random(w.shape) < changed)).astype(np.float32)
+            for w in weights]
+
+
+@pytest.mark.parametrize("codec_name", ["binary", "json"])
+@pytest.mark.parametrize("config", CONFIGS)
+def test_server_and_client_rebuild_the_same_model(config, codec_name):
+    rng = np.random.default_rng(0)
+    encoder = DeltaEncoder(versions=3, seed=0, **config)
+    codec = get_codec(codec_name, default=default)
+    weights = model(rng)
+    server_base = (0, weights)
+    client_base = (0, [w.copy() for w in weights])
+    for r in range(1, 8):
+        weights = step(weights, rng)
+        delta, rebuilt = encoder.encode(weights, server_base[1])
+        assert delta is not None
+        message = decode(codec.encode({"round": r, "agg_response": {"weights": delta, "base_round": r - 1}}))
+        client_weights = apply_delta(message["agg_response"]["weights"], client_base[1])
+        for a, b in zip(client_weights, rebuilt):
+            np.testing.assert_array_equal(a, b)
+        server_base, client_base = (r, rebuilt), (r, client_weights)
+    # the error of the lossy deltas is sent again in the next ones, so it does not accumulate
+    error = max(np.abs(a - b).max() for a, b in zip(server_base[1], weights))
+    assert error < 0.05
+
+
+def test_lossless_encoder_is_exact():
+    rng = np.random.default_rng(1)
+    base = model(rng)
+    weights = step(base, rng)
+    delta, rebuilt = DeltaEncoder().encode(weights, base)
+    assert delta["delta"] is False
+    for a, b in zip(rebuilt, weights):
+        np.testing.assert_array_equal(a, b)
+
+
+def test_exact_delta():
+    rng = np.random.default_rng(2)
+    base = model(rng)
+    weights = step(base, rng, changed=0.1)
+    delta = exact_delta(weights, base)
+    assert len(delta["values"]) < 0.5 * sum(w.size for w in weights)
+    for a, b in zip(apply_delta(delta, base), weights):
+        np.testing.assert_array_equal(a, b)
+
+
+def test_exact_delta_falls_back_to_the_full_model():
+    rng = np.random.default_rng(3)
+    base = model(rng)
+    assert exact_delta(base, None) is None  # version evicted or unknown
+    assert exact_delta(model(rng), base) is None  # every coordinate changed
+    assert exact_delta([base[0]], base) is None  # different layers
+    delta, rebuilt = DeltaEncoder().encode([base[0][:10]], [base[0]])
+    assert delta is None
+    np.testing.assert_array_equal(rebuilt[0], base[0][:10])
+
+
+def test_delta_against_the_wrong_base_is_rejected():
+    rng = np.random.default_rng(4)
+    base = model(rng)
+    delta, _ = DeltaEncoder(sparsify={"scheme": "topk", "ratio": 0.1}).encode(step(base, rng), base)
+    with pytest.raises(ValueError):
+        apply_delta(delta, [base[0]])
+
+
+def test_invalid_versions():
+    with pytest.raises(ValueError):
+        DeltaEncoder(versions=0)
+
+
+def test_client_copy_is_identical():
+    here = os.path.dirname(os.path.abspath(__file__))
+    client_copy = os.path.join(here, "..", "..", "client", "trainer", "delta.py")
+    with open(os.path.join(here, "delta.py")) as f, open(client_copy) as g:
+        assert f.read() == g.read()
@@ -0,0 +1,106 @@
+import os
+
+import numpy as np
+import pytest
+
+from .quantize import (STOCHASTIC_BITS, Quantizer, add_dequantized, dequantize, dequantize_layer,
+                       is_quantized, layer_shape, pack, quantize_layer, unpack)
+
+LAYERS = {
+    "positive": np.linspace(0.9, 1.1, 60, dtype=np.float32).reshape(6, 10),
+    "negative": np.linspace(-3.0, -2.1, 60, dtype=np.float32).reshape(6, 10),
+    "mixed": np.linspace(-1.0, 2.0, 60, dtype=np.float32).reshape(6, 10),
+    "constant": np.full((6, 10), 0.75, dtype=np.float32),
+    "constant_negative": np.full(7, -2.5, dtype=np.float32),
+    "zeros": np.zeros(5, dtype=np.float32),
+}
+
+
+def max_error(scheme, layer, bits=8):
+    # largest error expected from the scheme on layer
+    if scheme == "fp16":
+        return 1e-3 * max(1.0, float(np.abs(layer).max()))
+    low, high = float(layer.min()), float(layer.max())
+    if scheme == "int8":
+        return (max(high, 0.0) - min(low, 0.0)) / 255 / 2 + 1e-6
+    return (high - low) / ((1 << bits) - 1) + 1e-6
+
+
+@pytest.mark.parametrize("name", LAYERS)
+@pytest.mark.parametrize("scheme", ["fp16", "int8", "stochastic"])
+def test_roundtrip(scheme, name):
+    layer = LAYERS[name]
+    message = quantize_layer(layer, scheme, bits=8, rng=np.random.default_rng(0))
+    values = dequantize_layer(message)
+    assert values.dtype == np.float32
+    assert values.shape == layer.shape
+    assert layer_shape(message) == layer.shape
+    assert np.abs(values - layer).max() <= max_error(scheme, layer)
+
+
+@pytest.mark.parametrize("name", ["constant", "constant_negative", "zeros"])
+@pytest.mark.parametrize("scheme", ["fp16", "int8", "stochastic"])
+def test_constant_layers_are_exact(scheme, name):
+    layer = LAYERS[name]
+    values = dequantize_layer(quantize_layer(layer, scheme, rng=np.random.default_rng(0)))
+    np.testing.assert_allclose(values, layer, rtol=1e-6)
+
+
+@pytest.mark.parametrize("name", LAYERS)
+def test_int8_zero_point_in_range(name):
+    message = quantize_layer(LAYERS[name], "int8")
+    assert -128 <= message["zero_point"] <= 127
+    assert message["data"].dtype == np.int8
+
+
+@pytest.mark.parametrize("bits", STOCHASTIC_BITS)
+def test_pack_unpack(bits):
+    codes = np.random.default_rng(1).integers(0, 1 << bits, size=37)
+    np.testing.assert_array_equal(unpack(pack(codes, bits), bits, len(codes)), codes)
+
+
+@pytest.mark.parametrize("bits", STOCHASTIC_BITS)
+def test_stochastic_bits(bits):
+    layer = LAYERS["mixed"]
+    values = dequantize_layer(quantize_layer(layer, "stochastic", bits, np.random.default_rng(2)))
+    assert np.abs(values - layer).max() <= max_error("stochastic", layer, bits)
+
+
+def test_stochastic_is_unbiased():
+    layer = LAYERS["negative"]
+    rng = np.random.default_rng(3)
+    mean = np.mean([dequantize_layer(quantize_layer(layer, "stochastic", 2, rng))
+                    for _ in range(2000)], axis=0)
+    step = (layer.max() - layer.min()) / 3
+    assert np.abs(mean - layer).max() < 0.05 * step
+
+
+@pytest.mark.parametrize("scheme", ["fp16", "int8", "stochastic"])
+def test_add_dequantized_matches_dequantize(scheme):
+    layer = LAYERS["positive"]
+    message = quantize_layer(layer, scheme, rng=np.random.default_rng(4))
+    acc = np.ones(layer.shape, dtype=np.float64)
+    add_dequantized(acc, message, 3.0)
+    np.testing.assert_allclose(acc, 1 + 3.0 * dequantize_layer(message), rtol=1e-6)
+
+
+def test_quantizer_model():
+    layers = [LAYERS["mixed"], LAYERS["positive"][0]]
+    message = Quantizer("int8").quantize(layers)
+    assert is_quantized(message)
+    for values, layer in zip(dequantize(message), layers):
+        assert np.abs(values - layer).max() <= max_error("int8", layer)
+
+
+def test_invalid_arguments():
+    with pytest.raises(ValueError):
+        Quantizer("int4")
+    with pytest.raises(ValueError):
+        Quantizer("stochastic", bits=3)
+
+
+def test_client_copy_is_identical():
+    here = os.path.dirname(os.path.abspath(__file__))
+    client_copy = os.path.join(here, "..", "..", "client", "trainer", "quantize.py")
+    with open(os.path.join(here, "quantize.py")) as f, open(client_copy) as g:
+        assert f.read() == g.read()
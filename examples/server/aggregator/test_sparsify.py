@@ -0,0 +1,117 @@
+import os
+
+import numpy as np
+import pytest
+
+from .sparsify import (Sparsifier, densify, flatten, is_sparse, num_kept, same_shapes, select,
+                       sparsify, top_k)
+
+
+def layers(rng):
+    return [rng.normal(size=(8, 5)).astype(np.float32), rng.normal(size=5).astype(np.float32)]
+
+
+def test_top_k_indices_are_sorted_and_largest():
+    scores = np.array([0.1, 5.0, 0.3, 4.0, 0.2, 3.0])
+    np.testing.assert_array_equal(top_k(scores, 3), [1, 3, 5])
+    np.testing.assert_array_equal(top_k(scores, 10), np.arange(6))
+
+
+def test_num_kept():
+    assert num_kept(1000, 0.01) == 10
+    assert num_kept(10, 0.001) == 1
+    assert num_kept(10, 2.0) == 10
+
+
+@pytest.mark.parametrize("scheme", ["topk", "topk_change", "randk", "threshold"])
+def test_schemes(scheme):
+    rng = np.random.default_rng(0)
+    vector = rng.normal(size=200).astype(np.float32)
+    reference = rng.normal(size=200).astype(np.float32)
+    indices = select(vector, scheme, ratio=0.1, threshold=1.5, reference=reference, rng=rng)
+    assert np.all(np.diff(indices) > 0)
+    if scheme == "topk":
+        assert len(indices) == 20
+        assert np.abs(vector[indices]).min() >= np.delete(np.abs(vector), indices).max()
+    elif scheme == "topk_change":
+        change = np.abs(vector - reference)
+        assert change[indices].min() >= np.delete(change, indices).max()
+    elif scheme == "randk":
+        assert len(indices) == 20
+    else:
+        np.testing.assert_array_equal(indices, np.flatnonzero(np.abs(vector) >= 1.5))
+
+
+def test_invalid_schemes():
+    with pytest.raises(ValueError):
+        select(np.ones(3), "topk_change")
+    with pytest.raises(ValueError):
+        select(np.ones(3), "threshold")
+    with pytest.raises(ValueError):
+        Sparsifier("bottomk")
+
+
+def test_sparsify_and_densify():
+    rng = np.random.default_rng(1)
+    weights = layers(rng)
+    message = sparsify(weights, "topk", ratio=0.2)
+    assert is_sparse(message) and message["indices"].dtype == np.int32
+    dense = densify(message)
+    assert same_shapes(dense, weights)
+    vector = flatten(dense)
+    kept = message["indices"]
+    np.testing.assert_array_equal(vector[kept], flatten(weights)[kept])
+    assert not np.delete(vector, kept).any()
+
+    # replacement on top of a base: the other coordinates come from the base
+    base = layers(rng)
+    merged = flatten(densify(message, base))
+    np.testing.assert_array_equal(merged[kept], flatten(weights)[kept])
+    np.testing.assert_array_equal(np.delete(merged, kept), np.delete(flatten(base), kept))
+
+
+def test_densify_does_not_modify_the_base():
+    rng = np.random.default_rng(2)
+    base = layers(rng)
+    copy = [b.copy() for b in base]
+    densify(Sparsifier("topk", 0.5).compress(layers(rng), base), base)
+    for a, b in zip(base, copy):
+        np.testing.assert_array_equal(a, b)
+
+
+def test_densify_rejects_a_different_model():
+    rng = np.random.default_rng(3)
+    message = sparsify(layers(rng), "topk", ratio=0.2)
+    with pytest.raises(ValueError):
+        densify(message, [np.zeros(3, dtype=np.float32)])
+
+
+def test_error_feedback_sends_the_whole_update():
+    # with error feedback, what was sent plus the residual is always the whole update
+    rng = np.random.default_rng(4)
+    base = layers(rng)
+    sparsifier = Sparsifier("topk", ratio=0.1)
+    sent = np.zeros(len(flatten(base)), dtype=np.float32)
+    total = np.zeros_like(sent)
+    for _ in range(5):
+        weights = [b + rng.normal(scale=0.1, size=b.shape).astype(np.float32) for b in base]
+        total += flatten(weights) - flatten(base)
+        message = sparsifier.compress(weights, base)
+        assert message["delta"] is True
+        sent += flatten(densify(message, base)) - flatten(base)
+        np.testing.assert_allclose(sent + sparsifier.residual, total, atol=1e-5)
+
+
+def test_without_error_feedback_nothing_is_kept():
+    rng = np.random.default_rng(5)
+    base = layers(rng)
+    sparsifier = Sparsifier("randk", ratio=0.1, error_feedback=False, seed=0)
+    sparsifier.compress(layers(rng), base)
+    assert sparsifier.residual is None
+
+
+def test_client_copy_is_identical():
+    here = os.path.dirname(os.path.abspath(__file__))
+    client_copy = os.path.join(here, "..", "..", "client", "trainer", "sparsify.py")
+    with open(os.path.join(here, "sparsify.py")) as f, open(client_copy) as g:
+        assert f.read() == g.read()
@@ -0,0 +1,150 @@
+import json
+import struct
+
+import numpy as np
+
+
+# Binary wire format:
+#   MAGIC (4 bytes) | header length (uint32, little-endian) | JSON header | raw buffers
+# The JSON header is the original message with every tensor/bytes object replaced by
+# a reference {"__buf__": index}; "__buffers__" describes each buffer as
+# [dtype, shape, offset, nbytes]. Buffers are little-endian and 8-byte aligned so
+# they can be decoded with np.frombuffer without copies.
+MAGIC = b'MFB1'
+BUFFER_KEY = "__buf__"
+BUFFERS_KEY = "__buffers__"
+BYTES_DTYPE = "bytes"
+ALIGNMENT = 8
+
+
+def _padding(size):
+    return (-size) % ALIGNMENT
+
+
+class JsonCodec:
+    name = "json"
+
+    def __init__(self, default=None):
+        self.default = default
+
+    def encode(self, message):
+        return json.dumps(message, default=self.default).encode("utf-8")
+
+    def decode(self, payload):
+        return json.loads(payload.decode("utf-8"))
+
+
+class BinaryCodec:
+    name = "binary"
+
+    def __init__(self, default=None):
+        # default: optional hook used for objects that are not numpy arrays,
+        # bytes or plain json types (e.g. torch tensors or Pyfhel ciphertexts)
+        self.default = default
+
+    def _to_buffer(self, obj):
+        if isinstance(obj, np.ndarray):
+            return obj
+        if isinstance(obj, (bytes, bytearray, memoryview)):
+            return obj
+        if hasattr(obj, "detach") and hasattr(obj, "numpy"):
+            # torch.Tensor
+            return obj.detach().cpu().numpy()
+        if hasattr(obj, "to_bytes"):
+            # Pyfhel PyCtxt
+            return obj.to_bytes()
+        return None
+
+    def _extract(self, obj, buffers):
+        if isinstance(obj, dict):
+            return {k: self._extract(v, buffers) for k, v in obj.items()}
+        if isinstance(obj, (list, tuple)):
+            return [self._extract(v, buffers) for v in obj]
+        if isinstance(obj, np.generic):
+            return obj.item()
+        if obj is None or isinstance(obj, (str, int, float, bool)):
+            return obj
+        buffer = self._to_buffer(obj)
+        if buffer is None and self.default is not None:
+            return self._extract(self.default(obj), buffers)
+        if buffer is None:
+            raise TypeError('Tipo não pode ser serializado:', type(obj))
+        buffers.append(buffer)
+        return {BUFFER_KEY: len(buffers) - 1}
+
+    def encode(self, message):
+        buffers = []
+        body = self._extract(message, buffers)
+
+        descriptors = []
+        chunks = []
+        offset = 0
+        for buffer in buffers:
+            if isinstance(buffer, np.ndarray):
+                array = np.ascontiguousarray(
+                    buffer, dtype=buffer.dtype.newbyteorder('<'))
+                # flat byte view (memoryview.cast fails on shapes with a 0)
+                raw = memoryview(array.reshape(-1).view(np.uint8))
+                descriptors.append(
+                    [array.dtype.str, list(array.shape), offset, array.nbytes])
+            else:
+                raw = memoryview(buffer).cast('B')
+                descriptors.append([BYTES_DTYPE, [], offset, raw.nbytes])
+            chunks.append(raw)
+            pad = _padding(raw.nbytes)
+            if pad:
+                chunks.append(b'\0' * pad)
+            offset += raw.nbytes + pad
+
+        header = json.dumps({"body": body, BUFFERS_KEY: descriptors},
+                            separators=(',', ':')).encode("utf-8")
+        header += b' ' * _padding(len(MAGIC) + 4 + len(header))
+        return b''.join([MAGIC, struct.pack('<I', len(header)), header] + chunks)
+
+    def decode(self, payload):
+        header_len = struct.unpack_from('<I', payload, len(MAGIC))[0]
+        start = len(MAGIC) + 4
+        header = json.loads(bytes(payload[start:start + header_len]).decode("utf-8"))
+        data_start = start + header_len
+        view = memoryview(payload)
+
+        buffers = []
+        for dtype, shape, offset, nbytes in header[BUFFERS_KEY]:
+            offset += data_start
+            if dtype == BYTES_DTYPE:
+                buffers.append(bytes(view[offset:offset + nbytes]))
+            else:
+                dt = np.dtype(dtype)
+                array = np.frombuffer(payload, dtype=dt,
+                                      count=nbytes // dt.itemsize, offset=offset)
+                buffers.append(array.reshape(shape))
+        return self._restore(header["body"], buffers)
+
+    def _restore(self, obj, buffers):
+        if isinstance(obj, dict):
+            if len(obj) == 1 and BUFFER_KEY in obj:
+                return buffers[obj[BUFFER_KEY]]
+            return {k: self._restore(v, buffers) for k, v in obj.items()}
+        if isinstance(obj, list):
+            return [self._restore(v, buffers) for v in obj]
+        return obj
+
+
+CODECS = {
+    JsonCodec.name: JsonCodec,
+    BinaryCodec.name: BinaryCodec,
+}
+
+
+def get_codec(name, default=None):
+    try:
+        return CODECS[name](default=default)
+    except KeyError:
+        raise ValueError(f"Error: codec {name} not available ({list(CODECS)})")
+
+
+def decode(payload, default=None):
+    # The format is detected from the payload, so both ends can always read json
+    if bytes(payload[:len(MAGIC)]) == MAGIC:
+        return BinaryCodec(default=default).decode(payload)
+    return JsonCodec(default=default).decode(payload)
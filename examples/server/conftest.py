@@ -0,0 +1,6 @@
+import os
+import sys
+
+# server.py runs as a script from this folder and its modules import each other as top-level
+# modules (controller, codec, aggregator), so the tests see the folder the same way
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
@@ -3,14 +3,18 @@ import pandas as pd
 from client_selection import *
 from aggregator import *
 import importlib
+import threading
+import time
+from collections import deque
 import client_selection as clientSelection
+from aggregator.delta import exact_delta
 
 
-def create_object(pacote, nome_classe):
+def create_object(pacote, nome_classe, **atributtes):
     try:
         modulo = importlib.import_module(f"{pacote}")
         classe = getattr(modulo, nome_classe)
-        return classe()
+        return classe(**atributtes)
     except (ModuleNotFoundError, AttributeError) as e:
         print(f"Erro: {e}")
         return None
@@ -18,7 +22,7 @@ def create_object(pacote, nome_classe):
 
 class Controller:
     def __init__(self, min_trainers=2, num_rounds=5, client_selector='Random',
-                 aggregator="FedAvg"):
+                 aggregator="FedAvg", late_policy="drop", model_versions=1, aggregator_args=None):
         self.trainer_list = []
         self.min_trainers = min_trainers
         self.current_round = 0
@@ -29,9 +33,32 @@ class Controller:
         self.acc_list = []
         self.mean_acc_per_round = []
         self.clientSelection = getattr(clientSelection, client_selector)()
-        self.aggregator = create_object("aggregator", aggregator)
+        # aggregator_args: constructor arguments of the aggregator (e.g. {"trim_ratio": 0.2})
+        self.aggregator = create_object("aggregator", aggregator, **(aggregator_args or {}))
+        # aggregators with the incremental API (begin_round/accumulate/finalize) aggregate the
+        # weights as they arrive instead of keeping every client's model until the end of the round
+        self.streaming = callable(getattr(self.aggregator, "accumulate", None))
         self.metrics = {}
+        self.codecs = {}  # wire format negotiated with each trainer
         self.global_model = None
+        # (round, agg_response_dict) of the last model_versions global models sent to the trainers
+        # (ring buffer): bases of the sparse uploads and of the downlink deltas
+        self.sent_models = deque(maxlen=model_versions)
+        self.client_versions = {}  # round of the global model each trainer reported holding
+        # signalled by the mqtt callbacks whenever a trainer joins or a response arrives
+        self.condition = threading.Condition()
+        # phase of the round currently accepting responses ("train", "metrics" or None)
+        self.phase = None
+        self.phase_start = 0
+        # time between opening a phase and receiving each response, used for percentile deadlines
+        self.response_times = {"train": deque(maxlen=1000), "metrics": deque(maxlen=1000)}
+        # what to do with training responses that miss the deadline: "drop" or "buffer" for the next round
+        self.late_policy = late_policy
+        self.late_responses = {}
+        # asynchronous mode: updates waiting for aggregation and the latest accuracy of each trainer
+        self.update_buffer = []
+        self.latest_acc = {}
+        self.global_weights = None
 
     # getters
     def get_trainer_list(self):
@@ -54,14 +81,113 @@ class Controller:
     def get_global_model(self):
         return self.global_model
 
+    def get_mean_latest_acc(self):
+        with self.condition:
+            accs = list(self.latest_acc.values())
+        mean = float(np.mean(accs)) if accs else 0.0
+        self.mean_acc_per_round.append(mean)  # save mean acc
+        return mean
+
+    def get_broadcast_codec(self):
+        # posAggQueue is shared by all trainers, so binary is only used if every one supports it
+        if self.codecs and all(c == "binary" for c in self.codecs.values()):
+            return "binary"
+        return "json"
+
+    def get_codec_name(self, trainer_id):
+        return self.codecs.get(trainer_id, "json")
+
+    def set_codec(self, trainer_id, codec_name):
+        self.codecs[trainer_id] = codec_name
+
     def update_metrics(self, trainer_id, metrics):
         self.metrics[trainer_id] = metrics
 
     def update_num_responses(self):
-        self.num_responses += 1
+        with self.condition:
+            self.num_responses += 1
+            self.condition.notify_all()
 
     def reset_num_responses(self):
-        self.num_responses = 0
+        with self.condition:
+            self.num_responses = 0
+
+    def wait_for_responses(self, n, timeout=None):
+        # Blocks until at least n responses arrived. Returns False if the timeout expired first
+        with self.condition:
+            return self.condition.wait_for(lambda: self.num_responses >= n, timeout)
+
+    def open_phase(self, phase):
+        with self.condition:
+            self.phase = phase
+            self.phase_start = time.time()
+            self.num_responses = 0
+            if phase == "train" and self.streaming:
+                self.aggregator.begin_round()
+
+    def close(self):
+        # releases the resources of the aggregator (e.g. the process pool of Ckksfed)
+        if callable(getattr(self.aggregator, "close", None)):
+            self.aggregator.close()
+
+    def close_phase(self):
+        with self.condition:
+            self.phase = None
+
+    def accept_response(self, phase, round):
+        # A response is accepted if it belongs to the phase of the current round that is still open.
+        # Trainers that do not tag their responses with the round are always accepted
+        with self.condition:
+            if round is not None and (round != self.current_round or phase != self.phase):
+                return False
+            self.response_times[phase].append(time.time() - self.phase_start)
+            return True
+
+    def add_training_response(self, id, round, response):
+        # Checks the round and stores the response in a single step, so the phase can not be closed
+        # and the round aggregated in between. response is None when the training failed.
+        # Returns "accepted", "buffered" (late, kept for the next round) or "dropped" (late)
+        with self.condition:
+            if not self.accept_response("train", round):
+                if response is not None and self.add_late_response(id, response):
+                    return "buffered"
+                return "dropped"
+            if response is not None:
+                self.add_client_training_response(id, response)
+                self.num_responses += 1
+                self.condition.notify_all()
+            return "accepted"
+
+    def get_deadline(self, phase, spec, initial=None):
+        # spec: None (no deadline), seconds, or "p<q>" for the q-th percentile of the
+        # response times observed for this phase in previous rounds. initial is used
+        # by the percentile deadlines until there are response times for the phase
+        if spec is None:
+            return None
+        if isinstance(spec, str) and spec.startswith("p"):
+            with self.condition:
+                times = list(self.response_times[phase])
+            if not times:
+                return None if initial is None else float(initial)
+            return float(np.percentile(times, float(spec[1:])))
+        return float(spec)
+
+    def has_training_responses(self):
+        # something to aggregate: responses of the current round or late ones of the previous round
+        with self.condition:
+            return bool(self.client_training_response or self.late_responses)
+
+    def add_late_response(self, id, response):
+        with self.condition:
+            if self.late_policy == "buffer":
+                self.late_responses[id] = response
+                return True
+            return False
+
+    def wait_for_trainers(self, n, timeout=None):
+        # Blocks until at least n trainers joined the pool. Returns False if the timeout expired first
+        with self.condition:
+            return self.condition.wait_for(lambda: len(self.trainer_list) >= n, timeout)
 
     def reset_acc_list(self):
         self.acc_list = []
@@ -70,51 +196,190 @@ class Controller:
         self.current_round += 1
 
     def add_trainer(self, trainer_id):
-        self.trainer_list.append(trainer_id)
+        with self.condition:
+            self.trainer_list.append(trainer_id)
+            self.condition.notify_all()
 
     def add_client_training_response(self, id, response):
-        self.client_training_response[id] = response
+        with self.condition:
+            if self.streaming:
+                # the weights are folded into the aggregator and released, only the other info is kept
+                self.aggregator.accumulate(id, response["weights"], response["num_samples"],
+                                           response.get("training_args"))
+                response = {k: v for k, v in response.items() if k != "weights"}
+            self.client_training_response[id] = response
 
     def add_accuracy(self, acc):
-        self.acc_list.append(acc)
+        with self.condition:
+            self.acc_list.append(acc)
+
+    def set_latest_accuracy(self, trainer_id, acc):
+        with self.condition:
+            self.latest_acc[trainer_id] = acc
+
+    def add_buffered_update(self, id, response, base_version):
+        # asynchronous mode: base_version is the global model version the trainer started from
+        with self.condition:
+            if base_version is None:
+                base_version = self.current_round
+            self.update_buffer.append((id, response, base_version))
+            self.num_responses += 1
+            self.condition.notify_all()
 
     def select_trainers_for_round(self):
         return self.clientSelection.select_trainers_for_round(self.trainer_list, self.metrics)
 
     def agg_weights(self) -> dict:
         # Aggregate the models recived from clients
-        agg_response = {}
-        try:
-            agg_response = self.aggregator.aggregate(
-                self.client_training_response, self.trainer_list)
-        # old aggregator standard
-        except:
-            agg_response = self.aggregator.aggregate(
-                self.client_training_response)
-        agg_response_dict = {}
-
-        # The aggregator can return a list of weights or a dictionary mapping the id of each clients to their weights
-        # The numpy arrays need to be converted to lists before return to be able to turn into json
-        if isinstance(agg_response, dict):
-            for r in self.trainer_list:
+        # Everything is done under the lock: a response that arrives meanwhile is handled as late
+        # and can not be added to (or cleared from) the round being aggregated
+        with self.condition:
+            # late updates buffered from the previous round, unless the trainer already sent a new one
+            for id, response in self.late_responses.items():
+                if id not in self.client_training_response:
+                    self.add_client_training_response(id, response)
+            self.late_responses = {}
+            # reset weights and samples for next round
+            client_training_response = self.client_training_response
+            self.client_training_response = {}
+
+            agg_response = {}
+            if self.streaming:
+                agg_response = self.aggregator.finalize()
+            else:
                 try:
-                    # Tem que mandar para todos os trainers, mesmo os que não treinaram
-                    agg_response[r]["weights"] = [w.tolist()
-                                                  for w in agg_response[r]["weights"]]
+                    agg_response = self.aggregator.aggregate(
+                        client_training_response, self.trainer_list)
+                # old aggregator standard
                 except:
-                    raise Exception(f"Error: O agregador não retornou os weights do trainer {r}!")
-            agg_response_dict = agg_response
-        else:
-            # for r in self.client_training_response:
-            for r in self.trainer_list:
-                client_dict = {}
-                client_dict["weights"] = [w.tolist() for w in agg_response]
-                agg_response_dict[r] = client_dict
+                    agg_response = self.aggregator.aggregate(
+                        client_training_response)
+            agg_response_dict = {}
 
-        # reset weights and samples for next round
-        self.client_training_response.clear()
+            # The aggregator can return a list of weights or a dictionary mapping the id of each clients to their weights
+            # The numpy arrays are kept as they are; the codec used to publish them takes care of serialization
+            if isinstance(agg_response, dict):
+                for r in self.trainer_list:
+                    # Tem que mandar para todos os trainers, mesmo os que não treinaram
+                    # (the weights in "all" are used by the trainers without their own entry)
+                    if "weights" not in agg_response.get(r, agg_response.get("all", {})):
+                        raise Exception(f"Error: O agregador não retornou os weights do trainer {r}!")
+                agg_response_dict = agg_response
+            else:
+                # A single global model is shared by every trainer
+                agg_response_dict["all"] = {"weights": agg_response}
 
-        self.global_model = agg_response_dict
+            self.global_model = agg_response_dict
 
-        # agg_response_dict -> {client_id: {"weights": [], ...}}
+        # agg_response_dict -> {"all": {"weights": [], ...}} when the model is shared by all trainers
+        #                  -> {client_id: {"weights": [], ...}, "all": {...}} when each trainer has its own model
         return agg_response_dict
+
+    def agg_buffered_weights(self, buffer_size, staleness_exponent=0.5, server_learning_rate=1.0):
+        # FedBuff-style aggregation of the oldest buffer_size updates. Each update is weighted by
+        # num_samples * (1 + staleness) ** -staleness_exponent, where staleness is the number of
+        # versions published since the one it was trained on. The result is mixed with the current
+        # global model with a rate proportional to the mean staleness weight of the buffer.
+        with self.condition:
+            updates = self.update_buffer[:buffer_size]
+            self.update_buffer = self.update_buffer[buffer_size:]
+            self.num_responses = len(self.update_buffer)
+
+        responses = {}
+        staleness_list = []
+        total_samples = 0
+        weighted_samples = 0
+        for i, (id, response, base_version) in enumerate(updates):
+            staleness = max(self.current_round - base_version, 0)
+            factor = (1 + staleness) ** -staleness_exponent
+            total_samples += response["num_samples"]
+            weighted_samples += response["num_samples"] * factor
+            # the same trainer can have more than one update in the buffer
+            responses[f"{id}_{i}"] = response | {
+                "num_samples": response["num_samples"] * factor}
+            staleness_list.append(staleness)
+
+        agg_response = self.aggregator.aggregate(responses)
+        if isinstance(agg_response, dict):
+            raise Exception(
+                "Error: o modo assíncrono precisa de um agregador que retorne um único modelo global!")
+
+        if self.global_weights is None:
+            weights = agg_response
+        else:
+            mix = server_learning_rate * weighted_samples / max(total_samples, 1)
+            weights = [(1 - mix) * g + mix * a
+                       for g, a in zip(self.global_weights, agg_response)]
+
+        self.global_weights = weights
+        self.update_current_round()
+        self.global_model = {"all": {"weights": weights}}
+        return self.global_model, staleness_list
+
+    def add_sent_model(self, round, agg_response_dict):
+        # must be called before the model is published, the trainers answer right after receiving it
+        with self.condition:
+            self.sent_models.append((round, agg_response_dict))
+
+    def get_last_sent_model(self):
+        with self.condition:
+            return self.sent_models[-1] if self.sent_models else (None, None)
+
+    def get_sent_weights(self, trainer_id, round):
+        # weights of the global model sent to the trainer in round, None if that version
+        # was already evicted from the ring buffer
+        with self.condition:
+            models = [model for r, model in self.sent_models if r == round]
+        if round is None or not models:
+            return None
+        weights = models[-1].get(trainer_id, models[-1].get("all", {})).get("weights")
+        return weights if isinstance(weights, list) else None
+
+    def set_client_version(self, trainer_id, round):
+        with self.condition:
+            self.client_versions[trainer_id] = round
+
+    def get_client_version(self, trainer_id):
+        with self.condition:
+            return self.client_versions.get(trainer_id)
+
+    def get_agg_payloads(self, agg_response_dict):
+        # Returns the shared payload and the payload of each trainer.
+        # When there are per-trainer payloads, the shared info ("all") is merged into each one
+        shared = agg_response_dict.get("all", {})
+        per_client = {r: agg_response_dict[r] | shared
+                      for r in agg_response_dict if r != "all"}
+        return shared, per_client
+
+    def get_downlink_payloads(self, shared, encoder):
+        # Delta-based downlink of a shared model (see aggregator/delta.py): the trainers that hold the
+        # last model sent receive the (lossy) delta of encoder against it, the ones that hold an older
+        # version still in the ring buffer a lossless delta, and the others the full model.
+        # Returns the model to register with add_sent_model (the weights rebuilt by the trainers), the
+        # shared payload, the payload of each trainer (empty when they all get the same one) and the
+        # number of trainers that receive a delta and the full model
+        base_round, _ = self.get_last_sent_model()
+        base = self.get_sent_weights("all", base_round)
+        if base is None:
+            delta, weights = None, [np.asarray(w, dtype=np.float32) for w in shared["weights"]]
+        else:
+            delta, weights = encoder.encode(shared["weights"], base)
+        payloads = {}  # payload for each version held by the trainers
+        per_client = {}
+        num_full = 0
+        for t in self.get_trainer_list():
+            held = self.get_client_version(t)
+            if held not in payloads:
+                if held == base_round and delta is not None:
+                    payloads[held] = shared | {"weights": delta, "base_round": held}
+                elif (exact := exact_delta(weights, self.get_sent_weights("all", held))) is not None:
+                    payloads[held] = shared | {"weights": exact, "base_round": held}
+                else:
+                    payloads[held] = shared | {"weights": weights}
+            per_client[t] = payloads[held]
+            num_full += "base_round" not in payloads[held]
+        sent = {"all": shared | {"weights": weights}}
+        counts = (len(per_client) - num_full, num_full)
+        if len(payloads) == 1:
+            return sent, next(iter(payloads.values())), {}, counts
+        return sent, shared, per_client, counts
@@ -2,6 +2,10 @@ from logging import Formatter
 
 import paho.mqtt.client as mqtt
 from controller import Controller
+from codec import get_codec, decode
+from aggregator.sparsify import is_sparse, densify
+from aggregator.quantize import is_quantized, is_quantized_layer, dequantize, dequantize_layer
+from aggregator.delta import DeltaEncoder
 import json
 import time
 import numpy as np
@@ -15,6 +19,9 @@ def default(obj):
             return obj.tolist()
         else:
             return obj.item()
+    elif isinstance(obj, (bytes, bytearray, memoryview)):
+        # blobs (e.g. the encrypted distance matrix) go as cp437 strings in json
+        return bytes(obj).decode('cp437')
     else:
         try:
             from Pyfhel import PyCtxt
@@ -45,9 +52,33 @@ def server():
     min_trainers = server_args["min_trainers"]
     client_selector = server_args["client_selector"]
     aggregator = server_args["aggregator"]
+    aggregator_args = server_args.get("aggregator_args")
     nun_rounds = server_args["num_rounds"]
     stop_acc = server_args["stop_acc"]
     client_args = server_args.get("client")
+    # wire format for weights on preAggQueue/posAggQueue ("binary" or "json")
+    server_codec = server_args.get("codec", "binary")
+    # deadlines (seconds or "p<q>" percentile of previous response times) for each round phase
+    train_deadline = server_args.get("train_deadline")
+    metrics_deadline = server_args.get("metrics_deadline")
+    # deadline of the "p<q>" specs while there are no response times to take the percentile of
+    initial_deadline = server_args.get("initial_deadline")
+    late_policy = server_args.get("late_policy", "drop")
+    # "sync" (rounds) or "async" (FedBuff-style: aggregate every buffer_size updates)
+    mode = server_args.get("mode", "sync")
+    buffer_size = server_args.get("buffer_size", max(1, min_trainers // 2))
+    staleness_exponent = server_args.get("staleness_exponent", 0.5)
+    server_learning_rate = server_args.get("server_learning_rate", 1.0)
+    # sparse uploads, e.g. {"scheme": "topk", "ratio": 0.01} (see aggregator/sparsify.py). The clients send
+    # deltas against the last global model, so it is only used in the synchronous mode
+    upload_sparsify = server_args.get("sparsify") if mode == "sync" else None
+    # quantized uploads, e.g. {"scheme": "int8"} or {"scheme": "stochastic", "bits": 4} (see aggregator/quantize.py);
+    # clients with their own "quantize" argument keep it
+    upload_quantize = server_args.get("quantize")
+    # delta-based downlink, e.g. {"versions": 4, "sparsify": {"scheme": "topk", "ratio": 0.1}} (see aggregator/delta.py):
+    # trainers that hold one of the last "versions" global models only receive the delta against it
+    downlink = server_args.get("downlink")
+    downlink_encoder = DeltaEncoder(**downlink) if downlink else None
     metricType = {"infotype": "METRIC"}
     executionType = {"infotype": "EXECUT"}
 
@@ -99,46 +130,113 @@ def server():
     def on_message_register(client, userdata, message):
         m = json.loads(message.payload.decode("utf-8"))
         controller.update_metrics(m["id"], m['metrics'])
+        # clients that do not announce their codecs only understand json
+        codec_name = server_codec if server_codec in m.get(
+            "codecs", ["json"]) else "json"
+        controller.set_codec(m["id"], codec_name)
         logger.info(
             f'trainer number {m["id"]} just joined the pool', extra=executionType)
         print(
             f'trainer number {m["id"]} just joined the pool')
 
         client.publish(
-            'minifed/serverArgs', json.dumps({"id": m["id"], "args": client_args}))
+            'minifed/serverArgs', json.dumps({"id": m["id"], "args": client_args,
+                                              "codec": codec_name, "mode": mode,
+                                              "sparsify": upload_sparsify,
+                                              "quantize": upload_quantize}))
 
     # callback for preAggQueue: get weights of trainers, aggregate and send back
     def on_message_agg(client, userdata, message):
-        m = json.loads(message.payload.decode("utf-8"))
-
-        spnfl_logger.info(f'T_RETURN_0 {m["id"]} {m["success"]}')
+        m = decode(message.payload)
+        if mode == "async":
+            on_message_agg_async(m)
+            return
+        client_training_response = get_training_response(m) if m['success'] else None
+        # the round is checked and the response stored atomically, so it can not miss the aggregation
+        status = controller.add_training_response(m['id'], m.get("round"), client_training_response)
+
+        if status == "accepted":
+            spnfl_logger.info(f'T_RETURN_0 {m["id"]} {m["success"]}')
+        else:
+            spnfl_logger.info(f'T_LATE_0 {m["id"]} {m["success"]} {m.get("round")}')
+
+        if client_training_response is not None:
+            if status == "accepted":
+                logger.info(
+                    f'received weights from trainer {m["id"]}!', extra=executionType)
+                print(f'received weights from trainer {m["id"]}!')
+            elif status == "buffered":
+                logger.info(
+                    f'buffered late weights from trainer {m["id"]} for the next round', extra=executionType)
+                print(f'buffered late weights from trainer {m["id"]} for the next round')
+            else:
+                logger.info(
+                    f'dropped late weights from trainer {m["id"]}', extra=executionType)
+                print(f'dropped late weights from trainer {m["id"]}')
+        elif m['success']:
+            print(f'dropped sparse weights from trainer {m["id"]}: base model of round {m.get("base_round")} not available')
+        else:
+            print(f'client {m["id"]} failed in training!')
 
-        if m['success']:
-            client_training_response = {}
+    def get_training_response(m):
+        client_training_response = {}
+        if is_sparse(m['weights']):
+            # sparse delta against the global model the trainer received in base_round
+            base = controller.get_sent_weights(m['id'], m.get('base_round'))
+            if base is None:
+                return None
+            sparse = m['weights']
+            if is_quantized_layer(sparse['values']):
+                sparse = sparse | {'values': dequantize_layer(sparse['values'])}
+            weights = densify(sparse, base)
+        elif is_quantized(m['weights']):
+            # the incremental aggregators (FedAvg, SketchAgg) dequantize the layers while
+            # accumulating them; the others receive float32 layers
+            if controller.streaming and mode == "sync":
+                weights = m['weights']['layers']
+            else:
+                weights = dequantize(m['weights'])
+        else:
             weights = [np.asarray(w, dtype=np.float32) for w in m['weights']]
-            client_training_response["weights"] = weights
+        client_training_response["weights"] = weights
 
-            if 'training_args' in m:
-                client_training_response["training_args"] = m['training_args']
+        if 'training_args' in m:
+            client_training_response["training_args"] = m['training_args']
 
-            num_samples = m['num_samples']
-            client_training_response["num_samples"] = num_samples
-            controller.add_client_training_response(
-                m['id'], client_training_response)
-            controller.update_num_responses()
+        num_samples = m['num_samples']
+        client_training_response["num_samples"] = num_samples
+        return client_training_response
+
+    # asynchronous mode: every update is buffered, tagged with the global model version it started from
+    def on_message_agg_async(m):
+        spnfl_logger.info(f'T_RETURN_0 {m["id"]} {m["success"]}')
+        if m['success']:
+            controller.add_buffered_update(
+                m['id'], get_training_response(m), m.get('round'))
             logger.info(
-                f'received weights from trainer {m["id"]}!', extra=executionType)
-            print(f'received weights from trainer {m["id"]}!')
+                f'received weights from trainer {m["id"]} (base version {m.get("round")})!', extra=executionType)
+            print(f'received weights from trainer {m["id"]} (base version {m.get("round")})!')
         else:
             print(f'client {m["id"]} failed in training!')
 
 
-
     # callback for metricsQueue: get the metrics from each client after it finish its round
     def on_message_metrics(client, userdata, message):
         m = json.loads(message.payload.decode("utf-8"))
-        controller.add_accuracy(m['metrics']['accuracy'])
         controller.update_metrics(m["id"], m['metrics'])
+        # even late metrics tell which global model the trainer holds
+        controller.set_client_version(m["id"], m.get("version"))
+        if mode == "async":
+            controller.set_latest_accuracy(m["id"], m['metrics']['accuracy'])
+            m["metrics"]["client_name"] = m["id"]
+            logger.info(
+                f'{json.dumps(m["metrics"])}', extra=metricType)
+            spnfl_logger.info(f'T_RETURN_1 {m["id"]}')
+            return
+        if not controller.accept_response("metrics", m.get("round")):
+            spnfl_logger.info(f'T_LATE_1 {m["id"]} {m.get("round")}')
+            return
+        controller.add_accuracy(m['metrics']['accuracy'])
         m["metrics"]["client_name"] = m["id"]
         logger.info(
             f'{json.dumps(m["metrics"])}', extra=metricType)
@@ -146,9 +244,121 @@ def server():
 
         spnfl_logger.info(f'T_RETURN_1 {m["id"]}')
 
+    def wait_phase(phase, expected, deadline_spec):
+        # wait for the responses of a phase until its deadline. If none arrived, the first one is
+        # awaited for one more deadline, so that the server does not hang when every trainer is down
+        deadline = controller.get_deadline(phase, deadline_spec, initial_deadline)
+        if not controller.wait_for_responses(expected, deadline):
+            received = controller.get_num_responses()
+            spnfl_logger.info(f'T_DEADLINE {phase} {deadline} {received} {expected}')
+            logger.info(
+                f'{phase} deadline of {deadline:.2f}s expired with {received}/{expected} responses', extra=executionType)
+            print(color.YELLOW +
+                  f'{phase} deadline expired with {received}/{expected} responses' + color.RESET)
+            controller.wait_for_responses(1, deadline)
+        controller.close_phase()
+
+    def save_best_model(best_model):
+        with open(saved_model_file, "w", encoding="utf-8") as f:
+            json.dump(best_model, f, ensure_ascii=False, indent=2, default=default)
+
+    # publishes the global model of round version: once on posAggQueue when every trainer receives the
+    # same payload, otherwise the payload of each trainer on posAgg/<name>
+    def publish_global_model(version, agg_response_dict):
+        shared, per_client = controller.get_agg_payloads(agg_response_dict)
+        if not per_client and downlink_encoder is not None and isinstance(shared.get("weights"), list):
+            agg_response_dict, shared, per_client, (num_delta, num_full) = controller.get_downlink_payloads(
+                shared, downlink_encoder)
+            spnfl_logger.info(f'T_DOWNLINK {num_delta} {num_full}')
+        # the trainers answer as soon as they receive the model, so it is registered first
+        controller.add_sent_model(version, agg_response_dict)
+        if not per_client:
+            codec = get_codec(controller.get_broadcast_codec(), default=default)
+            client.publish('minifed/posAggQueue',
+                           codec.encode({'round': version, 'agg_response': shared}))
+            return
+        encoded = {}  # trainers with the same payload and codec share the encoded message
+        for t, payload in per_client.items():
+            codec_name = controller.get_codec_name(t)
+            key = (id(payload), codec_name)
+            if key not in encoded:
+                encoded[key] = get_codec(codec_name, default=default).encode(
+                    {'round': version, 'agg_response': payload})
+            client.publish(f'minifed/posAgg/{t}', encoded[key])
+
+    # asynchronous (FedBuff-style) mode: trainers keep training on the latest global model and
+    # a new version is published every buffer_size updates, without waiting for the slow trainers
+    def run_async():
+        best_acc = 0
+        best_model = None
+
+        # only the trainers already in the pool train, so a larger buffer would never fill up
+        num_trainers = len(controller.get_trainer_list())
+        size = min(buffer_size, num_trainers)
+        if size < buffer_size:
+            logger.warning(
+                f'buffer_size {buffer_size} is larger than the {num_trainers} trainers, using {size}', extra=executionType)
+            print(color.YELLOW +
+                  f'buffer_size {buffer_size} is larger than the {num_trainers} trainers, using {size}' + color.RESET)
+
+        for t in controller.get_trainer_list():
+            m = json.dumps({'id': t, 'selected': True, 'round': 0}).replace(' ', '')
+            client.publish('minifed/selectionQueue', m)
+            spnfl_logger.info(f'T_SELECT {t} True')
+
+        while controller.get_current_round() != nun_rounds:
+            version = controller.get_current_round()
+            spnfl_logger.info(f'START_ROUND {version}')
+            spnfl_logger.info(f'T_RETURN_0_START')
+            controller.wait_for_responses(size)
+            spnfl_logger.info(f'T_RETURN_0_END {controller.get_num_responses()}')
+
+            spnfl_logger.info(f'T_AGGREG_START')
+            agg_response, staleness = controller.agg_buffered_weights(
+                size, staleness_exponent, server_learning_rate)
+            version = controller.get_current_round()
+            spnfl_logger.info(f'T_AGGREG_END')
+
+            publish_global_model(version, agg_response)
+            spnfl_logger.info(f'T_SEND')
+
+            logger.info(f'round: {version}', extra=metricType)
+            logger.info(f'staleness: {json.dumps(staleness)}', extra=metricType)
+            print(color.BOLD_START + f'published global model version {version} '
+                  f'(staleness of the updates: {staleness})' + color.BOLD_END)
+
+            # the accuracies come from the last model each trainer evaluated, so they lag behind
+            mean_acc = controller.get_mean_latest_acc()
+            logger.info(f'mean_accuracy: {mean_acc}\n', extra=metricType)
+            print(color.GREEN +
+                  f'mean accuracy of the latest metrics was {mean_acc}\n' + color.RESET)
+
+            spnfl_logger.info(f'T_SAVE_START')
+            if mean_acc >= best_acc:
+                best_model = controller.get_global_model()
+                best_acc = mean_acc
+            spnfl_logger.info(f'T_SAVE_END')
+            spnfl_logger.info(f'END_ROUND {version}')
+
+            if mean_acc >= stop_acc:
+                logger.info('stop_condition: accuracy', extra=metricType)
+                print(color.RED + f'accuracy threshold met! stopping the training!')
+                break
+        else:
+            logger.info('stop_condition: rounds', extra=metricType)
+            print(color.RED + f'rounds threshold met! stopping the training!' + color.RESET)
+
+        save_best_model(best_model)
+        client.publish('minifed/stopQueue', json.dumps({'stop': True}))
+        time.sleep(1)  # time for clients to finish
+        controller.close()
+        client.loop_stop()
+
     # connect on queue
     controller = Controller(min_trainers=min_trainers, num_rounds=nun_rounds,
-                            client_selector=client_selector, aggregator=aggregator)
+                            client_selector=client_selector, aggregator=aggregator,
+                            late_policy=late_policy, aggregator_args=aggregator_args,
+                            model_versions=downlink_encoder.versions if downlink_encoder else 1)
     client = mqtt.Client('server')
     client.connect(broker_addr, bind_port=1883)
     client.on_connect = on_connect
@@ -173,11 +383,14 @@ def server():
     spnfl_logger.info("T_ARRIVAL_START")
 
     # wait trainers to connect
-    while controller.get_num_trainers() < min_trainers:
-        time.sleep(1)
+    controller.wait_for_trainers(min_trainers)
 
     spnfl_logger.info(f'T_ARRIVAL_END {min_trainers} {controller.get_num_trainers()}')
 
+    if mode == "async":
+        run_async()
+        return
+
     # begin training
     selected_qtd = 0
     round_times = []  # lista para armazenar o tempo de cada round
@@ -199,6 +412,7 @@ def server():
             logger.critical("Client's list empty", extra=executionType)
         select_trainers = controller.select_trainers_for_round()
         selected_qtd = len(select_trainers)
+        controller.open_phase("train")
 
         logger.info(f"n_selected: {len(select_trainers)}", extra=metricType)
         logger.info(
@@ -209,13 +423,15 @@ def server():
                 #     f'selected: {t}', extra=metricType)
                 print(
                     f'selected trainer {t} for training on round {controller.get_current_round()}')
-                m = json.dumps({'id': t, 'selected': True}).replace(' ', '')
+                m = json.dumps({'id': t, 'selected': True,
+                                'round': controller.get_current_round()}).replace(' ', '')
                 client.publish('minifed/selectionQueue', m)
                 spnfl_logger.info(f'T_SELECT {t} True')
             else:
                 # logger.info(
                 #     f'NOT_selected: {t}', extra=metricType)
-                m = json.dumps({'id': t, 'selected': False}).replace(' ', '')
+                m = json.dumps({'id': t, 'selected': False,
+                                'round': controller.get_current_round()}).replace(' ', '')
                 client.publish('minifed/selectionQueue', m)
                 spnfl_logger.info(f'T_SELECT {t} False')
 
@@ -224,21 +440,29 @@ def server():
         spnfl_logger.info(f'T_RETURN_0_START')
 
         # wait for agg responses
-        while controller.get_num_responses() != selected_qtd:
-            time.sleep(1)
+        wait_phase("train", selected_qtd, train_deadline)
         spnfl_logger.info(f'T_RETURN_0_END {controller.get_num_responses()}')
         controller.reset_num_responses()  # reset num_responses for next round
 
+        if not controller.has_training_responses():
+            # nenhum trainer respondeu: the global model is kept and the round is skipped
+            logger.info(
+                f'no training responses on round {controller.get_current_round()}, skipping aggregation', extra=executionType)
+            print(color.YELLOW +
+                  f'no training responses on round {controller.get_current_round()}, skipping aggregation' + color.RESET)
+            spnfl_logger.info(f'END_ROUND {controller.get_current_round()}')
+            continue
+
         spnfl_logger.info(f'T_AGGREG_START')
 
         # aggregate and send
         agg_response = controller.agg_weights()
-        response = json.dumps({'agg_response': agg_response}, default=default)
 
         spnfl_logger.info(f'T_AGGREG_END')
 
-
-        client.publish('minifed/posAggQueue', response) #### T_SEND
+        #### T_SEND
+        controller.open_phase("metrics")
+        publish_global_model(controller.get_current_round(), agg_response)
 
         spnfl_logger.info(f'T_SEND')
 
@@ -249,8 +473,7 @@ def server():
         spnfl_logger.info(f'T_RETURN_1_START')
 
         # wait for metrics response
-        while controller.get_num_responses() != controller.get_num_trainers():
-            time.sleep(1)
+        wait_phase("metrics", controller.get_num_trainers(), metrics_deadline)
         spnfl_logger.info(f'T_RETURN_1_END {controller.get_num_responses()}')
 
         #spnfl_logger.info(f'T_COMPUTE_START')
@@ -284,8 +507,7 @@ def server():
 
         # update stop queue or continue process
         if mean_acc >= stop_acc:
-            with open(saved_model_file, "w", encoding="utf-8") as f:
-                json.dump(best_model, f, ensure_ascii=False, indent=2)
+            save_best_model(best_model)
             #spnfl_logger.info(f'T_SAVE_END')
 
             logger.info('stop_condition: accuracy', extra=metricType)
@@ -295,6 +517,7 @@ def server():
             time.sleep(1)  # time for clients to finish
             #spnfl_logger.info(f'T_COMPUTE_END')
             spnfl_logger.info(f'END_ROUND {controller.get_current_round()}')
+            controller.close()
             exit()
 
         #spnfl_logger.info(f'T_SAVE_END')
@@ -304,13 +527,13 @@ def server():
 
 
     #spnfl_logger.info(f'T_SAVE_START')
-    with open(saved_model_file, "w", encoding="utf-8") as f:
-        json.dump(best_model, f, ensure_ascii=False, indent=2)
+    save_best_model(best_model)
     #spnfl_logger.info(f'T_SAVE_END')
 
     logger.info('stop_condition: rounds', extra=metricType)
     print(color.RED + f'rounds threshold met! stopping the training!' + color.RESET)
     client.publish('minifed/stopQueue', m)
+    controller.close()
     client.loop_stop()
 
 
@@ -0,0 +1,101 @@
+import os
+import struct
+
+import numpy as np
+import pytest
+
+from codec import MAGIC, BinaryCodec, JsonCodec, decode, get_codec
+
+
+def default(obj):
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, (bytes, bytearray, memoryview)):
+        return bytes(obj).decode('cp437')
+    raise TypeError(type(obj))
+
+
+def message():
+    return {
+        "id": "sta0", "round": 3, "success": True, "num_samples": np.int64(100),
+        "weights": [np.arange(12, dtype=np.float32).reshape(3, 4),
+                    np.linspace(-1, 1, 5),
+                    np.array([1, -2, 3], dtype=np.int8),
+                    np.zeros((0, 4), dtype=np.float32)],
+        "training_args": [None, 0.5, "x", [1, 2]],
+    }
+
+
+def test_binary_roundtrip():
+    original = message()
+    payload = BinaryCodec().encode(original)
+    assert payload[:4] == MAGIC
+    decoded = decode(payload)
+    assert decoded["id"] == "sta0" and decoded["num_samples"] == 100
+    assert decoded["training_args"] == [None, 0.5, "x", [1, 2]]
+    for a, b in zip(decoded["weights"], original["weights"]):
+        assert a.dtype == b.dtype and a.shape == b.shape
+        np.testing.assert_array_equal(a, b)
+
+
+def test_json_roundtrip():
+    original = message()
+    decoded = decode(JsonCodec(default=default).encode(original))
+    for a, b in zip(decoded["weights"], original["weights"]):
+        np.testing.assert_array_equal(np.asarray(a, dtype=b.dtype).reshape(b.shape), b)
+
+
+def test_buffers_are_aligned():
+    payload = BinaryCodec().encode({"a": np.ones(3, dtype=np.int8), "b": np.ones(3, dtype=np.float64)})
+    header_len = struct.unpack_from('<I', payload, len(MAGIC))[0]
+    assert (len(MAGIC) + 4 + header_len) % 8 == 0
+    decoded = decode(payload)
+    np.testing.assert_array_equal(decoded["b"], np.ones(3))
+
+
+def test_decoded_arrays_are_read_only_views():
+    # the arrays point into the payload: the receivers copy them before writing
+    decoded = decode(BinaryCodec().encode({"w": np.arange(4, dtype=np.float32)}))
+    assert not decoded["w"].flags.writeable
+    with pytest.raises(ValueError):
+        decoded["w"][0] = 1
+
+
+def test_encodes_read_only_non_contiguous_and_big_endian_arrays():
+    read_only = np.arange(6, dtype=np.float32)
+    read_only.setflags(write=False)
+    strided = np.arange(20, dtype=np.float32).reshape(4, 5)[:, ::2]
+    big_endian = np.arange(4, dtype='>f8')
+    decoded = decode(BinaryCodec().encode([read_only, strided, big_endian]))
+    np.testing.assert_array_equal(decoded[0], read_only)
+    np.testing.assert_array_equal(decoded[1], strided)
+    np.testing.assert_array_equal(decoded[2], big_endian)
+    assert decoded[2].dtype == np.dtype('<f8')
+
+
+def test_bytes_roundtrip():
+    blob = bytes(range(256)) * 3
+    assert decode(BinaryCodec().encode({"distances_bin": blob}))["distances_bin"] == blob
+
+
+def test_default_hook():
+    class Opaque:
+        pass
+
+    with pytest.raises(TypeError):
+        BinaryCodec().encode({"x": Opaque()})
+    decoded = decode(BinaryCodec(default=lambda obj: [1, 2]).encode({"x": Opaque()}))
+    assert decoded["x"] == [1, 2]
+
+
+def test_unknown_codec():
+    with pytest.raises(ValueError):
+        get_codec("msgpack")
+
+
+def test_client_copy_is_identical():
+    here = os.path.dirname(os.path.abspath(__file__))
+    with open(os.path.join(here, "codec.py")) as f, open(os.path.join(here, "..", "client", "codec.py")) as g:
+        assert f.read() == g.read()
@@ -0,0 +1,101 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("pandas")  # imported by the controller
+
+from aggregator.delta import DeltaEncoder, apply_delta
+from controller import Controller
+
+
+def layers(value):
+    return [np.full((4, 5), value, dtype=np.float32), np.full(5, value, dtype=np.float32)]
+
+
+def test_sent_models_ring_buffer():
+    controller = Controller(model_versions=2)
+    for r in range(1, 4):
+        controller.add_sent_model(r, {"all": {"weights": layers(r)}})
+    assert controller.get_sent_weights("t0", 1) is None  # evicted
+    np.testing.assert_array_equal(controller.get_sent_weights("t0", 2)[0], layers(2)[0])
+    np.testing.assert_array_equal(controller.get_sent_weights("t0", 3)[0], layers(3)[0])
+    assert controller.get_sent_weights("t0", None) is None
+    assert controller.get_last_sent_model()[0] == 3
+
+
+def test_sent_weights_of_each_trainer():
+    controller = Controller(model_versions=1)
+    controller.add_sent_model(1, {"t0": {"weights": layers(5)}, "all": {"weights": layers(1)}})
+    assert controller.get_sent_weights("t0", 1)[0][0, 0] == 5
+    assert controller.get_sent_weights("t1", 1)[0][0, 0] == 1
+
+
+def test_downlink_payloads():
+    controller = Controller(model_versions=2)
+    encoder = DeltaEncoder(versions=2, sparsify={"scheme": "topk", "ratio": 0.5})
+    for t in ("t0", "t1", "t2", "t3"):
+        controller.add_trainer(t)
+
+    # first model: nobody has a base, everybody gets the full model on the shared topic
+    sent, shared, per_client, counts = controller.get_downlink_payloads({"weights": layers(1)}, encoder)
+    assert per_client == {} and counts == (0, 4) and "base_round" not in shared
+    controller.add_sent_model(1, sent)
+
+    new = [w.copy() for w in layers(1)]
+    new[1][:2] = 7
+    sent_2, _, _, _ = controller.get_downlink_payloads({"weights": new}, encoder)
+    controller.add_sent_model(2, sent_2)
+
+    new = [w.copy() for w in sent_2["all"]["weights"]]
+    new[0][0] = 9
+    controller.set_client_version("t0", 2)  # holds the last model sent
+    controller.set_client_version("t1", 1)  # older version still in the ring buffer
+    controller.set_client_version("t2", 0)  # evicted
+    sent, shared, per_client, counts = controller.get_downlink_payloads({"weights": new}, encoder)
+    assert counts == (2, 2)
+    assert per_client["t0"]["base_round"] == 2 and per_client["t0"]["weights"]["delta"] is True
+    assert per_client["t1"]["base_round"] == 1 and per_client["t1"]["weights"]["delta"] is False
+    assert "base_round" not in per_client["t2"] and "base_round" not in per_client["t3"]
+
+    # every trainer rebuilds exactly the model registered as sent
+    bases = {"t0": sent_2["all"]["weights"], "t1": layers(1)}
+    for t, payload in per_client.items():
+        if "base_round" in payload:
+            rebuilt = apply_delta(payload["weights"], bases[t])
+        else:
+            rebuilt = payload["weights"]
+        for a, b in zip(rebuilt, sent["all"]["weights"]):
+            np.testing.assert_array_equal(a, b)
+
+
+def test_training_responses_of_the_open_round():
+    controller = Controller(late_policy="buffer")
+    controller.current_round = 1
+    controller.open_phase("train")
+    assert controller.add_training_response("t0", 1, {"weights": layers(1), "num_samples": 10}) == "accepted"
+    assert controller.add_training_response("t1", 0, {"weights": layers(3), "num_samples": 10}) == "buffered"
+    assert controller.add_training_response("t2", 1, None) == "accepted"  # failed training
+    assert controller.get_num_responses() == 1
+    controller.close_phase()
+    # the phase is closed: the response waits for the next aggregation instead of being lost
+    assert controller.add_training_response("t2", 1, {"weights": layers(5), "num_samples": 10}) == "buffered"
+    weights = controller.agg_weights()["all"]["weights"]
+    np.testing.assert_allclose(weights[0], 3)
+    assert controller.client_training_response == {} and controller.late_responses == {}
+
+
+def test_late_training_responses_are_dropped():
+    controller = Controller()
+    controller.open_phase("train")
+    controller.close_phase()
+    assert controller.add_training_response("t0", 0, {"weights": layers(1), "num_samples": 10}) == "dropped"
+    assert controller.late_responses == {}
+
+
+def test_percentile_deadline():
+    controller = Controller()
+    assert controller.get_deadline("train", None, 5) is None
+    assert controller.get_deadline("train", 3) == 3.0
+    assert controller.get_deadline("train", "p90") is None
+    assert controller.get_deadline("train", "p90", initial=5) == 5.0  # no history yet
+    controller.response_times["train"].extend([1.0, 2.0, 3.0])
+    assert controller.get_deadline("train", "p50", initial=5) == 2.0